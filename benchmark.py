@@ -0,0 +1,291 @@
+"""Benchmark de la app con datos sintéticos.
+
+Uso:
+    python benchmark.py                                # 1k, 10k y 100k ofertas
+    python benchmark.py --tamanos 1000 10000 --salida bench.json
+    python benchmark.py --tamanos 10000 --posturas 10000
+    AGUACATE_PERSISTENCIA=sqlite python benchmark.py --tamanos 10000
+
+Para cada tamaño se generan datos con generar_datos.py en un directorio
+temporal y se mide, en un proceso aparte (para que la memoria y las cachés
+de un tamaño no afecten al siguiente):
+
+- carga de cada tabla con cargar_tabla / load_csv_list;
+- arranque (construir DatosCompartidos) y memoria pico de los datos;
+- archivado inicial de negociaciones terminadas;
+- save_all() después de un cambio;
+- emparejamiento de ofertas con las posturas de compra (libros por calibre
+  frente a comparar cada oferta con todas las posturas);
+- main() con AppTest para cada rol y modo de vista: primera ejecución,
+  segunda ejecución y la latencia de cada vista registrada por medir_latencia.
+
+El resultado es un JSON con la versión del código (commit de git) y la
+configuración, para comparar entre versiones.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generar_datos
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+RUTA_MAIN = os.path.join(DIRECTORIO, "main.py")
+
+USUARIOS_BENCHMARK = [("buyer", "comprador1"), ("producer", "vendedor1")]
+
+
+def ms_desde(inicio):
+    return round((time.perf_counter() - inicio) * 1000, 3)
+
+
+def medir_save_all(main, repeticiones=5):
+    """ms de save_all() tras anotar un registro de historial."""
+    datos = main.get_datos()
+    oferta = next(iter(datos.offers), None)
+    tiempos = []
+    for _ in range(repeticiones):
+        with datos.lock:
+            main.registrar_historial(
+                oferta["id"] if oferta else "benchmark", "benchmark", "interes",
+                "Registro de prueba del benchmark.",
+            )
+            inicio = time.perf_counter()
+            main.save_all()
+            tiempos.append(ms_desde(inicio))
+    return round(statistics.median(tiempos), 3)
+
+
+def medir_emparejamiento(main, muestras=500):
+    """ms por oferta para encontrar las posturas que la aceptan.
+
+    Compara LibroPosturas.compatibles con recorrer todas las posturas activas
+    y verifica que ambos den las mismas coincidencias.
+    """
+    datos = main.get_datos()
+    posturas = [p for p in datos.posturas.registros() if p.get("activa")]
+    ofertas = [o for o in datos.offers if main.oferta_disponible(o)]
+    ofertas = random.Random(1).sample(ofertas, min(muestras, len(ofertas)))
+    limite = main.AVISOS_POR_OFERTA
+
+    def lineal(oferta):
+        candidatas = sorted(
+            (p for p in posturas if main.postura_acepta(p, oferta)),
+            key=lambda p: -p["precio_max"],
+        )
+        elegidas, compradores = [], set()
+        for p in candidatas:
+            if p["buyer"] not in compradores:
+                elegidas.append(p)
+                compradores.add(p["buyer"])
+        return elegidas[:limite]
+
+    resultado = {"posturas": len(posturas), "ofertas": len(ofertas)}
+    coincidencias = {}
+    for nombre, buscar in (
+        ("libro", lambda o: datos.posturas.compatibles(o, limite)),
+        ("lineal", lineal),
+    ):
+        tiempos, encontradas = [], []
+        for oferta in ofertas:
+            inicio = time.perf_counter()
+            encontradas.append(buscar(oferta))
+            tiempos.append(ms_desde(inicio))
+        tiempos.sort()
+        coincidencias[nombre] = [
+            sorted((p["buyer"], p["precio_max"]) for p in e) for e in encontradas
+        ]
+        resultado[f"{nombre}_ms_mediana"] = round(statistics.median(tiempos), 4) if tiempos else None
+        resultado[f"{nombre}_ms_p95"] = (
+            round(tiempos[int(len(tiempos) * 0.95)], 4) if tiempos else None
+        )
+    # Mismos compradores y precios (entre empates de precio el orden puede variar)
+    resultado["coinciden"] = all(
+        [c[1] for c in libro] == [c[1] for c in lineal_]
+        for libro, lineal_ in zip(coincidencias["libro"], coincidencias["lineal"])
+    )
+    return resultado
+
+
+def medir_apptest(rol, usuario, compacto):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(RUTA_MAIN, default_timeout=600)
+    at.session_state["user"] = usuario
+    at.session_state["role"] = rol
+    at.session_state["modo_compacto"] = compacto
+    inicio = time.perf_counter()
+    at.run()
+    primera = ms_desde(inicio)
+    inicio = time.perf_counter()
+    at.run()
+    segunda = ms_desde(inicio)
+    return {
+        "rol": rol,
+        "usuario": usuario,
+        "compacto": compacto,
+        "primera_ms": primera,
+        "segunda_ms": segunda,
+        "vistas_ms": {
+            seccion: round(ms, 3)
+            for seccion, ms in sorted(at.session_state["latencias"].items())
+        },
+        "errores": [e.message for e in at.exception],
+    }
+
+
+def medir(directorio):
+    """Mide con los datos de `directorio` (se ejecuta en un proceso aparte)."""
+    os.chdir(directorio)
+    import main
+
+    resultado = {"cargas": {}}
+    for nombre in main.TABLAS:
+        inicio = time.perf_counter()
+        filas = main.cargar_tabla(nombre)
+        resultado["cargas"][nombre] = {"filas": len(filas), "ms": ms_desde(inicio)}
+
+    def construir():
+        return main.DatosCompartidos(main.ALMACENES[main.MODO_PERSISTENCIA]())
+
+    # La primera construcción incluye la importación inicial de SQLite
+    inicio = time.perf_counter()
+    construir()
+    resultado["arranque_inicial_ms"] = ms_desde(inicio)
+    inicio = time.perf_counter()
+    construir()
+    resultado["arranque_ms"] = ms_desde(inicio)
+    tracemalloc.start()
+    datos = construir()
+    resultado["memoria_pico_datos_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+    tracemalloc.stop()
+    del datos
+
+    inicio = time.perf_counter()
+    resultado["negociaciones_archivadas"] = main.archivar_negociaciones()
+    resultado["archivar_ms"] = ms_desde(inicio)
+    resultado["ofertas_calientes"] = len(main.get_datos().offers)
+    resultado["save_all_ms"] = medir_save_all(main)
+    resultado["emparejamiento"] = medir_emparejamiento(main)
+    if main.ESCRITURA_DIFERIDA:
+        main.get_cola_escritura().vaciar()
+
+    # Arranque de la app en AppTest (carga sus propios datos compartidos)
+    from streamlit.testing.v1 import AppTest
+
+    inicio = time.perf_counter()
+    AppTest.from_file(RUTA_MAIN, default_timeout=600).run()
+    resultado["app_arranque_ms"] = ms_desde(inicio)
+
+    resultado["vistas"] = [
+        medir_apptest(rol, usuario, compacto)
+        for rol, usuario in USUARIOS_BENCHMARK
+        for compacto in (False, True)
+    ]
+    # ru_maxrss está en KB en Linux
+    resultado["rss_pico_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2
+    )
+    return resultado
+
+
+def version_codigo():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DIRECTORIO,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versiones = {"git": commit, "python": platform.python_version()}
+    for modulo in ("streamlit", "pandas"):
+        try:
+            versiones[modulo] = __import__(modulo).__version__
+        except ImportError:
+            versiones[modulo] = None
+    return versiones
+
+
+def configuracion():
+    return {
+        variable: os.environ.get(variable)
+        for variable in (
+            "AGUACATE_PERSISTENCIA", "AGUACATE_SNAPSHOT",
+            "AGUACATE_ESCRITURA_DIFERIDA", "AGUACATE_FSYNC",
+            "AGUACATE_MULTIPROCESO",
+        )
+    }
+
+
+def ejecutar(tamano, semilla, posturas, conservar):
+    directorio = tempfile.mkdtemp(prefix=f"aguacate_bench_{tamano}_")
+    try:
+        args = generar_datos.parser_argumentos().parse_args(
+            ["--dir", directorio, "--ofertas", str(tamano), "--semilla", str(semilla),
+             "--posturas", str(posturas)]
+        )
+        inicio = time.perf_counter()
+        generar_datos.escribir(generar_datos.Generador(args).generar(), directorio)
+        generar_ms = ms_desde(inicio)
+
+        proceso = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--medir", directorio],
+            capture_output=True, text=True,
+        )
+        if proceso.returncode != 0:
+            return {"ofertas": tamano, "error": proceso.stderr.strip().splitlines()[-1:]}
+        # La última línea de la salida es el JSON (Streamlit puede escribir avisos antes)
+        resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+        return {"ofertas": tamano, "generar_ms": generar_ms, **resultado}
+    finally:
+        if conservar:
+            print(f"Datos de {tamano} ofertas en {directorio}", file=sys.stderr)
+        else:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tamanos", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Número de ofertas iniciales de cada corrida")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--posturas", type=int, default=10000,
+                        help="Posturas de compra activas de cada corrida")
+    parser.add_argument("--salida", help="Archivo JSON de salida (por defecto stdout)")
+    parser.add_argument("--conservar", action="store_true",
+                        help="No borrar los directorios de datos generados")
+    parser.add_argument("--medir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        print(json.dumps(medir(args.medir)))
+        return
+
+    informe = {
+        "version": version_codigo(),
+        "configuracion": configuracion(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "resultados": [
+            ejecutar(n, args.semilla, args.posturas, args.conservar) for n in args.tamanos
+        ],
+    }
+    texto = json.dumps(informe, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,264 @@
+"""Generador de datos sintéticos para probar la app a escala.
+
+Uso:
+    python generar_datos.py --dir datos_bench --ofertas 10000
+    python generar_datos.py --dir datos_bench --ofertas 1000 --productores 20 \
+        --compradores 100 --prob-contra 0.5 --max-contras 4 --interes 1.5
+    python generar_datos.py --dir datos_bench --ofertas 1000 --posturas 10000
+
+Escribe offers, history, notifications, buyer_actions, lecturas y posturas en `--dir`
+con el esquema tipado de main.py (CSV o Parquet según AGUACATE_SNAPSHOT).
+Los usuarios se llaman vendedor1..N y comprador1..M, así vendedor1,
+comprador1 y comprador2 coinciden con los usuarios de prueba de la app.
+"""
+
+import argparse
+import math
+import os
+import random
+import time
+from datetime import datetime
+
+import main
+
+CALIBRES = ["12", "14", "16", "18", "20", "22", "24", "26"]
+MADUREZ = ["Verde", "Sazón", "Maduro"]
+ORIGENES = ["Michoacán", "Jalisco", "Estado de México", "Nayarit", "Morelos"]
+
+
+def texto_fecha(ts):
+    """Mismo formato que main.ahora()."""
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %I:%M %p")
+
+
+class Generador:
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.semilla)
+        self.productores = [f"vendedor{i}" for i in range(1, args.productores + 1)]
+        self.compradores = [f"comprador{i}" for i in range(1, args.compradores + 1)]
+        self.offers = []
+        self.history = []
+        self.notifications = []
+        self.buyer_actions = set()
+        self.posturas = []
+        self.ahora = time.time()
+        self.n_id = 0
+
+    def nuevo_id(self):
+        self.n_id += 1
+        return f"{self.n_id:08x}"
+
+    def historial(self, offer_id, actor, accion, detalle, ts):
+        self.history.append({
+            "offer_id": offer_id,
+            "actor": actor,
+            "accion": accion,
+            "detalle": detalle,
+            "fecha": texto_fecha(ts),
+        })
+
+    def notificar(self, mensaje, ts, usuario=None, rol=None):
+        self.notifications.append({
+            "usuario_destino": usuario,
+            "rol_destino": rol,
+            "mensaje": mensaje,
+            "fecha": texto_fecha(ts),
+            "ts": ts,
+        })
+
+    def cantidad(self, media):
+        """Entero aleatorio con distribución de Poisson (algoritmo de Knuth)."""
+        limite, k, p = math.exp(-media), 0, self.rnd.random()
+        while p > limite:
+            k += 1
+            p *= self.rnd.random()
+        return k
+
+    def condiciones(self):
+        return {
+            "toneladas": float(self.rnd.randint(1, 40)),
+            "recoleccion": str(self.rnd.randint(1, 15)),
+            "canastillas": str(self.rnd.randint(50, 2000)),
+            "precio": float(self.rnd.randint(20, 60) * 1000),
+            "calibre": self.rnd.choice(CALIBRES),
+            "madurez": self.rnd.choice(MADUREZ),
+            "origen": self.rnd.choice(ORIGENES),
+        }
+
+    def registro(self, tipo, producer, buyer, parent, ts, status):
+        r = {
+            "id": self.nuevo_id(),
+            "tipo": tipo,
+            "producer": producer,
+            "buyer": buyer,
+            "parent_offer_id": parent,
+            **self.condiciones(),
+            "notas": None,
+            "status": status,
+            "producer_hidden": False if tipo == "offer" else None,
+            "created_at": texto_fecha(ts),
+            "updated_at": texto_fecha(ts),
+        }
+        self.offers.append(r)
+        return r
+
+    def negociacion(self):
+        """Una oferta con su cadena de contraofertas, historial y avisos."""
+        rnd = self.rnd
+        # Cada paso de la negociación ocurre hasta una hora después del anterior
+        ts = self.ahora - rnd.uniform(86400, self.args.dias * 86400)
+        productor = rnd.choice(self.productores)
+        oferta = self.registro("offer", productor, None, None, ts, "open")
+        self.historial(oferta["id"], productor, "crear_oferta",
+                       "El productor creó una oferta inicial.", ts)
+        self.notificar(f"El productor {productor} publicó una nueva oferta #{oferta['id']}.",
+                       ts, rol="buyer")
+
+        for _ in range(self.cantidad(self.args.interes)):
+            ts += rnd.uniform(60, 3600)
+            comprador = rnd.choice(self.compradores)
+            self.historial(oferta["id"], comprador, "interes",
+                           f"El comprador {comprador} marcó interés en la oferta.", ts)
+            self.notificar(f"El comprador {comprador} marcó interés en tu oferta #{oferta['id']}.",
+                           ts, usuario=productor)
+
+        cerrada = False
+        if rnd.random() < self.args.prob_contra:
+            for _ in range(rnd.randint(1, self.args.max_contras)):
+                ts += rnd.uniform(60, 3600)
+                comprador = rnd.choice(self.compradores)
+                contra = self.registro("counter", productor, comprador, oferta["id"], ts, "open")
+                self.buyer_actions.add((comprador, oferta["id"]))
+                self.historial(oferta["id"], comprador, "contraoferta_comprador",
+                               f"El comprador {comprador} envió una contraoferta.", ts)
+                self.notificar(f"El comprador {comprador} hizo una contraoferta a tu oferta "
+                               f"#{oferta['id']}.", ts, usuario=productor)
+                ts += rnd.uniform(60, 3600)
+                final = rnd.random()
+                if final < 0.25:
+                    contra["status"] = "accepted"
+                    oferta.update(status="closed", buyer=comprador)
+                    self.historial(contra["id"], productor, "aceptar_contraoferta",
+                                   f"El productor aceptó la contraoferta de {comprador}.", ts)
+                    self.notificar(f"El productor aceptó tu contraoferta #{contra['id']}.",
+                                   ts, usuario=comprador)
+                    cerrada = True
+                elif final < 0.5:
+                    contra["status"] = "rejected"
+                    self.historial(contra["id"], productor, "rechazar_contraoferta",
+                                   f"El productor rechazó la contraoferta de {comprador}.", ts)
+                    self.notificar(f"El productor rechazó tu contraoferta #{contra['id']}.",
+                                   ts, usuario=comprador)
+                elif final < 0.8:
+                    contra["status"] = "answered"
+                    oferta.update(self.condiciones())
+                    self.buyer_actions.discard((comprador, oferta["id"]))
+                    self.historial(oferta["id"], productor, "contraoferta_vendedor",
+                                   f"El productor envió una contraoferta al comprador {comprador}.", ts)
+                    self.notificar(f"El productor {productor} envió una contraoferta sobre la "
+                                   f"oferta #{oferta['id']}.", ts, usuario=comprador)
+                contra["updated_at"] = texto_fecha(ts)
+                oferta["updated_at"] = texto_fecha(ts)
+                if cerrada or contra["status"] == "open":
+                    break
+
+        if not cerrada and rnd.random() < self.args.prob_aceptada:
+            ts += rnd.uniform(60, 3600)
+            comprador = rnd.choice(self.compradores)
+            oferta.update(status="accepted", buyer=comprador, updated_at=texto_fecha(ts))
+            self.buyer_actions.add((comprador, oferta["id"]))
+            self.historial(oferta["id"], comprador, "aceptar_oferta",
+                           f"El comprador {comprador} aceptó la oferta.", ts)
+            self.notificar(f"El comprador {comprador} aceptó tu oferta #{oferta['id']}.",
+                           ts, usuario=productor)
+
+    def subconjunto(self, valores, prob_cualquiera):
+        """Valores aceptados por una postura, separados por coma ("" = cualquiera)."""
+        if self.rnd.random() < prob_cualquiera:
+            return None
+        return ",".join(self.rnd.sample(valores, self.rnd.randint(1, min(3, len(valores)))))
+
+    def postura(self):
+        rnd = self.rnd
+        minimo = float(rnd.randint(1, 10)) if rnd.random() < 0.5 else None
+        maximo = (minimo or 0) + rnd.randint(5, 30) if rnd.random() < 0.5 else None
+        ts = self.ahora - rnd.uniform(0, self.args.dias * 86400)
+        self.posturas.append({
+            "id": self.nuevo_id(),
+            "buyer": rnd.choice(self.compradores),
+            "precio_max": float(rnd.randint(20, 60) * 1000),
+            "toneladas_min": minimo,
+            "toneladas_max": float(maximo) if maximo is not None else None,
+            "calibres": self.subconjunto(CALIBRES, 0.2),
+            "madurez": self.subconjunto(MADUREZ, 0.5),
+            "origenes": self.subconjunto(ORIGENES, 0.5),
+            "activa": True,
+            "created_at": texto_fecha(ts),
+        })
+
+    def generar(self):
+        for _ in range(self.args.ofertas):
+            self.negociacion()
+        for _ in range(self.args.posturas):
+            self.postura()
+        # Las tablas se guardan en orden cronológico, como las escribe la app
+        self.history.sort(key=lambda h: main.fecha_ordenable(h["fecha"]))
+        self.notifications.sort(key=lambda n: n["ts"])
+        return {
+            "offers": self.offers,
+            "history": self.history,
+            "notifications": self.notifications,
+            "buyer_actions": [
+                {"buyer": b, "offer_id": o} for b, o in sorted(self.buyer_actions)
+            ],
+            "lecturas": [],
+            "posturas": self.posturas,
+        }
+
+
+def escribir(tablas, directorio):
+    """Guarda las tablas en `directorio` con el formato de snapshot actual."""
+    os.makedirs(directorio, exist_ok=True)
+    anterior = os.getcwd()
+    os.chdir(directorio)
+    try:
+        for nombre in main.TABLAS:
+            main.guardar_tabla(nombre, tablas[nombre])
+    finally:
+        os.chdir(anterior)
+
+
+def parser_argumentos():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", required=True, help="Directorio de salida")
+    parser.add_argument("--ofertas", type=int, default=1000,
+                        help="Ofertas iniciales (las contraofertas se suman aparte)")
+    parser.add_argument("--productores", type=int, default=20)
+    parser.add_argument("--compradores", type=int, default=100)
+    parser.add_argument("--prob-contra", type=float, default=0.5,
+                        help="Probabilidad de que una oferta reciba contraofertas")
+    parser.add_argument("--max-contras", type=int, default=4,
+                        help="Largo máximo de la cadena de contraofertas")
+    parser.add_argument("--prob-aceptada", type=float, default=0.2,
+                        help="Probabilidad de que un comprador acepte la oferta tal cual")
+    parser.add_argument("--interes", type=float, default=1.0,
+                        help="Promedio de marcas de interés por oferta")
+    parser.add_argument("--posturas", type=int, default=0,
+                        help="Posturas de compra activas de los compradores")
+    parser.add_argument("--dias", type=int, default=180,
+                        help="Antigüedad máxima de las ofertas")
+    parser.add_argument("--semilla", type=int, default=1)
+    return parser
+
+
+def main_cli():
+    args = parser_argumentos().parse_args()
+    tablas = Generador(args).generar()
+    escribir(tablas, args.dir)
+    resumen = ", ".join(f"{nombre}: {len(filas)}" for nombre, filas in tablas.items())
+    print(f"Datos generados en {args.dir} ({resumen})")
+
+
+if __name__ == "__main__":
+    main_cli()
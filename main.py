@@ -1,9 +1,32 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
 from datetime import datetime
 import uuid
 import os
+import atexit
 import math
+import collections
+import unicodedata
+import json
+import csv
+import io
+import sqlite3
+import threading
+import functools
+import contextlib
+import bisect
+import heapq
+import itertools
+import time
+import mmap
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 st.markdown("""
 <style>
@@ -39,44 +62,1857 @@ div.stDownloadButton > button {
 """, unsafe_allow_html=True)
 
 
+# ============================================================
+#  CONFIGURACIÓN
+# ============================================================
+
+# Backend de persistencia:
+#   "csv"     -> reescribe los tres CSV completos en cada save_all()
+#   "journal" -> anexa cada cambio a JOURNAL_FILE y compacta periódicamente
+#   "sqlite"  -> base SQLite (WAL) con índices; escrituras fila a fila
+MODO_PERSISTENCIA = os.environ.get("AGUACATE_PERSISTENCIA", "csv")
+JOURNAL_FILE = "journal.jsonl"
+SNAPSHOT_META_FILE = "snapshot_meta.json"
+# Notificaciones por página y días que se conservan las ya leídas
+TAMANO_PAGINA_NOTIFICACIONES = int(os.environ.get("AGUACATE_PAGINA_NOTIS", "20"))
+RETENCION_NOTIFICACIONES_DIAS = int(os.environ.get("AGUACATE_RETENCION_NOTIS", "90"))
+# Ofertas por página en el Inicio del comprador
+TAMANO_PAGINA_FEED = int(os.environ.get("AGUACATE_TAMANO_PAGINA", "20"))
+# Número de eventos en el journal a partir del cual se compacta el snapshot
+COMPACTAR_CADA = int(os.environ.get("AGUACATE_COMPACTAR_CADA", "500"))
+SQLITE_FILE = os.environ.get("AGUACATE_SQLITE", "aguacate.db")
+# Formato de los snapshots de los backends "csv" y "journal":
+#   "csv"     -> offers.csv, history.csv, ...
+#   "parquet" -> offers.parquet, ... (columnar y tipado; requiere pyarrow)
+FORMATO_SNAPSHOT = os.environ.get("AGUACATE_SNAPSHOT", "csv")
+# Negociaciones terminadas (oferta cerrada/aceptada y sin contraofertas
+# abiertas) se mueven a archivos fríos por mes tras ARCHIVAR_TRAS_DIAS días
+ARCHIVO_DIR = os.environ.get("AGUACATE_ARCHIVO", "archivo")
+ARCHIVAR_TRAS_DIAS = int(os.environ.get("AGUACATE_ARCHIVAR_DIAS", "30"))
+# Escritura diferida: save_all() solo encola los eventos y un hilo los
+# persiste por lotes cada FLUSH_CADA_MS ms o al juntar FLUSH_MAX_EVENTOS
+ESCRITURA_DIFERIDA = os.environ.get("AGUACATE_ESCRITURA_DIFERIDA", "0") == "1"
+FLUSH_CADA_MS = int(os.environ.get("AGUACATE_FLUSH_MS", "200"))
+FLUSH_MAX_EVENTOS = int(os.environ.get("AGUACATE_FLUSH_EVENTOS", "100"))
+# Durabilidad: con "1" cada escritura hace fsync antes de darse por hecha
+# (y SQLite usa synchronous=FULL); con "0" se deja al sistema operativo
+FSYNC = os.environ.get("AGUACATE_FSYNC", "0") == "1"
+# Instrumentación (opcional): duración de las secciones calientes en una
+# ventana móvil de las últimas VENTANA_METRICAS llamadas por sección
+INSTRUMENTACION = os.environ.get("AGUACATE_INSTRUMENTACION", "0") == "1"
+VENTANA_METRICAS = int(os.environ.get("AGUACATE_VENTANA_METRICAS", "1000"))
+# Feed de cambios entre sesiones: cada cuántos segundos lo consulta cada
+# sesión (0 lo desactiva) y cuántos cambios guarda cada canal
+FEED_CADA_SEGUNDOS = float(os.environ.get("AGUACATE_FEED_SEGUNDOS", "5"))
+FEED_MAX_EVENTOS = int(os.environ.get("AGUACATE_FEED_EVENTOS", "500"))
+# Varios procesos servidor sobre los mismos archivos (p. ej. detrás de un
+# balanceador): las acciones se serializan con un candado de archivo y antes
+# de cada una el proceso aplica lo que guardaron los demás desde su versión
+MULTIPROCESO = os.environ.get("AGUACATE_MULTIPROCESO", "0") == "1"
+CANDADO_FILE = os.environ.get("AGUACATE_CANDADO", "aguacate.lock")
+# Cambios que SQLite conserva para la recarga incremental de otros procesos
+RETENER_CAMBIOS = int(os.environ.get("AGUACATE_RETENER_CAMBIOS", "10000"))
+# Posturas de compra: a cuántos compradores (los que más pagan) se avisa
+# como mucho por cada oferta publicada o actualizada
+AVISOS_POR_OFERTA = int(os.environ.get("AGUACATE_AVISOS_POSTURAS", "5"))
+
+TABLAS = {
+    "offers": "offers.csv",
+    "history": "history.csv",
+    "notifications": "notifications.csv",
+    "buyer_actions": "buyer_actions.csv",
+    "lecturas": "lecturas.csv",
+    "posturas": "posturas.csv",
+}
+
+# Esquema tipado de cada tabla: columna -> dtype de pandas (todos aceptan
+# nulos). El orden es el de los CSV, los snapshots Parquet y la base SQLite.
+ESQUEMA = {
+    "offers": {
+        "id": "string",
+        "tipo": "string",
+        "producer": "string",
+        "buyer": "string",
+        "parent_offer_id": "string",
+        "toneladas": "Float64",
+        "recoleccion": "string",
+        "canastillas": "string",
+        "precio": "Float64",
+        "calibre": "string",
+        "madurez": "string",
+        "origen": "string",
+        "notas": "string",
+        "status": "string",
+        "producer_hidden": "boolean",
+        "created_at": "string",
+        "updated_at": "string",
+    },
+    "history": {
+        "offer_id": "string",
+        "actor": "string",
+        "accion": "string",
+        "detalle": "string",
+        "fecha": "string",
+    },
+    # usuario_destino para mensajes directos; rol_destino para difusión
+    # (una sola fila que ven todos los usuarios de ese rol)
+    # ts: instante de creación en segundos epoch (ordenable, con fracción)
+    "notifications": {
+        "usuario_destino": "string",
+        "rol_destino": "string",
+        "mensaje": "string",
+        "fecha": "string",
+        "ts": "Float64",
+    },
+    # Ofertas que cada comprador ya procesó (se ocultan en su Inicio)
+    "buyer_actions": {
+        "buyer": "string",
+        "offer_id": "string",
+    },
+    # Marcador de lectura por usuario y canal ("user:<nombre>" o "role:<rol>"):
+    # ts de la notificación más reciente que ya vio
+    "lecturas": {
+        "usuario": "string",
+        "canal": "string",
+        "leido_hasta": "Float64",
+    },
+    # Posturas de compra permanentes de los compradores. calibres, madurez y
+    # origenes: valores aceptados separados por coma (vacío = cualquiera)
+    "posturas": {
+        "id": "string",
+        "buyer": "string",
+        "precio_max": "Float64",
+        "toneladas_min": "Float64",
+        "toneladas_max": "Float64",
+        "calibres": "string",
+        "madurez": "string",
+        "origenes": "string",
+        "activa": "boolean",
+        "created_at": "string",
+    },
+}
+
+COLUMNAS = {tabla: list(tipos) for tabla, tipos in ESQUEMA.items()}
+
+# Tablas cuyo evento "upsert" reemplaza la fila con la misma clave
+CLAVES_UPSERT = {
+    "lecturas": ("usuario", "canal"),
+    "posturas": ("id",),
+}
+
+
+# ============================================================
+#  INSTRUMENTACIÓN
+# ============================================================
+
+def percentil(ordenados, p):
+    """Percentil p (0-100) por rango más cercano de una lista ya ordenada."""
+    if not ordenados:
+        return 0.0
+    return ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)]
+
+
+class Metricas:
+    """Histograma móvil por sección, compartido por todo el proceso.
+
+    Por sección se guardan las últimas `ventana` muestras (ts, ms, filas)
+    para los percentiles y, aparte, los totales acumulados (llamadas, ms y
+    filas) que usa el formato de Prometheus.
+    """
+
+    def __init__(self, ventana=VENTANA_METRICAS):
+        self.lock = threading.Lock()
+        self.ventana = ventana
+        self.muestras = {}
+        self.totales = {}
+
+    def registrar(self, seccion, ms, filas=None):
+        with self.lock:
+            muestras = self.muestras.get(seccion)
+            if muestras is None:
+                muestras = self.muestras[seccion] = collections.deque(maxlen=self.ventana)
+                self.totales[seccion] = [0, 0.0, 0]
+            muestras.append((time.time(), ms, filas))
+            totales = self.totales[seccion]
+            totales[0] += 1
+            totales[1] += ms
+            totales[2] += filas or 0
+
+    def reiniciar(self):
+        with self.lock:
+            self.muestras = {}
+            self.totales = {}
+
+    def _copia(self):
+        with self.lock:
+            return (
+                {s: list(m) for s, m in self.muestras.items()},
+                {s: list(t) for s, t in self.totales.items()},
+            )
+
+    def resumen(self):
+        """Una fila por sección con llamadas, percentiles (ms) y filas medias."""
+        muestras, totales = self._copia()
+        filas = []
+        for seccion in sorted(muestras):
+            ms = sorted(m[1] for m in muestras[seccion])
+            con_filas = [m[2] for m in muestras[seccion] if m[2] is not None]
+            filas.append({
+                "seccion": seccion,
+                "llamadas": totales[seccion][0],
+                "muestras": len(ms),
+                "p50_ms": round(percentil(ms, 50), 3),
+                "p95_ms": round(percentil(ms, 95), 3),
+                "p99_ms": round(percentil(ms, 99), 3),
+                "max_ms": round(ms[-1], 3),
+                "filas_media": (
+                    round(sum(con_filas) / len(con_filas), 1) if con_filas else None
+                ),
+            })
+        return filas
+
+    def prometheus(self):
+        """Texto en el formato de exposición de Prometheus."""
+        _, totales = self._copia()
+        lineas = [
+            "# HELP aguacate_seccion_ms Duración de cada sección en ms (ventana móvil).",
+            "# TYPE aguacate_seccion_ms summary",
+        ]
+        for fila in self.resumen():
+            etiqueta = f'seccion="{fila["seccion"]}"'
+            for q, columna in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lineas.append(f'aguacate_seccion_ms{{{etiqueta},quantile="{q}"}} {fila[columna]}')
+            llamadas, ms_total, _ = totales[fila["seccion"]]
+            lineas.append(f"aguacate_seccion_ms_sum{{{etiqueta}}} {round(ms_total, 3)}")
+            lineas.append(f"aguacate_seccion_ms_count{{{etiqueta}}} {llamadas}")
+        lineas += [
+            "# HELP aguacate_seccion_filas_total Filas procesadas por sección.",
+            "# TYPE aguacate_seccion_filas_total counter",
+        ]
+        for seccion, (_, _, filas) in sorted(totales.items()):
+            lineas.append(f'aguacate_seccion_filas_total{{seccion="{seccion}"}} {filas}')
+        if ESCRITURA_DIFERIDA:
+            lineas += [
+                "# HELP aguacate_cola_escritura_eventos Eventos esperando en la cola de escritura.",
+                "# TYPE aguacate_cola_escritura_eventos gauge",
+                f"aguacate_cola_escritura_eventos {get_cola_escritura().profundidad()}",
+            ]
+        return "\n".join(lineas) + "\n"
+
+    def csv(self):
+        """Muestras de la ventana en CSV (seccion, ts, ms, filas)."""
+        muestras, _ = self._copia()
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer, lineterminator="\n")
+        escritor.writerow(["seccion", "ts", "ms", "filas"])
+        for seccion in sorted(muestras):
+            for ts, ms, filas in muestras[seccion]:
+                escritor.writerow([seccion, f"{ts:.3f}", f"{ms:.3f}", "" if filas is None else filas])
+        return buffer.getvalue()
+
+
+@st.cache_resource
+def get_metricas():
+    return Metricas()
+
+
+def instrumentar(seccion, filas=None):
+    """Decorador: registra la duración de cada llamada en get_metricas().
+
+    `filas(resultado)` (opcional) indica cuántas filas procesó la llamada.
+    Sin INSTRUMENTACION devuelve la función tal cual, sin costo extra.
+    """
+    def decorador(funcion):
+        if not INSTRUMENTACION:
+            return funcion
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            resultado = None
+            try:
+                resultado = funcion(*args, **kwargs)
+                return resultado
+            finally:
+                ms = (time.perf_counter() - inicio) * 1000
+                n = filas(resultado) if filas and resultado is not None else None
+                get_metricas().registrar(seccion, ms, n)
+        return envoltura
+    return decorador
+
+
 # ============================================================
 #  FUNCIONES PARA GUARDAR / CARGAR CSV
 # ============================================================
 
-def load_csv_list(filename):
-    """Carga una lista de diccionarios desde un CSV si existe."""
+def registros_desde_df(df):
+    """DataFrame -> lista de dicts, con None en lugar de NaN/NA.
+
+    La conversión se hace por columnas (sin recorrer cada celda en Python).
+    """
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def df_tipado(records, tabla):
+    """Lista de dicts -> DataFrame con las columnas y dtypes de ESQUEMA."""
+    df = pd.DataFrame(records, columns=COLUMNAS[tabla])
+    return df.astype(ESQUEMA[tabla])
+
+
+@instrumentar("load_csv_list", filas=len)
+def load_csv_list(filename, tabla=None):
+    """Carga una lista de diccionarios desde un CSV si existe.
+
+    Con `tabla` se leen las columnas con los tipos de ESQUEMA en lugar de
+    dejar que pandas los adivine (p. ej. ids como "12345678" seguían siendo
+    texto solo por suerte).
+    """
     if not os.path.exists(filename):
         return []
-    df = pd.read_csv(filename)
-    records = df.to_dict("records")
-    # Convertir NaN a None para evitar problemas con 'nan'
-    for r in records:
-        for k, v in r.items():
-            if isinstance(v, float) and math.isnan(v):
-                r[k] = None
-    return records
+    dtype = ESQUEMA.get(tabla)
+    # memory_map: pandas parsea desde el mapa del archivo, sin copiarlo entero
+    df = pd.read_csv(filename, dtype=dtype, memory_map=True)
+    return registros_desde_df(df)
 
 
-def save_csv_list(filename, records):
+def save_csv_list(filename, records, tabla=None):
     """Guarda una lista de diccionarios en un CSV."""
-    if not records:
+    if tabla is not None:
+        df_tipado(records, tabla).to_csv(filename, index=False)
+    elif not records:
         pd.DataFrame([]).to_csv(filename, index=False)
     else:
         df = pd.DataFrame(records)
         df.to_csv(filename, index=False)
 
 
+class LectorIncremental:
+    """Lee de un archivo solo los bytes anexados desde la lectura anterior.
+
+    Recuerda el archivo (dispositivo + inode), su tamaño y mtime, el byte
+    hasta donde leyó y un CRC de esos bytes. Si el archivo se reemplazó, se
+    acortó o cambió antes de ese byte (reescritura o compactación) se vuelve
+    a leer desde el principio. El archivo se recorre con mmap: el CRC se
+    calcula sobre el mapa y solo la parte nueva se copia a memoria.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.identidad = None
+        self.tamano = None
+        self.mtime = None
+        self.offset = 0
+        self.crc = 0
+
+    def leer(self, copiar_releido=True):
+        """(bytes nuevos hasta el último salto de línea, si se releyó todo).
+
+        Con `copiar_releido=False`, al releer todo un archivo que termina en
+        salto de línea devuelve None en lugar de copiarlo: quien llama lo
+        lee directamente desde la ruta.
+        """
+        try:
+            info = os.stat(self.ruta)
+        except FileNotFoundError:
+            releido = self.offset > 0
+            self.__init__(self.ruta)
+            return b"", releido
+        identidad = (info.st_dev, info.st_ino)
+        if (identidad, info.st_size, info.st_mtime_ns) == (self.identidad, self.tamano, self.mtime):
+            return b"", False
+
+        with open(self.ruta, "rb") as f:
+            # mmap no admite archivos vacíos
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if info.st_size else b""
+            try:
+                vista = memoryview(mapa)
+                releido = (
+                    identidad != self.identidad
+                    or len(mapa) < self.offset
+                    or zlib.crc32(vista[:self.offset]) != self.crc
+                )
+                inicio = 0 if releido else self.offset
+                # Solo líneas completas: lo demás se lee la próxima vez
+                fin = mapa.rfind(b"\n", inicio) + 1 or inicio
+                if releido and not copiar_releido and 0 < fin == info.st_size:
+                    nuevos = None
+                else:
+                    nuevos = bytes(vista[inicio:fin])
+                self.crc = zlib.crc32(vista[inicio:fin], 0 if releido else self.crc)
+                vista.release()
+            finally:
+                if info.st_size:
+                    mapa.close()
+        self.identidad, self.tamano, self.mtime = identidad, info.st_size, info.st_mtime_ns
+        self.offset = fin
+        return nuevos, releido
+
+
+class TablaIncremental:
+    """Filas de un CSV que, al recargarse, solo parsea las filas anexadas.
+
+    Si el archivo se reemplazó (el backend CSV lo reescribe en cada
+    guardado) se parsea desde la ruta con memory_map, sin copiarlo antes.
+    """
+
+    def __init__(self, ruta, tabla):
+        self.lector = LectorIncremental(ruta)
+        self.tabla = tabla
+        self.lock = threading.Lock()
+        self.encabezado = b""
+        self.filas = []
+
+    @instrumentar("load_csv_incremental", filas=len)
+    def cargar(self):
+        with self.lock:
+            nuevos, releido = self.lector.leer(copiar_releido=False)
+            if releido:
+                self.encabezado, self.filas = b"", []
+            if nuevos is None:
+                df = pd.read_csv(
+                    self.lector.ruta, dtype=ESQUEMA.get(self.tabla), memory_map=True
+                )
+                self.filas = registros_desde_df(df)
+                # El encabezado solo hace falta para parsear filas anexadas después
+                with open(self.lector.ruta, "rb") as f:
+                    self.encabezado = f.readline()
+                nuevos = b""
+            if not self.encabezado and nuevos:
+                encabezado, _, nuevos = nuevos.partition(b"\n")
+                self.encabezado = encabezado + b"\n"
+            if nuevos.strip():
+                df = pd.read_csv(
+                    io.BytesIO(self.encabezado + nuevos), dtype=ESQUEMA.get(self.tabla)
+                )
+                self.filas.extend(registros_desde_df(df))
+            # Copias: quien carga la tabla modifica sus registros
+            return [dict(r) for r in self.filas]
+
+
+@st.cache_resource
+def get_tabla_incremental(ruta, tabla):
+    return TablaIncremental(ruta, tabla)
+
+
+def _requiere_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError(
+            "Los snapshots Parquet necesitan pyarrow: pip install pyarrow"
+        ) from None
+
+
+def load_parquet_list(filename, tabla):
+    """Carga una tabla desde un snapshot Parquet (columnar, ya tipado)."""
+    if not os.path.exists(filename):
+        return []
+    _requiere_pyarrow()
+    df = pd.read_parquet(filename)
+    return registros_desde_df(df.astype(ESQUEMA[tabla]))
+
+
+def save_parquet_list(filename, records, tabla):
+    _requiere_pyarrow()
+    df_tipado(records, tabla).to_parquet(filename, index=False)
+
+
+def fsync_archivo(filename):
+    """Fuerza a disco un archivo ya escrito (solo si FSYNC está activo)."""
+    if not FSYNC:
+        return
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archivo_tabla(nombre, formato=None):
+    """Archivo de snapshot de una tabla según el formato."""
+    formato = formato or FORMATO_SNAPSHOT
+    if formato == "parquet":
+        return os.path.splitext(TABLAS[nombre])[0] + ".parquet"
+    return TABLAS[nombre]
+
+
+def cargar_tabla(nombre, formato=None, archivo=None):
+    formato = formato or FORMATO_SNAPSHOT
+    if formato == "csv" and archivo is None and MULTIPROCESO:
+        # Con varios procesos las tablas se recargan seguido: solo se
+        # parsea lo anexado desde la carga anterior
+        return get_tabla_incremental(archivo_tabla(nombre, formato), nombre).cargar()
+    archivo = archivo or archivo_tabla(nombre, formato)
+    if formato == "parquet":
+        return load_parquet_list(archivo, nombre)
+    return load_csv_list(archivo, nombre)
+
+
+def guardar_tabla(nombre, records, formato=None, archivo=None):
+    formato = formato or FORMATO_SNAPSHOT
+    archivo = archivo or archivo_tabla(nombre, formato)
+    if formato == "parquet":
+        save_parquet_list(archivo, records, nombre)
+    else:
+        save_csv_list(archivo, records, nombre)
+    fsync_archivo(archivo)
+
+
+def convertir_snapshot(origen="csv", destino="parquet"):
+    """Convierte los snapshots de todas las tablas entre formatos."""
+    for nombre in TABLAS:
+        guardar_tabla(nombre, cargar_tabla(nombre, origen), destino)
+
+
+def aplicar_eventos(tablas, eventos):
+    """Aplica una lista de eventos sobre las tablas en memoria."""
+    ofertas_por_id = {o.get("id"): o for o in tablas["offers"]}
+    for ev in eventos:
+        lista = tablas[ev["tabla"]]
+        datos = ev["datos"]
+        if ev["op"] == "insert":
+            registro = dict(datos)
+            lista.append(registro)
+            if ev["tabla"] == "offers":
+                ofertas_por_id[registro.get("id")] = registro
+        elif ev["op"] == "update":
+            registro = ofertas_por_id.get(datos.get("id"))
+            if registro is not None:
+                registro.update(datos)
+        elif ev["op"] == "delete":
+            lista[:] = [
+                r for r in lista
+                if any(r.get(k) != v for k, v in datos.items())
+            ]
+        elif ev["op"] == "upsert":
+            clave = CLAVES_UPSERT[ev["tabla"]]
+            for r in lista:
+                if all(r.get(k) == datos.get(k) for k in clave):
+                    r.update(datos)
+                    break
+            else:
+                lista.append(dict(datos))
+
+
+# ============================================================
+#  BACKENDS DE ALMACENAMIENTO
+# ============================================================
+# Todos los backends exponen la misma interfaz:
+#   cargar()                   -> {"offers": [...], "history": [...], ...}
+#   persistir(eventos, tablas) -> guarda los cambios de un save_all()
+# Los eventos tienen la forma
+#   {"tabla": "offers", "op": "insert", "datos": {...}}
+#   {"tabla": "offers", "op": "update", "datos": {"id": ..., <campos>}}
+#   {"tabla": "buyer_actions", "op": "delete", "datos": {<fila completa>}}
+#   {"tabla": "history", "op": "delete", "datos": {"offer_id": ...}}
+#     (delete borra todas las filas que coinciden en los campos dados)
+#   {"tabla": "lecturas", "op": "upsert", "datos": {<fila completa>}}
+#
+# Con MULTIPROCESO además:
+#   version()                  -> versión global (cuántos eventos se guardaron)
+#   cambios_desde(version)     -> (versión actual, eventos posteriores), o
+#                                 (versión actual, None) si hay que recargar todo
+
+class CandadoArchivo:
+    """Candado exclusivo entre procesos sobre un archivo (flock / msvcrt).
+
+    Es reentrante dentro del proceso; se usa siempre con el lock de los
+    datos compartidos tomado, así que el contador no necesita otro lock.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.profundidad = 0
+        self.archivo = None
+
+    def __enter__(self):
+        if self.profundidad == 0:
+            self.archivo = open(self.ruta, "a+b")
+            if fcntl is not None:
+                fcntl.flock(self.archivo.fileno(), fcntl.LOCK_EX)
+            else:
+                self.archivo.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.archivo.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK se rinde tras ~10 s; se sigue esperando
+                        continue
+        self.profundidad += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.profundidad -= 1
+        if self.profundidad == 0:
+            if fcntl is not None:
+                fcntl.flock(self.archivo.fileno(), fcntl.LOCK_UN)
+            else:
+                self.archivo.seek(0)
+                msvcrt.locking(self.archivo.fileno(), msvcrt.LK_UNLCK, 1)
+            self.archivo.close()
+            self.archivo = None
+
+
+class AlmacenCSV:
+    """Reescribe los snapshots completos en cada guardado (comportamiento original).
+
+    El formato (CSV o Parquet) lo decide FORMATO_SNAPSHOT.
+    """
+
+    # persistir() usa las tablas completas (los demás backends solo los eventos)
+    NECESITA_TABLAS = True
+
+    def cargar(self):
+        return {nombre: cargar_tabla(nombre) for nombre in TABLAS}
+
+    def persistir(self, eventos, tablas):
+        for nombre in TABLAS:
+            guardar_tabla(nombre, tablas[nombre])
+        if MULTIPROCESO and eventos:
+            meta = self._leer_meta()
+            meta["version"] = meta.get("version", 0) + len(eventos)
+            self._escribir_meta(meta)
+
+    def version(self):
+        return self._leer_meta().get("version", 0)
+
+    def cambios_desde(self, version):
+        """Sin registro de eventos: cualquier cambio obliga a recargar todo."""
+        actual = self.version()
+        return actual, ([] if actual == version else None)
+
+    def _leer_meta(self):
+        if not os.path.exists(SNAPSHOT_META_FILE):
+            return {"lineas_journal": 0}
+        with open(SNAPSHOT_META_FILE, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _escribir_meta(self, meta):
+        tmp = SNAPSHOT_META_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        fsync_archivo(tmp)
+        os.replace(tmp, SNAPSHOT_META_FILE)
+
+
+class AlmacenJournal(AlmacenCSV):
+    """Snapshot CSV + journal de eventos solo-anexar.
+
+    Cada save_all() anexa sus eventos a JOURNAL_FILE. Al arrancar se carga el
+    snapshot (los CSV) y se reproduce el journal. Cada COMPACTAR_CADA eventos
+    el journal se vuelca a un snapshot nuevo.
+    """
+
+    NECESITA_TABLAS = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.eventos_desde_compactar = 0
+        # Eventos del journal ya leídos; el lector solo parsea lo anexado
+        self.lock_lectura = threading.Lock()
+        self.lector = LectorIncremental(JOURNAL_FILE)
+        self.lineas = []
+
+    def cargar(self):
+        tablas = super().cargar()
+        aplicar_eventos(tablas, self._leer_journal())
+        return tablas
+
+    def persistir(self, eventos, tablas):
+        """Anexa los eventos al journal con una sola escritura."""
+        if not eventos:
+            return
+        texto = "".join(
+            json.dumps(ev, ensure_ascii=False, default=str) + "\n" for ev in eventos
+        )
+        with self.lock:
+            with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+                f.write(texto)
+                if FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.eventos_desde_compactar += len(eventos)
+            if self.eventos_desde_compactar >= COMPACTAR_CADA:
+                self.compactar()
+                self.eventos_desde_compactar = 0
+
+    def compactar(self):
+        """Vuelca snapshot + journal a CSV nuevos y vacía el journal.
+
+        Se reconstruye desde disco (no desde la sesión) para no perder eventos
+        anexados por otras sesiones.
+        """
+        if not os.path.exists(JOURNAL_FILE):
+            return
+        total_lineas = len(self._lineas_journal())
+
+        meta = self._leer_meta()
+        version = self.version()
+        tablas = self.cargar()
+        # Primero todos los temporales; antes de reemplazar ninguna tabla se
+        # anota en el meta el inode de cada temporal (os.replace lo
+        # conserva). Si el proceso muere entre dos reemplazos, al cargar las
+        # tablas ya reemplazadas se reconocen por su inode y no se les vuelve
+        # a aplicar el journal que ya incluyen.
+        temporales = {}
+        for nombre in TABLAS:
+            tmp = archivo_tabla(nombre) + ".tmp"
+            guardar_tabla(nombre, tablas[nombre], archivo=tmp)
+            temporales[nombre] = tmp
+        self._escribir_meta({
+            **meta,
+            "lineas_nuevas": total_lineas,
+            "tablas_nuevas": {n: os.stat(t).st_ino for n, t in temporales.items()},
+        })
+        for nombre, tmp in temporales.items():
+            os.replace(tmp, archivo_tabla(nombre))
+
+        self._escribir_meta({"lineas_journal": total_lineas, "version": version})
+        open(JOURNAL_FILE, "w", encoding="utf-8").close()
+        self._escribir_meta({"lineas_journal": 0, "version": version})
+
+    def _lineas_journal(self):
+        """Eventos del journal; solo se parsean las líneas nuevas."""
+        with self.lock_lectura:
+            nuevos, releido = self.lector.leer()
+            if releido:
+                # Se vació o reemplazó (compactación): se leyó desde el principio
+                self.lineas = []
+            self.lineas.extend(
+                json.loads(l) for l in nuevos.decode("utf-8").splitlines() if l.strip()
+            )
+            return list(self.lineas)
+
+    def _estado_journal(self):
+        """(meta, eventos del journal, cuántos ya están en el snapshot)."""
+        meta = self._leer_meta()
+        lineas = self._lineas_journal()
+
+        # Si la compactación se interrumpió después de escribir el snapshot
+        # pero antes de vaciar el journal, esas primeras líneas ya están
+        # incluidas en el snapshot y no deben aplicarse otra vez.
+        ya_aplicadas = meta.get("lineas_journal", 0)
+        if ya_aplicadas > len(lineas):
+            ya_aplicadas = 0
+        return meta, lineas, ya_aplicadas
+
+    def _leer_journal(self):
+        """Devuelve los eventos del journal que aún no están en el snapshot."""
+        meta, lineas, ya_aplicadas = self._estado_journal()
+        # Tablas ya reemplazadas por una compactación interrumpida
+        por_tabla = {}
+        for nombre, inodo in meta.get("tablas_nuevas", {}).items():
+            try:
+                if os.stat(archivo_tabla(nombre)).st_ino == inodo:
+                    por_tabla[nombre] = meta["lineas_nuevas"]
+            except FileNotFoundError:
+                pass
+        if not por_tabla:
+            return lineas[ya_aplicadas:]
+        return [
+            ev for i, ev in enumerate(lineas)
+            if i >= por_tabla.get(ev["tabla"], ya_aplicadas)
+        ]
+
+    def version(self):
+        # La versión del snapshot más las líneas anexadas después
+        meta, lineas, ya_aplicadas = self._estado_journal()
+        return meta.get("version", 0) + len(lineas) - ya_aplicadas
+
+    def cambios_desde(self, version):
+        meta, lineas, ya_aplicadas = self._estado_journal()
+        base = meta.get("version", 0)
+        actual = base + len(lineas) - ya_aplicadas
+        if version < base or version > actual:
+            # Lo que faltaba ya se compactó en el snapshot
+            return actual, None
+        inicio = ya_aplicadas + version - base
+        return actual, lineas[inicio:]
+
+
+class AlmacenSQLite:
+    """Base SQLite en modo WAL con índices para las consultas de las vistas.
+
+    Cada evento se traduce en un INSERT o UPDATE de una sola fila. La primera
+    vez que se abre la base se importan los CSV (y el journal, si existe)
+    para no perder los datos existentes.
+    """
+
+    NECESITA_TABLAS = False
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS offers (
+            id TEXT PRIMARY KEY,
+            tipo TEXT, producer TEXT, buyer TEXT, parent_offer_id TEXT,
+            toneladas REAL, recoleccion TEXT, canastillas TEXT, precio REAL,
+            calibre TEXT, madurez TEXT, origen TEXT, notas TEXT,
+            status TEXT, producer_hidden INTEGER,
+            created_at TEXT, updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            offer_id TEXT, actor TEXT, accion TEXT, detalle TEXT, fecha TEXT
+        );
+        CREATE TABLE IF NOT EXISTS notifications (
+            usuario_destino TEXT, rol_destino TEXT, mensaje TEXT, fecha TEXT,
+            ts REAL
+        );
+        CREATE TABLE IF NOT EXISTS buyer_actions (
+            buyer TEXT, offer_id TEXT, PRIMARY KEY (buyer, offer_id)
+        );
+        CREATE TABLE IF NOT EXISTS lecturas (
+            usuario TEXT, canal TEXT, leido_hasta REAL,
+            PRIMARY KEY (usuario, canal)
+        );
+        CREATE TABLE IF NOT EXISTS posturas (
+            id TEXT PRIMARY KEY, buyer TEXT, precio_max REAL,
+            toneladas_min REAL, toneladas_max REAL, calibres TEXT, madurez TEXT,
+            origenes TEXT, activa INTEGER, created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+        -- Registro de eventos para la recarga incremental (MULTIPROCESO)
+        CREATE TABLE IF NOT EXISTS cambios (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, evento TEXT
+        );
+
+        -- offers(id) ya está indexado por ser PRIMARY KEY
+        CREATE INDEX IF NOT EXISTS idx_offers_producer_tipo_status
+            ON offers(producer, tipo, status);
+        CREATE INDEX IF NOT EXISTS idx_offers_buyer ON offers(buyer);
+        CREATE INDEX IF NOT EXISTS idx_offers_parent ON offers(parent_offer_id);
+        CREATE INDEX IF NOT EXISTS idx_history_offer ON history(offer_id);
+        CREATE INDEX IF NOT EXISTS idx_notifications_usuario
+            ON notifications(usuario_destino);
+    """
+
+    # Índices sobre columnas agregadas después de la primera versión; se
+    # crean tras _migrar_columnas() para que existan en bases antiguas
+    INDICES_EXTRA = """
+        CREATE INDEX IF NOT EXISTS idx_notifications_rol
+            ON notifications(rol_destino);
+        CREATE INDEX IF NOT EXISTS idx_notifications_usuario_ts
+            ON notifications(usuario_destino, ts);
+        CREATE INDEX IF NOT EXISTS idx_notifications_rol_ts
+            ON notifications(rol_destino, ts);
+    """
+
+    def __init__(self, ruta=SQLITE_FILE):
+        # Streamlit ejecuta cada sesión en su propio hilo: una sola conexión
+        # compartida, protegida por un lock.
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(ruta, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(f"PRAGMA synchronous={'FULL' if FSYNC else 'NORMAL'}")
+        self.con.executescript(self.ESQUEMA)
+        self._migrar_columnas()
+        self.con.executescript(self.INDICES_EXTRA)
+        self._importar_csv_si_hace_falta()
+
+    def _migrar_columnas(self):
+        """Agrega a bases existentes las columnas nuevas de COLUMNAS."""
+        for tabla, columnas in COLUMNAS.items():
+            existentes = {
+                fila["name"] for fila in self.con.execute(f"PRAGMA table_info({tabla})")
+            }
+            for col in columnas:
+                if col not in existentes:
+                    self.con.execute(f"ALTER TABLE {tabla} ADD COLUMN {col}")
+
+    def _importar_csv_si_hace_falta(self):
+        fila = self.con.execute(
+            "SELECT valor FROM meta WHERE clave = 'importado_csv'"
+        ).fetchone()
+        if fila is not None:
+            return
+        tablas = AlmacenJournal().cargar()
+        with self.con:
+            for nombre, registros in tablas.items():
+                for r in registros:
+                    self._insertar(nombre, r)
+            self.con.execute(
+                "INSERT INTO meta (clave, valor) VALUES ('importado_csv', ?)",
+                (ahora(),),
+            )
+
+    def _insertar(self, tabla, datos):
+        cols = [c for c in COLUMNAS[tabla] if c in datos]
+        sql = (
+            f"INSERT OR REPLACE INTO {tabla} ({', '.join(cols)}) "
+            f"VALUES ({', '.join('?' for _ in cols)})"
+        )
+        self.con.execute(sql, [datos[c] for c in cols])
+
+    def _actualizar_oferta(self, datos):
+        cols = [c for c in COLUMNAS["offers"] if c in datos and c != "id"]
+        if not cols:
+            return
+        sql = f"UPDATE offers SET {', '.join(c + ' = ?' for c in cols)} WHERE id = ?"
+        self.con.execute(sql, [datos[c] for c in cols] + [datos["id"]])
+
+    def _borrar(self, tabla, datos):
+        cols = [c for c in COLUMNAS[tabla] if c in datos]
+        # "IS" compara bien también los NULL
+        sql = f"DELETE FROM {tabla} WHERE {' AND '.join(c + ' IS ?' for c in cols)}"
+        self.con.execute(sql, [datos[c] for c in cols])
+
+    def cargar(self):
+        tablas = {}
+        with self.lock:
+            for nombre in TABLAS:
+                filas = self.con.execute(f"SELECT * FROM {nombre} ORDER BY rowid")
+                tablas[nombre] = [dict(f) for f in filas]
+        return tablas
+
+    def persistir(self, eventos, tablas):
+        """Aplica los eventos como INSERT/UPDATE de una fila, en una transacción."""
+        if not eventos:
+            return
+        with self.lock, self.con:
+            for ev in eventos:
+                if ev["op"] == "insert":
+                    self._insertar(ev["tabla"], ev["datos"])
+                elif ev["op"] == "update":
+                    self._actualizar_oferta(ev["datos"])
+                elif ev["op"] == "delete":
+                    self._borrar(ev["tabla"], ev["datos"])
+                elif ev["op"] == "upsert":
+                    # La PRIMARY KEY hace que INSERT OR REPLACE sea un upsert
+                    self._insertar(ev["tabla"], ev["datos"])
+            if MULTIPROCESO:
+                self.con.executemany(
+                    "INSERT INTO cambios (evento) VALUES (?)",
+                    [(json.dumps(ev, ensure_ascii=False, default=str),) for ev in eventos],
+                )
+                self.con.execute(
+                    "DELETE FROM cambios WHERE seq <= ?",
+                    (self._version() - RETENER_CAMBIOS,),
+                )
+
+    def _version(self):
+        fila = self.con.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'cambios'"
+        ).fetchone()
+        return fila[0] if fila else 0
+
+    def version(self):
+        with self.lock:
+            return self._version()
+
+    def cambios_desde(self, version):
+        with self.lock:
+            actual = self._version()
+            if actual == version:
+                return actual, []
+            primera = self.con.execute("SELECT MIN(seq) FROM cambios").fetchone()[0]
+            if primera is None or primera > version + 1:
+                # Los eventos intermedios ya se descartaron
+                return actual, None
+            filas = self.con.execute(
+                "SELECT evento FROM cambios WHERE seq > ? ORDER BY seq", (version,)
+            )
+            return actual, [json.loads(f[0]) for f in filas]
+
+
+ALMACENES = {
+    "csv": AlmacenCSV,
+    "journal": AlmacenJournal,
+    "sqlite": AlmacenSQLite,
+}
+
+
+@st.cache_resource
+def get_almacen():
+    """Backend de persistencia del proceso, según MODO_PERSISTENCIA."""
+    return ALMACENES[MODO_PERSISTENCIA]()
+
+
+@st.cache_resource
+def get_candado():
+    """Candado entre procesos (solo se toma con MULTIPROCESO)."""
+    return CandadoArchivo(CANDADO_FILE)
+
+
+# ============================================================
+#  DATOS COMPARTIDOS ENTRE SESIONES
+# ============================================================
+
+def valor_numerico(valor):
+    """float del valor, o None si falta o no es un número."""
+    try:
+        numero = float(valor)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(numero) else numero
+
+
+def oferta_disponible(oferta):
+    """Oferta que aún puede verse en el Inicio de los compradores."""
+    return oferta.get("tipo") == "offer" and oferta.get("status") not in ["closed", "accepted"]
+
+
+class RepositorioOfertas:
+    """Ofertas y contraofertas con índices hash en memoria.
+
+    Los índices se mantienen de forma incremental en agregar() y actualizar(),
+    así cada consulta de las vistas cuesta lo que mide su resultado.
+
+    Para los filtros del Inicio del comprador hay además, solo sobre las
+    ofertas disponibles, índices invertidos (valor -> ids) de los campos
+    categóricos y listas ordenadas (valor, id) de los numéricos.
+    """
+
+    # nombre del índice -> campos que forman la clave
+    INDICES = {
+        "producer": ("producer", "tipo"),
+        "producer_status": ("producer", "tipo", "status"),
+        "buyer": ("buyer", "tipo"),
+        "parent": ("parent_offer_id",),
+        "tipo_status": ("tipo", "status"),
+    }
+    FACETAS = ("calibre", "madurez", "origen", "producer")
+    RANGOS = ("precio", "toneladas")
+
+    def __init__(self, registros=()):
+        self.por_id = {}
+        # clave -> {id: oferta} (un dict conserva el orden de inserción)
+        self.indices = {nombre: {} for nombre in self.INDICES}
+        # Solo ofertas disponibles: id -> oferta, campo -> valor -> {ids}
+        # y campo -> [(valor, id)] ordenada
+        self.disponibles = {}
+        self.facetas = {campo: {} for campo in self.FACETAS}
+        self.rangos = {campo: [] for campo in self.RANGOS}
+        for r in registros:
+            self.agregar(r)
+
+    def __iter__(self):
+        return iter(self.por_id.values())
+
+    def __len__(self):
+        return len(self.por_id)
+
+    def _clave(self, nombre, oferta):
+        return tuple(oferta.get(campo) for campo in self.INDICES[nombre])
+
+    def _indexar(self, oferta):
+        for nombre, indice in self.indices.items():
+            indice.setdefault(self._clave(nombre, oferta), {})[oferta["id"]] = oferta
+        if not oferta_disponible(oferta):
+            return
+        self.disponibles[oferta["id"]] = oferta
+        for campo, indice in self.facetas.items():
+            indice.setdefault(oferta.get(campo), set()).add(oferta["id"])
+        for campo, lista in self.rangos.items():
+            valor = valor_numerico(oferta.get(campo))
+            if valor is not None:
+                bisect.insort(lista, (valor, oferta["id"]))
+
+    def _desindexar(self, oferta):
+        for nombre, indice in self.indices.items():
+            clave = self._clave(nombre, oferta)
+            grupo = indice.get(clave)
+            if grupo is not None:
+                grupo.pop(oferta["id"], None)
+                if not grupo:
+                    del indice[clave]
+        if self.disponibles.pop(oferta["id"], None) is None:
+            return
+        for campo, indice in self.facetas.items():
+            grupo = indice.get(oferta.get(campo))
+            if grupo is not None:
+                grupo.discard(oferta["id"])
+                if not grupo:
+                    del indice[oferta.get(campo)]
+        for campo, lista in self.rangos.items():
+            par = (valor_numerico(oferta.get(campo)), oferta["id"])
+            if par[0] is not None:
+                i = bisect.bisect_left(lista, par)
+                if i < len(lista) and lista[i] == par:
+                    del lista[i]
+
+    def agregar(self, oferta):
+        self.por_id[oferta["id"]] = oferta
+        self._indexar(oferta)
+
+    def actualizar(self, oferta, cambios):
+        self._desindexar(oferta)
+        oferta.update(cambios)
+        self._indexar(oferta)
+
+    def quitar(self, oferta):
+        self._desindexar(oferta)
+        self.por_id.pop(oferta["id"], None)
+
+    def get(self, offer_id):
+        return self.por_id.get(offer_id)
+
+    def buscar(self, indice, *clave):
+        """Ofertas cuya clave en `indice` es exactamente `clave`."""
+        return list(self.indices[indice].get(clave, {}).values())
+
+    def claves(self, indice):
+        return list(self.indices[indice])
+
+    def valores_faceta(self, campo):
+        """{valor: nº de ofertas disponibles} de un campo categórico."""
+        return {valor: len(ids) for valor, ids in self.facetas[campo].items()}
+
+    def extremos_rango(self, campo):
+        """(mínimo, máximo) de un campo numérico entre las disponibles."""
+        lista = self.rangos[campo]
+        return (lista[0][0], lista[-1][0]) if lista else (None, None)
+
+    def filtrar_disponibles(self, facetas=None, rangos=None):
+        """Ofertas disponibles que cumplen todos los filtros.
+
+        `facetas`: campo -> valores aceptados; `rangos`: campo -> (mín, máx),
+        con None como límite abierto. Solo se recorre el filtro más selectivo
+        (cuántos ids aporta cada uno se sabe sin recorrerlos); los demás se
+        comprueban sobre esos candidatos.
+        """
+        facetas = {c: set(v) for c, v in (facetas or {}).items() if v}
+        rangos = {
+            c: (minimo, maximo) for c, (minimo, maximo) in (rangos or {}).items()
+            if minimo is not None or maximo is not None
+        }
+        if not facetas and not rangos:
+            return list(self.disponibles.values())
+
+        candidatos = []
+        for campo, valores in facetas.items():
+            grupos = [self.facetas[campo].get(v, ()) for v in valores]
+            candidatos.append((sum(map(len, grupos)), grupos))
+        for campo, (minimo, maximo) in rangos.items():
+            lista = self.rangos[campo]
+            desde = 0 if minimo is None else bisect.bisect_left(lista, minimo, key=lambda p: p[0])
+            hasta = (
+                len(lista) if maximo is None
+                else bisect.bisect_right(lista, maximo, key=lambda p: p[0])
+            )
+            candidatos.append((max(0, hasta - desde), [[i for _, i in lista[desde:hasta]]]))
+        _, grupos = min(candidatos, key=lambda c: c[0])
+
+        def cumple(oferta):
+            for campo, valores in facetas.items():
+                if oferta.get(campo) not in valores:
+                    return False
+            for campo, (minimo, maximo) in rangos.items():
+                valor = valor_numerico(oferta.get(campo))
+                if valor is None:
+                    return False
+                if (minimo is not None and valor < minimo) or (maximo is not None and valor > maximo):
+                    return False
+            return True
+
+        return [
+            self.disponibles[i] for grupo in grupos for i in grupo
+            if cumple(self.disponibles[i])
+        ]
+
+    def registros(self):
+        return list(self.por_id.values())
+
+
+def valores_postura(texto):
+    """Conjunto de valores aceptados de un campo de postura (vacío = cualquiera)."""
+    if not isinstance(texto, str):
+        return frozenset()
+    return frozenset(v.strip() for v in texto.split(",") if v.strip())
+
+
+def condiciones_postura(postura):
+    """(toneladas mín, máx, madurez, orígenes) ya interpretados de una postura."""
+    return (
+        valor_numerico(postura.get("toneladas_min")),
+        valor_numerico(postura.get("toneladas_max")),
+        valores_postura(postura.get("madurez")),
+        valores_postura(postura.get("origenes")),
+    )
+
+
+def postura_acepta(postura, oferta, condiciones=None):
+    """La oferta cumple todas las condiciones de la postura."""
+    precio = valor_numerico(oferta.get("precio"))
+    precio_max = valor_numerico(postura.get("precio_max"))
+    if precio is None or precio_max is None or precio > precio_max:
+        return False
+    calibres = valores_postura(postura.get("calibres"))
+    if calibres and oferta.get("calibre") not in calibres:
+        return False
+    minimo, maximo, madurez, origenes = condiciones or condiciones_postura(postura)
+    if minimo is not None or maximo is not None:
+        toneladas = valor_numerico(oferta.get("toneladas"))
+        if toneladas is None:
+            return False
+        if (minimo is not None and toneladas < minimo) or (maximo is not None and toneladas > maximo):
+            return False
+    if madurez and oferta.get("madurez") not in madurez:
+        return False
+    return not origenes or oferta.get("origen") in origenes
+
+
+class LibroPosturas:
+    """Posturas de compra con un libro ordenado por precio por cada calibre.
+
+    libros[calibre] es una lista ordenada de (-precio_max, orden, id): las
+    posturas que pagan más van primero, así las que aceptan una oferta de
+    precio p son un prefijo de la lista (bisect) y no hace falta comparar la
+    oferta con todas. Las posturas sin calibre van en el libro "*".
+    """
+
+    def __init__(self, registros):
+        self.por_id = {}
+        self.libros = {}
+        self.entradas = {}       # id -> (entrada, calibres) de las activas
+        self.condiciones = {}    # id -> condiciones_postura ya calculadas
+        self.contador = itertools.count()
+        for p in registros:
+            self.guardar(p)
+
+    def guardar(self, postura):
+        """Agrega o reemplaza una postura (y la saca del libro si ya no está activa)."""
+        anterior = self.entradas.pop(postura["id"], None)
+        if anterior is not None:
+            entrada, calibres = anterior
+            for calibre in calibres:
+                libro = self.libros[calibre]
+                del libro[bisect.bisect_left(libro, entrada)]
+        self.por_id[postura["id"]] = postura
+        precio_max = valor_numerico(postura.get("precio_max"))
+        if not postura.get("activa") or precio_max is None:
+            self.condiciones.pop(postura["id"], None)
+            return
+        entrada = (-precio_max, next(self.contador), postura["id"])
+        calibres = valores_postura(postura.get("calibres")) or {"*"}
+        for calibre in calibres:
+            bisect.insort(self.libros.setdefault(calibre, []), entrada)
+        self.entradas[postura["id"]] = (entrada, calibres)
+        self.condiciones[postura["id"]] = condiciones_postura(postura)
+
+    def get(self, postura_id):
+        return self.por_id.get(postura_id)
+
+    def registros(self):
+        return list(self.por_id.values())
+
+    def activas(self):
+        return len(self.entradas)
+
+    def compatibles(self, oferta, limite, descartar=None):
+        """Hasta `limite` posturas que aceptan la oferta, de la que más paga a
+        la que menos, con una sola por comprador y sin los compradores para
+        los que `descartar(comprador)` es verdadero."""
+        precio = valor_numerico(oferta.get("precio"))
+        if precio is None:
+            return []
+        # Prefijo de cada libro con precio_max >= precio, recorrido en orden
+        corte = (-precio, math.inf)
+        prefijos = [
+            itertools.islice(libro, bisect.bisect_right(libro, corte))
+            for libro in (self.libros.get(oferta.get("calibre")), self.libros.get("*"))
+            if libro
+        ]
+        encontradas = []
+        compradores = set()
+        for _, _, postura_id in heapq.merge(*prefijos):
+            postura = self.por_id[postura_id]
+            if postura["buyer"] in compradores:
+                continue
+            if descartar is not None and descartar(postura["buyer"]):
+                compradores.add(postura["buyer"])
+                continue
+            if postura_acepta(postura, oferta, self.condiciones[postura_id]):
+                encontradas.append(postura)
+                compradores.add(postura["buyer"])
+                if len(encontradas) >= limite:
+                    break
+        return encontradas
+
+
+class FeedCambios:
+    """Cambios recientes por canal, con un número de secuencia monótono.
+
+    Los canales son los mismos de las notificaciones: "user:<nombre>" y
+    "role:<rol>". Cada canal guarda sus últimos FEED_MAX_EVENTOS cambios
+    (seq, tipo, id, origen); una sesión pide solo los posteriores a la última
+    secuencia que vio. `origen` es la sesión que hizo el cambio (None si vino
+    de otro proceso): así cada sesión ignora sus propias acciones.
+    """
+
+    def __init__(self, maximo=FEED_MAX_EVENTOS):
+        self.maximo = maximo
+        self.secuencia = 0
+        self.colas = {}
+        # canal -> secuencia del último cambio descartado por falta de espacio
+        self.descartados = {}
+        # Secuencia de la última recarga completa de los datos
+        self.recarga = 0
+
+    def publicar(self, canales, tipo, ident, origen=None):
+        self.secuencia += 1
+        cambio = (self.secuencia, tipo, ident, origen)
+        for canal in canales:
+            cola = self.colas.setdefault(canal, collections.deque(maxlen=self.maximo))
+            if len(cola) == self.maximo:
+                self.descartados[canal] = cola[0][0]
+            cola.append(cambio)
+        return self.secuencia
+
+    def recargar(self):
+        """Los datos se recargaron completos: todas las sesiones deben releer."""
+        self.secuencia += 1
+        self.recarga = self.secuencia
+
+    def desde(self, canales, secuencia, excluir_origen=None):
+        """(secuencia actual, cambios de `canales` posteriores a `secuencia`).
+
+        Se omiten los cambios hechos por la sesión `excluir_origen`. Los
+        cambios son None si alguno ya se descartó: la sesión debe recargar
+        todo.
+        """
+        actual = self.secuencia
+        if actual == secuencia:
+            return actual, []
+        if self.recarga > secuencia:
+            return actual, None
+        cambios = []
+        for canal in canales:
+            if self.descartados.get(canal, 0) > secuencia:
+                return actual, None
+            # Se recorre desde el final: cuesta lo que mide la diferencia
+            for cambio in reversed(self.colas.get(canal, ())):
+                if cambio[0] <= secuencia:
+                    break
+                if excluir_origen is None or cambio[3] != excluir_origen:
+                    cambios.append(cambio)
+        cambios.sort()
+        return actual, cambios
+
+
+def canales_oferta(oferta):
+    """Canales que ven un cambio en una oferta o contraoferta."""
+    canales = {f"user:{oferta['producer']}"}
+    if oferta.get("buyer"):
+        canales.add(f"user:{oferta['buyer']}")
+    if oferta.get("tipo") == "offer":
+        # Aparece, cambia o sale del Inicio de todos los compradores
+        canales.add("role:buyer")
+    return canales
+
+
+class DatosCompartidos:
+    """Ofertas, historial y notificaciones del proceso servidor.
+
+    Hay una sola instancia por proceso (ver get_datos) y todas las sesiones
+    leen y escriben sobre ella con el lock tomado. `version` aumenta con cada
+    cambio, así una sesión solo recalcula sus consultas cuando hubo cambios.
+    """
+
+    def __init__(self, almacen):
+        self.lock = threading.RLock()
+        self.almacen = almacen
+        self.version_mes = {}
+        # Recargas completas de las tablas (indexar): invalida todos los meses
+        self.generacion = -1
+        self.ultima_purga = 0.0
+        self.ultimo_archivado = 0.0
+        # Eventos aún no persistidos (se vacía en save_all)
+        self.eventos_pendientes = []
+        # Lotes de acciones en curso: mientras haya alguno, save_all() espera
+        self.lotes_abiertos = 0
+        # Estado previo de lo que toca el lote en curso (ver deshacer_lote)
+        self.previos_lote = None
+        self.cambios = FeedCambios()
+        self.version = 0
+        # Versión global del almacén que ya refleja la memoria (MULTIPROCESO)
+        self.version_almacen = almacen.version() if MULTIPROCESO else 0
+        self.indexar(almacen.cargar())
+
+    def indexar(self, tablas):
+        """Arma las tablas en memoria y sus índices a partir de `tablas`."""
+        self.offers = RepositorioOfertas(tablas["offers"])
+        # Mes de creación -> ids de las ofertas originales, y versión de cada
+        # mes: la analítica solo recalcula los meses cuya versión cambió. La
+        # generación cubre también los meses que nunca se tocaron en memoria
+        self.negociaciones_por_mes = {}
+        self.generacion += 1
+        for o in self.offers:
+            if o.get("tipo") == "offer":
+                self.negociaciones_por_mes.setdefault(mes_de(o), set()).add(o["id"])
+        self.history = tablas["history"]
+        self.notifications = tablas["notifications"]
+        # Bandejas ordenadas por ts: usuario -> directas; rol -> difusiones
+        self.notificaciones_por_usuario = {}
+        self.notificaciones_por_rol = {}
+        # id() de las notificaciones cuyo ts solo existe en memoria
+        self.ts_derivados = set()
+        for n in self.notifications:
+            if n.get("ts") is None or pd.isna(n["ts"]):
+                # Filas anteriores a la columna ts: se deriva de la fecha
+                n["ts"] = fecha_ordenable(n.get("fecha"))
+                self.ts_derivados.add(id(n))
+            self.indexar_notificacion(n)
+        for bandejas in (self.notificaciones_por_usuario, self.notificaciones_por_rol):
+            for lista in bandejas.values():
+                lista.sort(key=ts_notificacion)
+        # (usuario, canal) -> ts de la última notificación del canal ya vista
+        self.lecturas = {
+            (l["usuario"], l["canal"]): float(l.get("leido_hasta") or 0)
+            for l in tablas["lecturas"]
+        }
+        # offer_id -> registros de historial de esa oferta (en orden)
+        self.historial_por_oferta = {}
+        for h in self.history:
+            self.historial_por_oferta.setdefault(h["offer_id"], []).append(h)
+        # comprador -> set de offer_id ya procesados (ocultos en su Inicio)
+        self.buyer_actions = {}
+        for a in tablas["buyer_actions"]:
+            self.buyer_actions.setdefault(a["buyer"], set()).add(a["offer_id"])
+        self.posturas = LibroPosturas(tablas["posturas"])
+
+    def indexar_notificacion(self, n):
+        """Agrega la notificación a su canal (se asume que es la más reciente)."""
+        if n.get("rol_destino"):
+            self.notificaciones_por_rol.setdefault(n["rol_destino"], []).append(n)
+        else:
+            self.notificaciones_por_usuario.setdefault(n["usuario_destino"], []).append(n)
+
+    def tablas(self):
+        return {
+            "offers": self.offers.registros(),
+            "history": self.history,
+            "notifications": self.notifications,
+            "buyer_actions": [
+                {"buyer": buyer, "offer_id": offer_id}
+                for buyer, procesadas in self.buyer_actions.items()
+                for offer_id in procesadas
+            ],
+            "lecturas": [
+                {"usuario": usuario, "canal": canal, "leido_hasta": leido_hasta}
+                for (usuario, canal), leido_hasta in self.lecturas.items()
+            ],
+            "posturas": self.posturas.registros(),
+        }
+
+
+@st.cache_resource
+def get_datos():
+    """Almacén en memoria compartido por todas las sesiones del proceso."""
+    if MULTIPROCESO:
+        # Que otro proceso no escriba a mitad de la carga
+        with get_candado():
+            return DatosCompartidos(get_almacen())
+    return DatosCompartidos(get_almacen())
+
+
+def transaccion(funcion):
+    """Ejecuta la acción con el lock de los datos compartidos tomado."""
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        with acceso_exclusivo():
+            return funcion(*args, **kwargs)
+    return envoltura
+
+
+@contextlib.contextmanager
+def lote_acciones():
+    """Agrupa varias acciones en una sola transacción y una sola escritura.
+
+    Dentro del bloque el lock queda tomado y save_all() no escribe; al salir
+    se guardan todos los cambios del lote juntos. Si una acción lanza una
+    excepción se deshace el lote completo y no se guarda nada de él.
+    """
+    datos = get_datos()
+    with acceso_exclusivo():
+        externo = not datos.lotes_abiertos
+        if externo:
+            datos.previos_lote = {
+                "eventos": len(datos.eventos_pendientes),
+                "history": len(datos.history),
+                "notifications": len(datos.notifications),
+                "offers": {},
+                "buyer_actions": {},
+            }
+        datos.lotes_abiertos += 1
+        try:
+            yield
+        except BaseException:
+            if externo:
+                deshacer_lote(datos)
+            raise
+        finally:
+            datos.lotes_abiertos -= 1
+            if externo:
+                datos.previos_lote = None
+                save_all()
+
+
+def guardar_previo(tabla, clave, registro):
+    """Dentro de un lote, copia `registro` antes de su primer cambio (None: es nuevo)."""
+    previos = get_datos().previos_lote
+    if previos is not None and clave not in previos[tabla]:
+        previos[tabla][clave] = None if registro is None else registro.copy()
+
+
+def deshacer_lote(datos):
+    """Devuelve la memoria al estado del inicio del lote.
+
+    Solo se restaura lo que tocaron las acciones: las ofertas y conjuntos de
+    buyer_actions guardados con guardar_previo, y las filas de historial y
+    notificaciones agregadas al final de sus listas. Los eventos del lote se
+    descartan antes de que save_all() los vea.
+    """
+    previos = datos.previos_lote
+    del datos.eventos_pendientes[previos["eventos"]:]
+    for registro in reversed(datos.history[previos["history"]:]):
+        lista = datos.historial_por_oferta.get(registro["offer_id"])
+        if lista and lista[-1] is registro:
+            lista.pop()
+    del datos.history[previos["history"]:]
+    for n in reversed(datos.notifications[previos["notifications"]:]):
+        if n.get("rol_destino"):
+            lista = datos.notificaciones_por_rol.get(n["rol_destino"])
+        else:
+            lista = datos.notificaciones_por_usuario.get(n["usuario_destino"])
+        if lista and lista[-1] is n:
+            lista.pop()
+    del datos.notifications[previos["notifications"]:]
+    for offer_id, previo in previos["offers"].items():
+        actual = datos.offers.get(offer_id)
+        if actual is not None:
+            datos.offers.quitar(actual)
+        if previo is None:
+            if actual is not None and actual.get("tipo") == "offer":
+                datos.negociaciones_por_mes.get(mes_de(actual), set()).discard(offer_id)
+            continue
+        if actual is None:
+            actual = previo
+        else:
+            actual.clear()
+            actual.update(previo)
+        datos.offers.agregar(actual)
+    for buyer, previo in previos["buyer_actions"].items():
+        datos.buyer_actions[buyer] = previo
+    datos.version += 1
+
+
+def olvidar_consultas(nombre):
+    """Descarta de la sesión las consultas cacheadas cuya clave empieza por `nombre`."""
+    cache = st.session_state.get("consultas", {})
+    for clave in [c for c in cache if c[0] == nombre]:
+        del cache[clave]
+
+
+def consulta_sesion(clave, calcular):
+    """Devuelve el resultado de una consulta de la sesión.
+
+    Solo se vuelve a calcular si la versión de los datos cambió desde la
+    última vez que esta sesión la pidió.
+    """
+    datos = get_datos()
+    cache = st.session_state.setdefault("consultas", {})
+    guardado = cache.get(clave)
+    if guardado is None or guardado[0] != datos.version:
+        with datos.lock:
+            guardado = (datos.version, calcular())
+        cache[clave] = guardado
+    return guardado[1]
+
+
+@instrumentar("save_all", filas=lambda n: n)
 def save_all():
-    """Guarda offers, history y notifications en CSV."""
-    save_csv_list("offers.csv", st.session_state.offers)
-    save_csv_list("history.csv", st.session_state.history)
-    save_csv_list("notifications.csv", st.session_state.notifications)
+    """Persiste los cambios pendientes (offers, history y notifications).
+
+    Con ESCRITURA_DIFERIDA solo los pasa a la cola de escritura, que los
+    guarda en segundo plano. Devuelve el número de eventos.
+    """
+    datos = get_datos()
+    with acceso_exclusivo():
+        if datos.lotes_abiertos:
+            # Lo guarda lote_acciones() al terminar el lote
+            return 0
+        eventos = datos.eventos_pendientes
+        datos.eventos_pendientes = []
+        # Con varios procesos se escribe antes de soltar el candado
+        if ESCRITURA_DIFERIDA and not MULTIPROCESO:
+            get_cola_escritura().encolar(eventos)
+        else:
+            get_almacen().persistir(eventos, datos.tablas())
+            if MULTIPROCESO:
+                datos.version_almacen = get_almacen().version()
+    return len(eventos)
+
+
+# ============================================================
+#  SINCRONIZACIÓN ENTRE PROCESOS
+# ============================================================
+# Con MULTIPROCESO cada proceso servidor tiene su propia copia en memoria.
+# Toda acción se ejecuta con el candado de archivo tomado y, al tomarlo, el
+# proceso aplica los eventos que los demás guardaron desde su versión; así
+# ninguna acción trabaja sobre datos viejos ni pisa lo que escribió otro.
+
+@contextlib.contextmanager
+def acceso_exclusivo():
+    """Lock de los datos y, con MULTIPROCESO, el candado entre procesos."""
+    datos = get_datos()
+    with datos.lock:
+        if not MULTIPROCESO:
+            yield
+            return
+        candado = get_candado()
+        primera = candado.profundidad == 0
+        with candado:
+            if primera:
+                sincronizar(datos)
+            yield
+
+
+def sincronizar(datos):
+    """Pone la memoria al día con la versión global del almacén."""
+    version, eventos = datos.almacen.cambios_desde(datos.version_almacen)
+    if eventos is None or not aplicar_eventos_externos(datos, eventos):
+        datos.indexar(datos.almacen.cargar())
+        datos.version += 1
+        datos.cambios.recargar()
+    datos.version_almacen = version
+
+
+def sincronizar_si_hace_falta():
+    """Aplica los cambios de otros procesos si la versión global avanzó."""
+    if not MULTIPROCESO:
+        return
+    datos = get_datos()
+    if datos.almacen.version() != datos.version_almacen:
+        # acceso_exclusivo() sincroniza al tomar el candado
+        with acceso_exclusivo():
+            pass
+
+
+def aplicar_eventos_externos(datos, eventos):
+    """Aplica en memoria eventos guardados por otros procesos.
+
+    Mantiene los índices y publica en el feed de cambios, como las acciones
+    locales. Devuelve False si hay borrados de ofertas, historial o
+    notificaciones (archivado y purga): en ese caso conviene recargar todo.
+    """
+    if any(ev["op"] == "delete" and ev["tabla"] != "buyer_actions" for ev in eventos):
+        return False
+    for ev in eventos:
+        tabla, op, registro = ev["tabla"], ev["op"], dict(ev["datos"])
+        if tabla == "offers" and op == "insert":
+            datos.offers.agregar(registro)
+            tocar_negociacion(registro)
+            datos.cambios.publicar(canales_oferta(registro), "oferta", registro["id"])
+        elif tabla == "offers":
+            oferta = datos.offers.get(registro.pop("id"))
+            if oferta is None:
+                continue
+            canales = canales_oferta(oferta)
+            datos.offers.actualizar(oferta, registro)
+            tocar_negociacion(oferta)
+            datos.cambios.publicar(canales | canales_oferta(oferta), "oferta", oferta["id"])
+        elif tabla == "history":
+            datos.history.append(registro)
+            datos.historial_por_oferta.setdefault(registro["offer_id"], []).append(registro)
+            oferta = datos.offers.get(registro["offer_id"])
+            if oferta is not None:
+                tocar_negociacion(oferta)
+        elif tabla == "notifications":
+            datos.notifications.append(registro)
+            datos.indexar_notificacion(registro)
+            canal = (
+                f"role:{registro['rol_destino']}" if registro.get("rol_destino")
+                else f"user:{registro['usuario_destino']}"
+            )
+            datos.cambios.publicar([canal], "notificacion", None)
+        elif tabla == "buyer_actions":
+            procesadas = datos.buyer_actions.setdefault(registro["buyer"], set())
+            if op == "insert":
+                procesadas.add(registro["offer_id"])
+            else:
+                procesadas.discard(registro["offer_id"])
+        elif tabla == "lecturas":
+            clave = (registro["usuario"], registro["canal"])
+            datos.lecturas[clave] = float(registro.get("leido_hasta") or 0)
+        elif tabla == "posturas":
+            datos.posturas.guardar(registro)
+        datos.version += 1
+    return True
+
+
+# ============================================================
+#  ESCRITURA DIFERIDA
+# ============================================================
+
+def coalescer_eventos(eventos):
+    """Une los eventos de un lote que se pueden fusionar sin cambiar el resultado.
+
+    Varios "update" de la misma oferta quedan en uno solo, y varios "upsert"
+    con la misma clave también. Un "delete" corta la fusión en su tabla.
+    """
+    resultado = []
+    fusionables = {}
+    for ev in eventos:
+        tabla, op, datos = ev["tabla"], ev["op"], ev["datos"]
+        if op == "update":
+            clave = (tabla, "update", datos.get("id"))
+        elif op == "upsert":
+            clave = (tabla, "upsert") + tuple(datos.get(c) for c in CLAVES_UPSERT[tabla])
+        else:
+            clave = None
+            if op == "delete":
+                fusionables = {k: v for k, v in fusionables.items() if k[0] != tabla}
+
+        if clave is not None and clave in fusionables:
+            fusionables[clave]["datos"].update(datos)
+            continue
+        nuevo = {"tabla": tabla, "op": op, "datos": dict(datos)}
+        resultado.append(nuevo)
+        if clave is not None:
+            fusionables[clave] = nuevo
+    return resultado
+
+
+class ColaEscritura:
+    """Cola en memoria + hilo que persiste los eventos por lotes.
+
+    Las acciones ya no esperan al disco: save_all() encola y vuelve. El hilo
+    escribe un lote cuando pasan FLUSH_CADA_MS desde el primer evento
+    pendiente o cuando se juntan FLUSH_MAX_EVENTOS. Si una escritura falla,
+    el lote vuelve al principio de la cola y se reintenta en el siguiente
+    ciclo. Al cerrar el proceso (atexit) se vacía la cola.
+    """
+
+    def __init__(self, almacen, datos, cada_ms=FLUSH_CADA_MS, max_eventos=FLUSH_MAX_EVENTOS):
+        self.almacen = almacen
+        self.datos = datos
+        self.cada = cada_ms / 1000
+        self.max_eventos = max_eventos
+        self.cond = threading.Condition()
+        self.pendientes = []
+        self.escribiendo = False
+        self.forzar = False
+        self.detenida = False
+        self.metricas = {
+            "lotes": 0,
+            "eventos": 0,
+            "eventos_escritos": 0,
+            "ms_ultimo": 0.0,
+            "ms_max": 0.0,
+            "ms_total": 0.0,
+            "errores": 0,
+            "ultimo_error": None,
+        }
+        self.hilo = threading.Thread(
+            target=self._bucle, name="aguacate-escritura", daemon=True
+        )
+        self.hilo.start()
+        atexit.register(self.detener)
+
+    def encolar(self, eventos):
+        if not eventos:
+            return
+        with self.cond:
+            self.pendientes.extend(eventos)
+            self.cond.notify_all()
+
+    def profundidad(self):
+        return len(self.pendientes)
+
+    def vaciar(self, timeout=None):
+        """Escribe ya lo pendiente y espera a que termine (True si quedó vacía)."""
+        with self.cond:
+            self.forzar = True
+            self.cond.notify_all()
+            return self.cond.wait_for(
+                lambda: not self.pendientes and not self.escribiendo, timeout
+            )
+
+    def detener(self, timeout=10):
+        """Vacía la cola y termina el hilo."""
+        with self.cond:
+            self.detenida = True
+            self.cond.notify_all()
+        self.hilo.join(timeout)
+
+    def _bucle(self):
+        while True:
+            with self.cond:
+                while not self.pendientes and not self.detenida:
+                    self.cond.wait()
+                limite = time.monotonic() + self.cada
+                while (
+                    len(self.pendientes) < self.max_eventos
+                    and not self.forzar
+                    and not self.detenida
+                ):
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self.cond.wait(restante)
+                if not self.pendientes:
+                    self.forzar = False
+                    self.cond.notify_all()
+                    if self.detenida:
+                        return
+                    continue
+                lote, self.pendientes = self.pendientes, []
+                self.escribiendo = True
+
+            ok = self._escribir(lote)
+
+            with self.cond:
+                self.escribiendo = False
+                if not ok:
+                    self.pendientes[:0] = lote
+                if not self.pendientes:
+                    self.forzar = False
+                self.cond.notify_all()
+                if not ok:
+                    if self.detenida:
+                        # No reintentar indefinidamente al cerrar el proceso
+                        return
+                    self.cond.wait(self.cada)
+
+    def _escribir(self, lote):
+        eventos = coalescer_eventos(lote)
+        tablas = None
+        if self.almacen.NECESITA_TABLAS:
+            # Copia para no escribir filas que otra sesión está modificando
+            with self.datos.lock:
+                tablas = {
+                    nombre: [dict(r) for r in registros]
+                    for nombre, registros in self.datos.tablas().items()
+                }
+        inicio = time.perf_counter()
+        try:
+            self.almacen.persistir(eventos, tablas)
+        except Exception as e:
+            self.metricas["errores"] += 1
+            self.metricas["ultimo_error"] = f"{type(e).__name__}: {e}"
+            return False
+        ms = (time.perf_counter() - inicio) * 1000
+        m = self.metricas
+        m["lotes"] += 1
+        m["eventos"] += len(lote)
+        m["eventos_escritos"] += len(eventos)
+        m["ms_ultimo"] = ms
+        m["ms_max"] = max(m["ms_max"], ms)
+        m["ms_total"] += ms
+        return True
+
+
+@st.cache_resource
+def get_cola_escritura():
+    """Cola de escritura diferida del proceso (solo con ESCRITURA_DIFERIDA)."""
+    return ColaEscritura(get_almacen(), get_datos())
 
 
 # ============================================================
 #  INICIALIZACIÓN DE DATOS
 # ============================================================
 
+@instrumentar("init_state")
 def init_state():
     if "user" not in st.session_state:
         st.session_state.user = None
@@ -88,23 +1924,21 @@ def init_state():
             "vendedor1": {"password": "vendedor123", "role": "producer"},
             "comprador1": {"password": "comprador123", "role": "buyer"},
             "comprador2": {"password": "comprador234", "role": "buyer"},
+            # Solo ve el panel de rendimiento
+            "admin": {"password": "admin123", "role": "admin"},
         }
 
-    # Ofertas y contraofertas
-    if "offers" not in st.session_state:
-        st.session_state.offers = load_csv_list("offers.csv")
-
-    # Historial de movimientos
-    if "history" not in st.session_state:
-        st.session_state.history = load_csv_list("history.csv")
+    # Ofertas, historial y notificaciones: compartidos por todas las sesiones
+    datos = get_datos()
+    # Con varios procesos, lo que guardaron los demás desde la última vez
+    sincronizar_si_hace_falta()
 
-    # Notificaciones
-    if "notifications" not in st.session_state:
-        st.session_state.notifications = load_csv_list("notifications.csv")
-
-    # Acciones de compradores sobre ofertas (para ocultarlas en Inicio)
-    if "buyer_actions" not in st.session_state:
-        st.session_state.buyer_actions = []  # esta parte no se persiste
+    # Retención de notificaciones: como mucho una purga por hora y proceso
+    if time.time() - datos.ultima_purga > 3600:
+        purgar_notificaciones(st.session_state.users)
+    # Archivo de negociaciones terminadas: igual, como mucho una vez por hora
+    if time.time() - datos.ultimo_archivado > 3600:
+        archivar_negociaciones()
 
 
 # ============================================================
@@ -116,87 +1950,582 @@ def ahora():
     return datetime.now().strftime("%Y-%m-%d %I:%M %p")
 
 
+def medir_latencia(seccion):
+    """Decorador: guarda en la sesión la duración de la última ejecución (ms).
+
+    Sirve para comparar un rerun completo ("app") con el rerun de un
+    fragmento (tarjetas, formularios, notificaciones).
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                latencias = st.session_state.setdefault("latencias", {})
+                latencias[seccion] = (time.perf_counter() - inicio) * 1000
+        return envoltura
+    return decorador
+
+
+def fecha_ordenable(texto):
+    """Convierte una fecha de ahora() a timestamp para poder ordenar.
+
+    El texto usa reloj de 12 horas ("%Y-%m-%d %I:%M %p"), así que ordenarlo
+    como cadena da un orden incorrecto.
+    """
+    if not texto:
+        return 0.0
+    try:
+        return datetime.strptime(str(texto), "%Y-%m-%d %I:%M %p").timestamp()
+    except ValueError:
+        return 0.0
+
+
+def mes_de(oferta):
+    """Mes de creación (AAAA-MM) de una oferta."""
+    ts = fecha_ordenable(oferta.get("created_at"))
+    return datetime.fromtimestamp(ts).strftime("%Y-%m") if ts else "sin-fecha"
+
+
+def clave_recientes(oferta):
+    """Clave de orden: más recientemente actualizada primero; desempate por id."""
+    return (-fecha_ordenable(oferta.get("updated_at")), str(oferta.get("id")))
+
+
+def clave_precio(oferta, descendente=False):
+    """Clave de orden por precio; las ofertas sin precio van al final."""
+    precio = valor_numerico(oferta.get("precio"))
+    if precio is None:
+        return (1, 0.0, str(oferta.get("id")))
+    return (0, -precio if descendente else precio, str(oferta.get("id")))
+
+
+# Órdenes del Inicio del comprador: nombre -> (etiqueta, clave de orden)
+ORDENES_FEED = {
+    "recientes": ("Más recientes", clave_recientes),
+    "precio_asc": ("Precio: menor a mayor", clave_precio),
+    "precio_desc": ("Precio: mayor a menor", lambda o: clave_precio(o, descendente=True)),
+}
+
+
+def pagina_por_cursor(ordenados, claves, cursor, tamano):
+    """Devuelve (página, cursor_siguiente) de una lista ya ordenada.
+
+    `claves` son las claves de orden de `ordenados`; `cursor` es la clave del
+    último elemento de la página anterior (None para la primera página).
+    """
+    inicio = 0 if cursor is None else bisect.bisect_right(claves, cursor)
+    pagina = ordenados[inicio:inicio + tamano]
+    siguiente = None
+    if inicio + tamano < len(ordenados):
+        siguiente = claves[inicio + tamano - 1]
+    return pagina, siguiente
+
+
 def generar_id():
     """Genera un id corto para ofertas y contraofertas."""
     return uuid.uuid4().hex[:8]
 
 
-def registrar_historial(offer_id, actor, accion, detalle):
-    st.session_state.history.append(
-        {
-            "offer_id": offer_id,
-            "actor": actor,
-            "accion": accion,
-            "detalle": detalle,
-            "fecha": ahora(),
-        }
+def registrar_evento(tabla, op, datos):
+    """Anota un cambio para que save_all() lo persista."""
+    compartidos = get_datos()
+    compartidos.eventos_pendientes.append(
+        {"tabla": tabla, "op": op, "datos": dict(datos)}
     )
+    compartidos.version += 1
 
 
-def enviar_notificacion(usuario, mensaje):
-    st.session_state.notifications.append(
-        {
-            "usuario_destino": usuario,
-            "mensaje": mensaje,
-            "fecha": ahora(),
-        }
+def tocar_negociacion(oferta):
+    """Marca como cambiado el mes de la negociación de `oferta` (analítica)."""
+    datos = get_datos()
+    if oferta.get("tipo") == "counter":
+        oferta = datos.offers.get(oferta.get("parent_offer_id"))
+        if oferta is None:
+            return
+    mes = mes_de(oferta)
+    datos.negociaciones_por_mes.setdefault(mes, set()).add(oferta["id"])
+    datos.version_mes[mes] = datos.version_mes.get(mes, 0) + 1
+
+
+def sesion_actual():
+    """Id de la sesión de Streamlit que ejecuta la acción (None fuera de una sesión)."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else None
+
+
+def insertar_oferta(oferta):
+    datos = get_datos()
+    guardar_previo("offers", oferta["id"], None)
+    datos.offers.agregar(oferta)
+    tocar_negociacion(oferta)
+    registrar_evento("offers", "insert", oferta)
+    datos.cambios.publicar(canales_oferta(oferta), "oferta", oferta["id"], sesion_actual())
+
+
+def actualizar_oferta(oferta, **cambios):
+    """Actualiza campos de una oferta/contraoferta y registra el cambio."""
+    cambios.setdefault("updated_at", ahora())
+    datos = get_datos()
+    # Tras una recarga completa (MULTIPROCESO) la vista puede traer una copia vieja
+    oferta = datos.offers.get(oferta["id"]) or oferta
+    # Canales de antes y después (p. ej. el comprador que la acaba de aceptar)
+    canales = canales_oferta(oferta)
+    guardar_previo("offers", oferta["id"], oferta)
+    datos.offers.actualizar(oferta, cambios)
+    tocar_negociacion(oferta)
+    registrar_evento("offers", "update", {"id": oferta["id"], **cambios})
+    datos.cambios.publicar(
+        canales | canales_oferta(oferta), "oferta", oferta["id"], sesion_actual()
     )
 
 
+def registrar_historial(offer_id, actor, accion, detalle):
+    registro = {
+        "offer_id": offer_id,
+        "actor": actor,
+        "accion": accion,
+        "detalle": detalle,
+        "fecha": ahora(),
+    }
+    datos = get_datos()
+    datos.history.append(registro)
+    datos.historial_por_oferta.setdefault(offer_id, []).append(registro)
+    oferta = datos.offers.get(offer_id)
+    if oferta is not None:
+        tocar_negociacion(oferta)
+    registrar_evento("history", "insert", registro)
+
+
+@instrumentar("enviar_notificacion", filas=lambda _: 1)
+def enviar_notificacion(usuario, mensaje):
+    registro = {
+        "usuario_destino": usuario,
+        "rol_destino": None,
+        "mensaje": mensaje,
+        "fecha": ahora(),
+        "ts": time.time(),
+    }
+    datos = get_datos()
+    datos.notifications.append(registro)
+    datos.indexar_notificacion(registro)
+    registrar_evento("notifications", "insert", registro)
+    datos.cambios.publicar([f"user:{usuario}"], "notificacion", None, sesion_actual())
+
+
+@instrumentar("enviar_notificacion_rol", filas=lambda _: 1)
+def enviar_notificacion_rol(rol, mensaje):
+    """Notificación de difusión: una sola fila para todos los usuarios del rol.
+
+    Cuesta lo mismo sin importar cuántos usuarios tenga el rol; cada bandeja
+    la incorpora al leerla (ver bandeja_notificaciones).
+    """
+    registro = {
+        "usuario_destino": None,
+        "rol_destino": rol,
+        "mensaje": mensaje,
+        "fecha": ahora(),
+        "ts": time.time(),
+    }
+    datos = get_datos()
+    datos.notifications.append(registro)
+    datos.indexar_notificacion(registro)
+    registrar_evento("notifications", "insert", registro)
+    datos.cambios.publicar([f"role:{rol}"], "notificacion", None, sesion_actual())
+
+
+def historial_de_oferta(offer_id):
+    """Registros de historial de una oferta, sin recorrer todo el historial.
+
+    Si la oferta ya fue archivada se lee de su partición fría.
+    """
+    datos = get_datos()
+    with datos.lock:
+        registros = datos.historial_por_oferta.get(offer_id)
+        if registros is not None:
+            return list(registros)
+        if datos.offers.get(offer_id) is not None:
+            return []
+    archivada = indice_archivo().get(offer_id)
+    if archivada is None:
+        return []
+    return list(historial_archivado(archivada[0]).get(offer_id, []))
+
+
+@instrumentar("get_oferta_por_id", filas=lambda _: 1)
 def get_oferta_por_id(offer_id):
-    for o in st.session_state.offers:
-        if o.get("id") == offer_id:
-            return o
-    return None
+    return get_datos().offers.get(offer_id)
 
 
 def marcar_oferta_procesada_por_comprador(buyer, offer_id):
     """Se usa para que el comprador deje de ver esa oferta en Inicio."""
-    for a in st.session_state.buyer_actions:
-        if a["buyer"] == buyer and a["offer_id"] == offer_id:
-            return
-    st.session_state.buyer_actions.append(
-        {"buyer": buyer, "offer_id": offer_id}
-    )
+    procesadas = get_datos().buyer_actions.setdefault(buyer, set())
+    if offer_id in procesadas:
+        return
+    guardar_previo("buyer_actions", buyer, procesadas)
+    procesadas.add(offer_id)
+    registrar_evento("buyer_actions", "insert", {"buyer": buyer, "offer_id": offer_id})
 
 
 def comprador_ya_proceso_oferta(buyer, offer_id):
-    for a in st.session_state.buyer_actions:
-        if a["buyer"] == buyer and a["offer_id"] == offer_id:
-            return True
-    return False
+    return offer_id in get_datos().buyer_actions.get(buyer, ())
 
 
 def limpiar_accion_comprador(buyer, offer_id):
     """Permite que el comprador vuelva a ver una oferta en su Inicio
     cuando el productor envía una nueva contraoferta o cuando el comprador elimina su contraoferta."""
-    nueva_lista = []
-    for a in st.session_state.buyer_actions:
-        if not (a["buyer"] == buyer and a["offer_id"] == offer_id):
-            nueva_lista.append(a)
-    st.session_state.buyer_actions = nueva_lista
+    procesadas = get_datos().buyer_actions.get(buyer)
+    if not procesadas or offer_id not in procesadas:
+        return
+    guardar_previo("buyer_actions", buyer, procesadas)
+    procesadas.discard(offer_id)
+    registrar_evento("buyer_actions", "delete", {"buyer": buyer, "offer_id": offer_id})
 
 
 # ============================================================
-#  CREACIÓN DE OFERTAS Y CONTRAOFERTAS
+#  BANDEJA DE NOTIFICACIONES
 # ============================================================
+# Cada usuario lee dos canales ordenados por ts: sus mensajes directos
+# ("user:<nombre>") y las difusiones de su rol ("role:<rol>"). Las consultas
+# usan búsqueda binaria sobre ts, así que cuestan lo que mide la página.
 
-def crear_oferta(productor, toneladas, recoleccion, canastillas, precio,
-                calibre, madurez, origen, notas):
-    nueva_oferta = {
-        "id": generar_id(),
-        "tipo": "offer",
-        "producer": productor,
-        "buyer": None,
-        "parent_offer_id": None,
-        "toneladas": toneladas,
-        "recoleccion": recoleccion,
-        "canastillas": canastillas,
-        "precio": precio,
+def ts_notificacion(n):
+    return n.get("ts") or 0.0
 
-        # NUEVOS CAMPOS DE NEGOCIACIÓN
-        "calibre": calibre,
-        "madurez": madurez,
+
+def texto_ts(ts):
+    """ts epoch -> texto con segundos, para mostrar."""
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def canales_notificaciones(user, rol):
+    """Canales de la bandeja del usuario: sus mensajes directos y los de su rol."""
+    datos = get_datos()
+    return [
+        (f"user:{user}", datos.notificaciones_por_usuario.get(user, [])),
+        (f"role:{rol}", datos.notificaciones_por_rol.get(rol, [])),
+    ]
+
+
+def contar_no_leidas(user, rol):
+    """Cantidad de notificaciones posteriores a los marcadores de lectura."""
+    datos = get_datos()
+    total = 0
+    with datos.lock:
+        for canal, lista in canales_notificaciones(user, rol):
+            leido_hasta = datos.lecturas.get((user, canal), 0.0)
+            total += len(lista) - bisect.bisect_right(
+                lista, leido_hasta, key=ts_notificacion
+            )
+    return total
+
+
+def clave_bandeja(lista, canal, i):
+    """Clave de orden de lista[i] en la bandeja: (ts, canal, nº dentro del ts).
+
+    Las filas anteriores a la columna ts comparten el ts del minuto de su
+    fecha; el número dentro del mismo ts desempata sin saltarse ninguna al
+    paginar. La purga borra grupos de un mismo ts completos, así que el
+    número no cambia entre páginas.
+    """
+    ts = ts_notificacion(lista[i])
+    return (ts, canal, i - bisect.bisect_left(lista, ts, key=ts_notificacion))
+
+
+def corte_bandeja(lista, canal, cursor, incluido=False):
+    """Cuántas filas de `lista` tienen clave < `cursor` (<= si `incluido`)."""
+    ts, canal_cursor, n = cursor
+    inicio = bisect.bisect_left(lista, ts, key=ts_notificacion)
+    fin = bisect.bisect_right(lista, ts, key=ts_notificacion)
+    if canal < canal_cursor:
+        return fin
+    if canal > canal_cursor:
+        return inicio
+    return inicio + min(n + (1 if incluido else 0), fin - inicio)
+
+
+def pagina_bandeja(user, rol, antes_de=None, despues_de=None,
+                   tamano=TAMANO_PAGINA_NOTIFICACIONES):
+    """Página de la bandeja, de la más reciente a la más antigua.
+
+    Sin cursores devuelve las `tamano` más recientes. Con `antes_de` (clave
+    de clave_bandeja) devuelve las anteriores a esa fila (página más
+    antigua); con `despues_de`, las posteriores (página más nueva).
+    Cada elemento es (notificacion, es_nueva, clave).
+    """
+    datos = get_datos()
+    candidatas = []
+    with datos.lock:
+        for canal, (nombre, lista) in enumerate(canales_notificaciones(user, rol)):
+            leido_hasta = datos.lecturas.get((user, nombre), 0.0)
+            if despues_de is not None:
+                inicio = corte_bandeja(lista, canal, despues_de, incluido=True)
+                indices = range(inicio, min(len(lista), inicio + tamano))
+            else:
+                fin = len(lista)
+                if antes_de is not None:
+                    fin = corte_bandeja(lista, canal, antes_de)
+                indices = range(max(0, fin - tamano), fin)
+            for i in indices:
+                n = lista[i]
+                candidatas.append((n, ts_notificacion(n) > leido_hasta, clave_bandeja(lista, canal, i)))
+
+    candidatas.sort(key=lambda x: x[2])
+    if despues_de is not None:
+        candidatas = candidatas[:tamano]
+    else:
+        candidatas = candidatas[-tamano:]
+    candidatas.reverse()
+    return candidatas
+
+
+@transaccion
+def marcar_notificaciones_leidas(user, rol):
+    """Mueve los marcadores de lectura del usuario al final de cada canal."""
+    datos = get_datos()
+    hubo_cambios = False
+    for canal, lista in canales_notificaciones(user, rol):
+        if not lista:
+            continue
+        ultima = ts_notificacion(lista[-1])
+        if datos.lecturas.get((user, canal), 0.0) < ultima:
+            datos.lecturas[(user, canal)] = ultima
+            registrar_evento(
+                "lecturas",
+                "upsert",
+                {"usuario": user, "canal": canal, "leido_hasta": ultima},
+            )
+            hubo_cambios = True
+    if hubo_cambios:
+        save_all()
+
+
+@transaccion
+def purgar_notificaciones(usuarios, ahora_ts=None):
+    """Elimina notificaciones leídas con más de RETENCION_NOTIFICACIONES_DIAS.
+
+    Una difusión se considera leída cuando todos los usuarios de su rol
+    (según `usuarios`) la vieron.
+    """
+    datos = get_datos()
+    ahora_ts = time.time() if ahora_ts is None else ahora_ts
+    limite = ahora_ts - RETENCION_NOTIFICACIONES_DIAS * 86400
+
+    def leida_por(usuario, canal, n):
+        return datos.lecturas.get((usuario, canal), 0.0) >= ts_notificacion(n)
+
+    borrar = []
+    for usuario, lista in datos.notificaciones_por_usuario.items():
+        canal = f"user:{usuario}"
+        for n in lista:
+            if ts_notificacion(n) >= limite:
+                break
+            if leida_por(usuario, canal, n):
+                borrar.append(n)
+    for rol, lista in datos.notificaciones_por_rol.items():
+        canal = f"role:{rol}"
+        lectores = [u for u, d in usuarios.items() if d["role"] == rol]
+        for n in lista:
+            if ts_notificacion(n) >= limite:
+                break
+            if all(leida_por(u, canal, n) for u in lectores):
+                borrar.append(n)
+
+    datos.ultima_purga = ahora_ts
+    if not borrar:
+        return 0
+
+    ids_borrar = {id(n) for n in borrar}
+    datos.notifications[:] = [n for n in datos.notifications if id(n) not in ids_borrar]
+    for bandejas in (datos.notificaciones_por_usuario, datos.notificaciones_por_rol):
+        for clave, lista in bandejas.items():
+            bandejas[clave] = [n for n in lista if id(n) not in ids_borrar]
+    for n in borrar:
+        # El borrado compara todos los campos del evento con la fila guardada:
+        # un ts derivado al cargar no está en el almacén y no coincidiría
+        if id(n) in datos.ts_derivados:
+            n = {k: v for k, v in n.items() if k != "ts"}
+        registrar_evento("notifications", "delete", n)
+    save_all()
+    return len(borrar)
+
+
+# ============================================================
+#  ARCHIVO DE NEGOCIACIONES TERMINADAS
+# ============================================================
+# Una negociación (oferta + sus contraofertas + su historial) terminada se
+# mueve a ARCHIVO_DIR/offers_AAAA-MM.csv y history_AAAA-MM.csv según el mes
+# de su último cambio. En memoria (y en el almacén) quedan solo las vivas.
+# Las particiones frías se leen bajo demanda y quedan cacheadas hasta que
+# cambian en disco.
+
+def archivo_particion(tabla, mes, formato=None):
+    formato = formato or FORMATO_SNAPSHOT
+    extension = ".parquet" if formato == "parquet" else ".csv"
+    return os.path.join(ARCHIVO_DIR, f"{tabla}_{mes}{extension}")
+
+
+def firma_archivo():
+    """(mes, mtime) de cada partición de ofertas; cambia al archivar."""
+    if not os.path.isdir(ARCHIVO_DIR):
+        return ()
+    extension = os.path.splitext(archivo_particion("offers", ""))[1]
+    firma = []
+    for nombre in os.listdir(ARCHIVO_DIR):
+        if nombre.startswith("offers_") and nombre.endswith(extension):
+            mes = nombre[len("offers_"):-len(extension)]
+            ruta = os.path.join(ARCHIVO_DIR, nombre)
+            firma.append((mes, os.stat(ruta).st_mtime_ns))
+    return tuple(sorted(firma, reverse=True))
+
+
+# Los resultados cacheados se comparten entre sesiones: no modificarlos.
+@st.cache_resource(max_entries=24)
+def _ofertas_particion(mes, mtime):
+    return cargar_tabla("offers", archivo=archivo_particion("offers", mes))
+
+
+@st.cache_resource(max_entries=24)
+def _historial_particion(mes, mtime):
+    por_oferta = {}
+    for h in cargar_tabla("history", archivo=archivo_particion("history", mes)):
+        por_oferta.setdefault(h["offer_id"], []).append(h)
+    return por_oferta
+
+
+@st.cache_resource(max_entries=4)
+def _indice_archivo(firma):
+    indice = {}
+    for mes, mtime in firma:
+        for o in _ofertas_particion(mes, mtime):
+            indice[o["id"]] = (mes, o)
+    return indice
+
+
+def indice_archivo():
+    """offer_id -> (mes, oferta) de todo lo archivado."""
+    return _indice_archivo(firma_archivo())
+
+
+def historial_archivado(mes):
+    """offer_id -> registros de historial de una partición."""
+    ruta = archivo_particion("history", mes)
+    if not os.path.exists(ruta):
+        return {}
+    return _historial_particion(mes, os.stat(ruta).st_mtime_ns)
+
+
+def ofertas_archivadas():
+    return [o for _, o in indice_archivo().values()]
+
+
+def anexar_particion(tabla, mes, registros, clave):
+    """Agrega registros a una partición fría (reemplaza los de la misma clave).
+
+    Reemplazar en lugar de duplicar permite repetir un archivado que se
+    interrumpió antes de quitar las filas de los datos calientes.
+    """
+    os.makedirs(ARCHIVO_DIR, exist_ok=True)
+    ruta = archivo_particion(tabla, mes)
+    nuevas = {r.get(clave) for r in registros}
+    filas = [r for r in cargar_tabla(tabla, archivo=ruta) if r.get(clave) not in nuevas]
+    filas.extend(registros)
+    tmp = ruta + ".tmp"
+    guardar_tabla(tabla, filas, archivo=tmp)
+    os.replace(tmp, ruta)
+
+
+def negociaciones_terminadas(limite_ts):
+    """[(mes, [oferta, contraofertas...])] listas para archivar.
+
+    Una negociación termina cuando la oferta está cerrada o aceptada; sus
+    contraofertas ya no pueden prosperar aunque alguna siga "open" (datos
+    anteriores a cerrar_contraofertas_pendientes). Se archiva si su último
+    cambio es anterior a `limite_ts`.
+    """
+    repo = get_datos().offers
+    terminadas = []
+    for status in ("closed", "accepted"):
+        for oferta in repo.buscar("tipo_status", "offer", status):
+            contras = repo.buscar("parent", oferta["id"])
+            ultimo = max(fecha_ordenable(r.get("updated_at")) for r in [oferta] + contras)
+            if ultimo >= limite_ts:
+                continue
+            mes = datetime.fromtimestamp(ultimo).strftime("%Y-%m") if ultimo else "sin-fecha"
+            terminadas.append((mes, [oferta] + contras))
+    return terminadas
+
+
+@transaccion
+def archivar_negociaciones(ahora_ts=None):
+    """Mueve las negociaciones terminadas a las particiones frías.
+
+    Primero se escriben los archivos fríos y después se quitan las filas de
+    los datos calientes, así una interrupción nunca pierde datos.
+    """
+    datos = get_datos()
+    ahora_ts = time.time() if ahora_ts is None else ahora_ts
+    datos.ultimo_archivado = ahora_ts
+    terminadas = negociaciones_terminadas(ahora_ts - ARCHIVAR_TRAS_DIAS * 86400)
+    if not terminadas:
+        return 0
+
+    por_mes = {}
+    for mes, registros in terminadas:
+        por_mes.setdefault(mes, []).extend(registros)
+    for mes, registros in por_mes.items():
+        ids = [r["id"] for r in registros]
+        historial = [h for i in ids for h in datos.historial_por_oferta.get(i, [])]
+        anexar_particion("offers", mes, [dict(r) for r in registros], "id")
+        if historial:
+            anexar_particion("history", mes, [dict(h) for h in historial], "offer_id")
+
+    archivadas = [r for _, registros in terminadas for r in registros]
+    ids = {r["id"] for r in archivadas}
+    for r in archivadas:
+        if r.get("tipo") == "offer":
+            mes = mes_de(r)
+            datos.negociaciones_por_mes.get(mes, set()).discard(r["id"])
+            datos.version_mes[mes] = datos.version_mes.get(mes, 0) + 1
+        datos.offers.quitar(r)
+        registrar_evento("offers", "delete", {"id": r["id"]})
+    con_historial = [i for i in ids if i in datos.historial_por_oferta]
+    if con_historial:
+        datos.history[:] = [h for h in datos.history if h["offer_id"] not in ids]
+        for i in con_historial:
+            del datos.historial_por_oferta[i]
+            registrar_evento("history", "delete", {"offer_id": i})
+    for buyer, procesadas in datos.buyer_actions.items():
+        for offer_id in procesadas & ids:
+            procesadas.discard(offer_id)
+            registrar_evento("buyer_actions", "delete", {"buyer": buyer, "offer_id": offer_id})
+    save_all()
+    return len(terminadas)
+
+
+# ============================================================
+#  CREACIÓN DE OFERTAS Y CONTRAOFERTAS
+# ============================================================
+
+def armar_oferta(productor, toneladas, recoleccion, canastillas, precio,
+                 calibre, madurez, origen, notas):
+    """Registro de una oferta nueva (aún sin insertar)."""
+    return {
+        "id": generar_id(),
+        "tipo": "offer",
+        "producer": productor,
+        "buyer": None,
+        "parent_offer_id": None,
+        "toneladas": toneladas,
+        "recoleccion": recoleccion,
+        "canastillas": canastillas,
+        "precio": precio,
+
+        # NUEVOS CAMPOS DE NEGOCIACIÓN
+        "calibre": calibre,
+        "madurez": madurez,
         "origen": origen,
 
         "notas": notas,
@@ -205,7 +2534,16 @@ def crear_oferta(productor, toneladas, recoleccion, canastillas, precio,
         "created_at": ahora(),
         "updated_at": ahora(),
     }
-    st.session_state.offers.append(nueva_oferta)
+
+
+@transaccion
+def crear_oferta(productor, toneladas, recoleccion, canastillas, precio,
+                calibre, madurez, origen, notas):
+    nueva_oferta = armar_oferta(
+        productor, toneladas, recoleccion, canastillas, precio,
+        calibre, madurez, origen, notas,
+    )
+    insertar_oferta(nueva_oferta)
 
     registrar_historial(
         nueva_oferta["id"],
@@ -214,497 +2552,1740 @@ def crear_oferta(productor, toneladas, recoleccion, canastillas, precio,
         "El productor creó una oferta inicial.",
     )
 
-    # Notificar a todos los compradores de que hay una nueva oferta
-    for username, data in st.session_state.users.items():
-        if data["role"] == "buyer":
-            enviar_notificacion(
-                username,
-                f"El productor {productor} publicó una nueva oferta #{nueva_oferta['id']}.",
-            )
+    # Notificar a todos los compradores de que hay una nueva oferta
+    # (una sola fila de difusión, no una por comprador)
+    enviar_notificacion_rol(
+        "buyer",
+        f"El productor {productor} publicó una nueva oferta #{nueva_oferta['id']}.",
+    )
+    emparejar_ofertas([nueva_oferta])
+
+    save_all()
+
+
+# Importación masiva: columnas del archivo (en el orden de la plantilla)
+CAMPOS_IMPORTACION = [
+    "toneladas", "recoleccion", "canastillas", "precio",
+    "calibre", "madurez", "origen", "notas",
+]
+# Encabezados alternativos aceptados (sin acentos ni mayúsculas)
+ALIAS_IMPORTACION = {
+    "dias de recoleccion": "recoleccion",
+    "grado de madurez": "madurez",
+    "notas (opcional)": "notas",
+}
+
+
+def normalizar_columna(nombre):
+    texto = unicodedata.normalize("NFKD", str(nombre)).encode("ascii", "ignore").decode()
+    texto = texto.strip().lower()
+    return ALIAS_IMPORTACION.get(texto, texto)
+
+
+def leer_archivo_importacion(nombre, contenido):
+    """DataFrame (todo texto) de un CSV o Excel (.xlsx) subido por el productor."""
+    if nombre.lower().endswith(".xls"):
+        raise ValueError(
+            "El formato .xls (Excel 97-2003) no está soportado; guarda el archivo "
+            "como .xlsx o CSV."
+        )
+    if nombre.lower().endswith(".xlsx"):
+        try:
+            return pd.read_excel(io.BytesIO(contenido), dtype=str)
+        except ImportError:
+            raise ValueError(
+                "Para importar Excel hace falta openpyxl (pip install openpyxl); "
+                "también puedes subir el archivo como CSV."
+            ) from None
+    return pd.read_csv(io.BytesIO(contenido), dtype=str, sep=None, engine="python")
+
+
+def validar_importacion(df):
+    """Valida todas las filas de una vez (operaciones por columna).
+
+    Devuelve (registros válidos, DataFrame de errores con fila y motivo).
+    Lanza ValueError si faltan columnas obligatorias.
+    """
+    df = df.rename(columns=normalizar_columna).dropna(how="all")
+    faltantes = [c for c in ("toneladas", "precio") if c not in df.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas obligatorias: {', '.join(faltantes)}")
+    df = df.reindex(columns=CAMPOS_IMPORTACION)
+
+    numeros = {c: pd.to_numeric(df[c], errors="coerce") for c in ("toneladas", "precio")}
+    errores = pd.Series("", index=df.index)
+    for campo, valores in numeros.items():
+        for mascara, motivo in (
+            (valores.isna(), f"{campo} vacío o no numérico"),
+            (valores < 0, f"{campo} negativo"),
+        ):
+            errores = errores.where(~mascara, errores + motivo + "; ")
+
+    validas = errores == ""
+    invalidas = pd.DataFrame({
+        # +2: el encabezado es la línea 1 y el índice empieza en 0
+        "fila": df.index[~validas] + 2,
+        "motivo": errores[~validas].str.rstrip("; "),
+    })
+
+    limpias = df[validas].copy()
+    for campo, valores in numeros.items():
+        limpias[campo] = valores[validas]
+    for campo in CAMPOS_IMPORTACION:
+        if campo not in numeros:
+            texto = limpias[campo].astype("string").str.strip()
+            limpias[campo] = texto.mask(texto == "")
+    return registros_desde_df(limpias), invalidas
+
+
+@transaccion
+def importar_ofertas(productor, filas):
+    """Crea muchas ofertas con una sola escritura y un solo aviso a compradores.
+
+    Devuelve los ids creados.
+    """
+    ids = []
+    for fila in filas:
+        oferta = armar_oferta(productor, **{c: fila.get(c) for c in CAMPOS_IMPORTACION})
+        insertar_oferta(oferta)
+        registrar_historial(
+            oferta["id"],
+            productor,
+            "crear_oferta",
+            "El productor creó una oferta inicial (importación masiva).",
+        )
+        ids.append(oferta["id"])
+    if not ids:
+        return ids
+
+    # Un solo aviso de difusión para todo el lote
+    listado = ", ".join(f"#{i}" for i in ids[:5])
+    if len(ids) > 5:
+        listado += f" y {len(ids) - 5} más"
+    enviar_notificacion_rol(
+        "buyer",
+        f"El productor {productor} publicó {len(ids)} ofertas nuevas ({listado}).",
+    )
+    emparejar_ofertas([get_oferta_por_id(i) for i in ids])
+    save_all()
+    return ids
+
+
+@transaccion
+def crear_contraoferta_comprador(oferta_original, comprador,
+                                 toneladas, recoleccion, canastillas,
+                                 precio, calibre, madurez, origen, notas):
+    """
+    Crea un registro de contraoferta del comprador.
+    No cierra la oferta original, solo añade una propuesta.
+    Devuelve False si la oferta ya no está disponible (otra sesión la cerró).
+    """
+    oferta_original = get_oferta_por_id(oferta_original["id"])
+    if oferta_original is None or not oferta_disponible(oferta_original):
+        return False
+
+    contra = {
+        "id": generar_id(),
+        "tipo": "counter",
+        "producer": oferta_original["producer"],
+        "buyer": comprador,
+        "parent_offer_id": oferta_original["id"],
+        "toneladas": toneladas,
+        "recoleccion": recoleccion,
+        "canastillas": canastillas,
+        "precio": precio,
+
+        # NUEVOS CAMPOS DE NEGOCIACIÓN
+        "calibre": calibre,
+        "madurez": madurez,
+        "origen": origen,
+
+        "notas": notas,
+        "status": "open",           # open, accepted, rejected, answered, deleted
+        "created_at": ahora(),
+        "updated_at": ahora(),
+    }
+    insertar_oferta(contra)
+
+    # La oferta original sigue "open"
+    actualizar_oferta(oferta_original, status="open")
+
+    registrar_historial(
+        oferta_original["id"],
+        comprador,
+        "contraoferta_comprador",
+        f"El comprador {comprador} envió una contraoferta.",
+    )
+    enviar_notificacion(
+        oferta_original["producer"],
+        f"El comprador {comprador} hizo una contraoferta a tu oferta #{oferta_original['id']}.",
+    )
+
+    # El comprador ya tomó una decisión sobre esta oferta → se oculta para él
+    marcar_oferta_procesada_por_comprador(comprador, oferta_original["id"])
+
+    save_all()
+    return True
+
+
+@transaccion
+def contraoferta_vendedor_actualizar(oferta_original, contraoferta,
+                                     toneladas, recoleccion, canastillas,
+                                     precio, calibre, madurez, origen, notas):
+    """
+    El productor responde a la contraoferta del comprador.
+    En lugar de crear una oferta nueva, actualiza los datos de la oferta original
+    y marca la contraoferta como respondida.
+    Devuelve False si la oferta ya se vendió o la contraoferta ya no está abierta.
+    """
+    oferta_original = get_oferta_por_id(oferta_original["id"])
+    contraoferta = get_oferta_por_id(contraoferta["id"])
+    if (
+        oferta_original is None or not oferta_disponible(oferta_original)
+        or contraoferta is None or contraoferta.get("status") != "open"
+    ):
+        return False
+
+    # Actualizar la oferta original con los nuevos datos
+    cambios = {
+        "toneladas": toneladas,
+        "recoleccion": recoleccion,
+        "canastillas": canastillas,
+        "precio": precio,
+
+        # NUEVOS CAMPOS DE NEGOCIACIÓN (se actualizan también)
+        "calibre": calibre,
+        "madurez": madurez,
+        "origen": origen,
+
+        "status": "open",
+    }
+    if notas is not None:
+        cambios["notas"] = notas
+    actualizar_oferta(oferta_original, **cambios)
+
+    # Marcar la contraoferta como respondida
+    actualizar_oferta(contraoferta, status="answered")
+
+    registrar_historial(
+        oferta_original["id"],
+        oferta_original["producer"],
+        "contraoferta_vendedor",
+        f"El productor envió una contraoferta al comprador {contraoferta['buyer']}.",
+    )
+
+    enviar_notificacion(
+        contraoferta["buyer"],
+        f"El productor {oferta_original['producer']} envió una contraoferta "
+        f"sobre la oferta #{oferta_original['id']}.",
+    )
+
+    # Permitir que el comprador vuelva a ver la oferta actualizada en su Inicio
+    limpiar_accion_comprador(contraoferta["buyer"], oferta_original["id"])
+
+    # Las nuevas condiciones pueden cumplir posturas de otros compradores
+    emparejar_ofertas(
+        [get_oferta_por_id(oferta_original["id"])], excluir={contraoferta["buyer"]}
+    )
+
+    save_all()
+    return True
+
+
+# ============================================================
+#  ACCIONES SOBRE OFERTAS Y CONTRAOFERTAS
+# ============================================================
+
+@transaccion
+def marcar_interes(oferta, comprador):
+    """Devuelve False si la oferta ya no está disponible."""
+    oferta = get_oferta_por_id(oferta["id"])
+    if oferta is None or not oferta_disponible(oferta):
+        return False
+    registrar_historial(
+        oferta["id"],
+        comprador,
+        "interes",
+        f"El comprador {comprador} marcó interés en la oferta.",
+    )
+    enviar_notificacion(
+        oferta["producer"],
+        f"El comprador {comprador} marcó interés en tu oferta #{oferta['id']}.",
+    )
+    save_all()
+    return True
+
+
+def cerrar_contraofertas_pendientes(oferta, excepto=None):
+    """Cierra las contraofertas abiertas de una oferta que se acaba de vender.
+
+    Se llama dentro de la transacción que cierra el negocio; así no quedan
+    en la bandeja del productor y la negociación se puede archivar.
+    """
+    for c in get_datos().offers.buscar("parent", oferta["id"]):
+        if c.get("status") != "open" or c["id"] == excepto:
+            continue
+        actualizar_oferta(c, status="rejected")
+        registrar_historial(
+            c["id"],
+            oferta["producer"],
+            "cerrar_contraoferta",
+            f"La oferta se vendió a otro comprador; se cerró la contraoferta de {c['buyer']}.",
+        )
+        enviar_notificacion(
+            c["buyer"],
+            f"La oferta #{oferta['id']} se vendió a otro comprador; "
+            f"tu contraoferta #{c['id']} quedó cerrada.",
+        )
+
+
+@transaccion
+def aceptar_oferta(oferta, comprador):
+    """Acepta la oferta tal cual. Devuelve False si ya no está disponible
+    (otra sesión la aceptó o la cerró)."""
+    oferta = get_oferta_por_id(oferta["id"])
+    if oferta is None or not oferta_disponible(oferta):
+        return False
+    actualizar_oferta(oferta, status="accepted", buyer=comprador)
+    cerrar_contraofertas_pendientes(oferta)
+    registrar_historial(
+        oferta["id"],
+        comprador,
+        "aceptar_oferta",
+        f"El comprador {comprador} aceptó la oferta.",
+    )
+    enviar_notificacion(
+        oferta["producer"],
+        f"El comprador {comprador} aceptó tu oferta #{oferta['id']}.",
+    )
+    marcar_oferta_procesada_por_comprador(comprador, oferta["id"])
+    save_all()
+    return True
+
+
+@transaccion
+def rechazar_oferta(oferta, comprador):
+    """Devuelve False si la oferta ya no está disponible."""
+    oferta = get_oferta_por_id(oferta["id"])
+    if oferta is None or not oferta_disponible(oferta):
+        return False
+    registrar_historial(
+        oferta["id"],
+        comprador,
+        "rechazar_oferta",
+        f"El comprador {comprador} rechazó la oferta.",
+    )
+    enviar_notificacion(
+        oferta["producer"],
+        f"El comprador {comprador} rechazó tu oferta #{oferta['id']}.",
+    )
+    marcar_oferta_procesada_por_comprador(comprador, oferta["id"])
+    save_all()
+    return True
+
+
+@transaccion
+def aceptar_contraoferta(contraoferta, oferta_original, productor):
+    """Acepta la contraoferta y cierra la oferta original. Devuelve False si
+    la contraoferta ya no está abierta o la oferta ya se vendió."""
+    contraoferta = get_oferta_por_id(contraoferta["id"])
+    if contraoferta is None or contraoferta.get("status") != "open":
+        return False
+    if oferta_original:
+        oferta_original = get_oferta_por_id(oferta_original["id"])
+        if oferta_original is not None and not oferta_disponible(oferta_original):
+            return False
+    actualizar_oferta(contraoferta, status="accepted")
+
+    if oferta_original:
+        actualizar_oferta(
+            oferta_original, status="closed", buyer=contraoferta["buyer"]
+        )
+        cerrar_contraofertas_pendientes(oferta_original, excepto=contraoferta["id"])
+
+    registrar_historial(
+        contraoferta["id"],
+        productor,
+        "aceptar_contraoferta",
+        f"El productor aceptó la contraoferta de {contraoferta['buyer']}.",
+    )
+    enviar_notificacion(
+        contraoferta["buyer"],
+        f"El productor aceptó tu contraoferta #{contraoferta['id']}.",
+    )
+    save_all()
+    return True
+
+
+@transaccion
+def rechazar_contraoferta(contraoferta, productor):
+    """Devuelve False si la contraoferta ya no está abierta."""
+    contraoferta = get_oferta_por_id(contraoferta["id"])
+    if contraoferta is None or contraoferta.get("status") != "open":
+        return False
+    actualizar_oferta(contraoferta, status="rejected")
+    registrar_historial(
+        contraoferta["id"],
+        productor,
+        "rechazar_contraoferta",
+        f"El productor rechazó la contraoferta de {contraoferta['buyer']}.",
+    )
+    enviar_notificacion(
+        contraoferta["buyer"],
+        f"El productor rechazó tu contraoferta #{contraoferta['id']}.",
+    )
+    save_all()
+    return True
+
+
+@transaccion
+def ocultar_oferta(oferta, productor):
+    """Oculta la oferta en "Mis ofertas" del productor (no la elimina).
+
+    Devuelve False si la oferta ya no está disponible (se vendió mientras tanto).
+    """
+    oferta = get_oferta_por_id(oferta["id"])
+    if oferta is None or not oferta_disponible(oferta):
+        return False
+    actualizar_oferta(oferta, producer_hidden=True)
+    registrar_historial(
+        oferta["id"],
+        productor,
+        "ocultar_oferta",
+        "El productor ocultó la oferta (sigue visible en Inicio para compradores).",
+    )
+    save_all()
+    return True
+
+
+@transaccion
+def eliminar_contraoferta(contraoferta, comprador):
+    """Devuelve False si la contraoferta ya no está abierta."""
+    contraoferta = get_oferta_por_id(contraoferta["id"])
+    if contraoferta is None or contraoferta.get("status") != "open":
+        return False
+    actualizar_oferta(contraoferta, status="deleted")
+    registrar_historial(
+        contraoferta["parent_offer_id"],
+        comprador,
+        "eliminar_contraoferta",
+        f"El comprador {comprador} eliminó su contraoferta.",
+    )
+    enviar_notificacion(
+        contraoferta["producer"],
+        f"El comprador {comprador} eliminó su contraoferta #{contraoferta['id']}.",
+    )
+
+    # CLAVE: permitir que vuelva a aparecer en Inicio
+    limpiar_accion_comprador(comprador, contraoferta["parent_offer_id"])
+
+    save_all()
+    return True
+
+
+# Acciones en lote: cada una aplica la acción individual a varios registros
+# dentro de lote_acciones() y devuelve cuántos se aplicaron. Se omiten los
+# que ya cambiaron (otra sesión o una acción anterior del mismo lote).
+
+def vigentes(registros, condicion):
+    """Versión actual de cada registro que todavía cumple `condicion`."""
+    for r in registros:
+        actual = get_oferta_por_id(r["id"])
+        if actual is not None and condicion(actual):
+            yield actual
+
+
+def contraoferta_abierta(c):
+    return c.get("status") == "open"
+
+
+def marcar_interes_lote(ofertas, comprador):
+    aplicadas = 0
+    with lote_acciones():
+        for o in vigentes(ofertas, oferta_disponible):
+            if marcar_interes(o, comprador):
+                aplicadas += 1
+    return aplicadas
+
+
+def aceptar_ofertas_lote(ofertas, comprador):
+    aplicadas = 0
+    with lote_acciones():
+        # oferta_disponible se evalúa en cada paso: una oferta repetida solo se acepta una vez
+        for o in vigentes(ofertas, oferta_disponible):
+            if aceptar_oferta(o, comprador):
+                aplicadas += 1
+    return aplicadas
+
+
+def rechazar_ofertas_lote(ofertas, comprador):
+    aplicadas = 0
+    with lote_acciones():
+        for o in vigentes(ofertas, oferta_disponible):
+            if o["id"] in get_datos().buyer_actions.get(comprador, ()):
+                continue
+            if rechazar_oferta(o, comprador):
+                aplicadas += 1
+    return aplicadas
+
+
+def aceptar_contraofertas_lote(contraofertas, productor):
+    aplicadas = 0
+    with lote_acciones():
+        for c in vigentes(contraofertas, contraoferta_abierta):
+            oferta_original = get_oferta_por_id(c["parent_offer_id"])
+            if oferta_original is not None and not oferta_disponible(oferta_original):
+                # Ya se vendió: aceptada por un comprador o cerrada con otra
+                # contraoferta (quizá de este mismo lote)
+                continue
+            if aceptar_contraoferta(c, oferta_original, productor):
+                aplicadas += 1
+    return aplicadas
+
+
+def rechazar_contraofertas_lote(contraofertas, productor):
+    aplicadas = 0
+    with lote_acciones():
+        for c in vigentes(contraofertas, contraoferta_abierta):
+            if rechazar_contraoferta(c, productor):
+                aplicadas += 1
+    return aplicadas
+
+
+# ============================================================
+#  POSTURAS DE COMPRA (EMPAREJAMIENTO)
+# ============================================================
+# Un comprador deja registrada una postura (precio máximo, rango de
+# toneladas y calibres / madurez / orígenes aceptados). Cada oferta que se
+# publica o se actualiza se busca en los libros de LibroPosturas y se avisa
+# a los compradores cuyas posturas la aceptan.
+
+@transaccion
+def registrar_postura(comprador, precio_max, toneladas_min, toneladas_max,
+                      calibres, madurez, origenes):
+    postura = {
+        "id": generar_id(),
+        "buyer": comprador,
+        "precio_max": precio_max,
+        "toneladas_min": toneladas_min,
+        "toneladas_max": toneladas_max,
+        "calibres": calibres or None,
+        "madurez": madurez or None,
+        "origenes": origenes or None,
+        "activa": True,
+        "created_at": ahora(),
+    }
+    get_datos().posturas.guardar(postura)
+    registrar_evento("posturas", "upsert", postura)
+    save_all()
+    return postura
+
+
+@transaccion
+def cancelar_postura(postura):
+    postura = dict(postura, activa=False)
+    get_datos().posturas.guardar(postura)
+    registrar_evento("posturas", "upsert", postura)
+    save_all()
+
+
+def posturas_comprador(user):
+    return [
+        p for p in get_datos().posturas.registros()
+        if p.get("buyer") == user and p.get("activa")
+    ]
+
+
+def ofertas_para_postura(postura):
+    """Ofertas disponibles que ya cumplen la postura (con los índices de facetas)."""
+    minimo, maximo, madurez, origenes = condiciones_postura(postura)
+    return get_datos().offers.filtrar_disponibles(
+        facetas={
+            "calibre": valores_postura(postura.get("calibres")),
+            "madurez": madurez,
+            "origen": origenes,
+        },
+        rangos={
+            "precio": (None, valor_numerico(postura.get("precio_max"))),
+            "toneladas": (minimo, maximo),
+        },
+    )
+
+
+@instrumentar("emparejar_ofertas", filas=lambda n: n)
+def emparejar_ofertas(ofertas, excluir=()):
+    """Avisa a los compradores cuyas posturas aceptan estas ofertas.
+
+    Por oferta se avisa como mucho a AVISOS_POR_OFERTA compradores (los de
+    precio máximo más alto) y cada comprador recibe una sola notificación
+    por llamada. Devuelve el número de coincidencias avisadas.
+    """
+    datos = get_datos()
+    por_comprador = {}
+    for oferta in ofertas:
+        if oferta is None or not oferta_disponible(oferta):
+            continue
+
+        def descartar(comprador, offer_id=oferta["id"]):
+            # Los que ya procesaron la oferta no la ven en su Inicio
+            return comprador in excluir or offer_id in datos.buyer_actions.get(comprador, ())
+
+        for postura in datos.posturas.compatibles(oferta, AVISOS_POR_OFERTA, descartar):
+            por_comprador.setdefault(postura["buyer"], []).append((oferta, postura))
+
+    for comprador, pares in por_comprador.items():
+        if len(pares) == 1:
+            oferta, postura = pares[0]
+            mensaje = (
+                f"La oferta #{oferta['id']} (calibre {oferta.get('calibre') or '—'}, "
+                f"${oferta.get('precio')}) cumple tu postura de compra #{postura['id']}."
+            )
+        else:
+            listado = ", ".join(f"#{o['id']}" for o, _ in pares[:5])
+            if len(pares) > 5:
+                listado += f" y {len(pares) - 5} más"
+            mensaje = f"{len(pares)} ofertas cumplen tus posturas de compra: {listado}."
+        enviar_notificacion(comprador, mensaje)
+    return sum(len(pares) for pares in por_comprador.values())
+
+
+# ============================================================
+#  LOGIN
+# ============================================================
+
+def login_box():
+    st.title("Aguacate Trade")
+    st.subheader("Iniciar sesión")
+
+    with st.form("login_form"):
+        usuario = st.text_input("Usuario")
+        password = st.text_input("Contraseña", type="password")
+        enviar = st.form_submit_button("Entrar")
+
+    if enviar:
+        datos = st.session_state.users.get(usuario)
+        if datos and datos["password"] == password:
+            st.session_state.user = usuario
+            st.session_state.role = datos["role"]
+            st.rerun()
+        else:
+            st.error("Credenciales inválidas")
+
+
+# ============================================================
+#  DESCARGAS CSV
+# ============================================================
+
+def iterar_csv_historial(offer_ids, tamano_bloque=1000):
+    """Genera el CSV del historial de varias ofertas en bloques de filas.
+
+    Evita armar un DataFrame con todo el historial: cada bloque se escribe
+    y se entrega como bytes antes de pasar al siguiente. Quien lo consume
+    decide si los une (st.download_button necesita el archivo completo).
+    """
+    columnas = COLUMNAS["history"]
+    buffer = io.StringIO()
+    escritor = csv.DictWriter(
+        buffer, fieldnames=columnas, extrasaction="ignore", lineterminator="\n"
+    )
+    escritor.writeheader()
+    filas_en_bloque = 0
+
+    for offer_id in offer_ids:
+        for h in historial_de_oferta(offer_id):
+            escritor.writerow(h)
+            filas_en_bloque += 1
+            if filas_en_bloque >= tamano_bloque:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                filas_en_bloque = 0
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+@st.cache_data(max_entries=256)
+def csv_historial_oferta(offer_id, version_historial):
+    """CSV del historial de una oferta, cacheado por (offer_id, versión).
+
+    El historial es solo-anexar, así que su longitud sirve como versión.
+    """
+    return b"".join(iterar_csv_historial([offer_id]))
+
+
+@st.cache_data(max_entries=32)
+def csv_exportacion_total(user, role, version):
+    """CSV con todas las negociaciones del usuario, cacheado por
+    version_negociaciones. Los bloques se unen en memoria porque
+    st.download_button recibe el archivo completo."""
+    return b"".join(iterar_csv_historial(ids_negociaciones(user, role)))
+
+
+def ids_negociaciones_vivas(user, role):
+    """Ofertas (y contraofertas) en memoria cuyo historial pertenece al usuario."""
+    repo = get_datos().offers
+    if role == "buyer":
+        ids = []
+        for c in repo.buscar("buyer", user, "counter"):
+            ids.append(c["parent_offer_id"])
+            ids.append(c["id"])
+        ids.extend(o["id"] for o in repo.buscar("buyer", user, "offer"))
+    else:
+        ids = [o["id"] for o in repo.buscar("producer", user, "offer")]
+        ids.extend(c["id"] for c in repo.buscar("producer", user, "counter"))
+    return ids
+
+
+def ids_negociaciones(user, role):
+    """Ofertas (y contraofertas) cuyo historial pertenece al usuario.
+
+    Incluye las archivadas (solo se llama al preparar la exportación).
+    """
+    ids = ids_negociaciones_vivas(user, role)
+    for o in ofertas_archivadas():
+        if role == "buyer" and o.get("buyer") == user:
+            if o.get("tipo") == "counter":
+                ids.append(o["parent_offer_id"])
+            ids.append(o["id"])
+        elif role != "buyer" and o.get("producer") == user:
+            ids.append(o["id"])
+    return list(dict.fromkeys(ids))
+
+
+def version_negociaciones(user, role):
+    """Versión de la exportación del usuario: solo cambia con sus negociaciones.
+
+    El historial es solo-anexar, así que basta su longitud total en las
+    negociaciones vivas; el archivo solo cambia al archivar (firma_archivo).
+    """
+    datos = get_datos()
+    with datos.lock:
+        ids = set(ids_negociaciones_vivas(user, role))
+        filas = sum(len(datos.historial_por_oferta.get(i, ())) for i in ids)
+    return (len(ids), filas, firma_archivo())
+
+
+# ============================================================
+#  CONSULTAS DE LAS VISTAS
+# ============================================================
+# Todas pasan por consulta_sesion: se recalculan solo cuando cambia la
+# versión de los datos compartidos.
+
+def ofertas_disponibles_comprador(user, filtros=(), orden="recientes"):
+    """Ofertas abiertas que el comprador aún no procesó.
+
+    `filtros` son pares (campo, valores) de las facetas o (campo, (mín, máx))
+    de los rangos (ver filtros_feed). Devuelve (ofertas, claves) en el
+    `orden` de ORDENES_FEED; `claves` sirve para paginar por cursor.
+    """
+    def calcular():
+        # Ocultar ofertas cerradas/aceptadas o ya procesadas por este comprador
+        repo = get_datos().offers
+        filtrados = repo.filtrar_disponibles(
+            facetas={c: v for c, v in filtros if c in repo.FACETAS},
+            rangos={c: v for c, v in filtros if c in repo.RANGOS},
+        )
+        ofertas = [o for o in filtrados if not comprador_ya_proceso_oferta(user, o.get("id"))]
+        clave = ORDENES_FEED[orden][1]
+        ofertas.sort(key=clave)
+        return ofertas, [clave(o) for o in ofertas]
+
+    return consulta_sesion(("inicio_comprador", user, filtros, orden), calcular)
+
+
+def contraofertas_abiertas_productor(user):
+    return consulta_sesion(
+        ("inicio_productor", user),
+        lambda: get_datos().offers.buscar("producer_status", user, "counter", "open"),
+    )
+
+
+def mis_ofertas_productor(user):
+    def calcular():
+        return [
+            o for o in get_datos().offers.buscar("producer", user, "offer")
+            if not o.get("producer_hidden", False)
+        ]
+
+    return consulta_sesion(("mis_ofertas_productor", user), calcular)
+
+
+def mis_contraofertas_comprador(user):
+    return consulta_sesion(
+        ("mis_contras_comprador", user),
+        lambda: get_datos().offers.buscar("buyer", user, "counter"),
+    )
+
+
+def aceptadas_comprador(user):
+    def calcular():
+        return [
+            o for o in get_datos().offers.buscar("buyer", user, "offer")
+            if o.get("status") in ["closed", "accepted"]
+        ]
+
+    return consulta_sesion(("aceptadas_comprador", user), calcular)
+
+
+def aceptadas_archivadas_comprador(user):
+    def calcular():
+        return [
+            o for o in ofertas_archivadas()
+            if o.get("tipo") == "offer" and o.get("buyer") == user
+            and o.get("status") in ["closed", "accepted"]
+        ]
+
+    return consulta_sesion(("aceptadas_archivadas", user), calcular)
+
+
+def ofertas_archivadas_productor(user):
+    return consulta_sesion(
+        ("archivadas_productor", user),
+        lambda: [
+            o for o in ofertas_archivadas()
+            if o.get("tipo") == "offer" and o.get("producer") == user
+        ],
+    )
+
+
+# ============================================================
+#  VISTA COMPACTA (TABLA CON SELECCIÓN DE FILAS)
+# ============================================================
+# En modo compacto cada lista se dibuja como un solo st.dataframe en lugar de
+# una tarjeta con muchos st.write por oferta. Las acciones se aplican a las
+# filas seleccionadas.
+
+COLUMNAS_TABLA_OFERTAS = [
+    "id", "status", "producer", "buyer", "toneladas", "recoleccion",
+    "canastillas", "precio", "calibre", "madurez", "origen", "updated_at",
+]
+COLUMNAS_TABLA_CONTRAOFERTAS = [
+    "id", "parent_offer_id", "status", "producer", "buyer", "toneladas",
+    "recoleccion", "canastillas", "precio", "calibre", "madurez", "origen",
+    "notas", "created_at",
+]
+
+
+def tabla_por_columnas(registros, columnas):
+    """Arma el DataFrame columna por columna (sin un dict intermedio por fila)."""
+    return pd.DataFrame({c: [r.get(c) for r in registros] for c in columnas})
+
+
+def seleccionar_filas(registros, columnas, key):
+    """Muestra la tabla y devuelve los registros de las filas seleccionadas."""
+    # El sufijo permite limpiar la selección después de aplicar una acción
+    sufijo = st.session_state.get(f"sel_{key}", 0)
+    evento = st.dataframe(
+        tabla_por_columnas(registros, columnas),
+        key=f"{key}_{sufijo}",
+        on_select="rerun",
+        selection_mode="multi-row",
+        hide_index=True,
+        use_container_width=True,
+    )
+    return [registros[i] for i in evento.selection.rows if i < len(registros)]
+
+
+def limpiar_seleccion(key):
+    st.session_state[f"sel_{key}"] = st.session_state.get(f"sel_{key}", 0) + 1
+
+
+@st.fragment
+@medir_latencia("tabla_ofertas_comprador")
+def tabla_ofertas_comprador(user):
+    ofertas, _ = ofertas_disponibles_comprador(user, *filtros_feed(user))
+    key = f"tabla_feed_{user}"
+    seleccion = seleccionar_filas(ofertas, COLUMNAS_TABLA_OFERTAS, key)
+    st.caption(f"{len(seleccion)} seleccionada(s) de {len(ofertas)} ofertas.")
+    if not seleccion:
+        return
+
+    c1, c2, c3 = st.columns(3)
+    for col, etiqueta, accion in (
+        (c1, "Me interesa", marcar_interes_lote),
+        (c2, "Aceptar", aceptar_ofertas_lote),
+        (c3, "Rechazar", rechazar_ofertas_lote),
+    ):
+        if col.button(etiqueta, key=f"{key}_{accion.__name__}"):
+            accion(seleccion, user)
+            limpiar_seleccion(key)
+            st.rerun(scope="fragment")
+
+    if len(seleccion) == 1:
+        with st.expander(f"Contraoferta a #{seleccion[0]['id']}", expanded=False):
+            formulario_contraoferta_comprador(seleccion[0], user)
+    else:
+        st.caption("Selecciona una sola oferta para enviar una contraoferta.")
+
+
+@st.fragment
+@medir_latencia("tabla_contraofertas_productor")
+def tabla_contraofertas_productor(user):
+    contraofertas = contraofertas_abiertas_productor(user)
+    key = f"tabla_contras_{user}"
+    seleccion = seleccionar_filas(contraofertas, COLUMNAS_TABLA_CONTRAOFERTAS, key)
+    st.caption(f"{len(seleccion)} seleccionada(s) de {len(contraofertas)} contraofertas.")
+    if not seleccion:
+        return
+
+    c1, c2 = st.columns(2)
+    if c1.button("Aceptar", key=f"{key}_acc"):
+        aceptar_contraofertas_lote(seleccion, user)
+        limpiar_seleccion(key)
+        st.rerun(scope="fragment")
+    if c2.button("Rechazar", key=f"{key}_rej"):
+        rechazar_contraofertas_lote(seleccion, user)
+        limpiar_seleccion(key)
+        st.rerun(scope="fragment")
+
+    if len(seleccion) == 1:
+        c = seleccion[0]
+        oferta_original = get_oferta_por_id(c["parent_offer_id"])
+        with st.expander(f"Contraofertar a #{c['id']}", expanded=False):
+            if oferta_original is None:
+                st.error("No se encontró la oferta original.")
+            else:
+                formulario_contraoferta_productor(c, oferta_original)
+    else:
+        st.caption("Selecciona una sola contraoferta para responder con otra propuesta.")
+
+
+@st.fragment
+def tabla_mis_ofertas_productor(user):
+    ofertas = mis_ofertas_productor(user)
+    key = f"tabla_mis_ofertas_{user}"
+    seleccion = seleccionar_filas(ofertas, COLUMNAS_TABLA_OFERTAS, key)
+    ocultables = [o for o in seleccion if o.get("status") not in ["closed", "accepted"]]
+    if ocultables and st.button(f"Eliminar oferta ({len(ocultables)})", key=f"{key}_del"):
+        for o in ocultables:
+            ocultar_oferta(o, user)
+        limpiar_seleccion(key)
+        st.rerun(scope="fragment")
+
+
+@st.fragment
+def tabla_mis_contraofertas_comprador(user):
+    contraofertas = mis_contraofertas_comprador(user)
+    key = f"tabla_mis_contras_{user}"
+    seleccion = seleccionar_filas(contraofertas, COLUMNAS_TABLA_CONTRAOFERTAS, key)
+    abiertas = [c for c in seleccion if c.get("status") == "open"]
+    if abiertas and st.button(f"Eliminar contraoferta ({len(abiertas)})", key=f"{key}_del"):
+        for c in abiertas:
+            eliminar_contraoferta(c, user)
+        limpiar_seleccion(key)
+        st.rerun(scope="fragment")
+
+
+# ============================================================
+#  ANALÍTICA DE PRECIOS
+# ============================================================
+# Los agregados se calculan por mes de creación de la negociación como
+# parciales (sumas, conteos, mín, máx) que se pueden combinar. Cada mes se
+# recalcula solo cuando cambia su versión (tocar_negociacion) y el archivo
+# solo cuando cambia su firma; el resto sale de la caché.
+
+DIMENSIONES_ANALITICA = ("calibre", "origen", "madurez")
+# Acciones del historial que cuentan como una ronda de contraoferta
+ACCIONES_RONDA = ("contraoferta_comprador", "contraoferta_vendedor")
+
+
+def agregados_parciales(ofertas, historial):
+    """(precios, rondas) parciales de un grupo de negociaciones.
+
+    `ofertas` son ofertas originales y `historial` sus registros. precios
+    tiene una fila por (dimension, valor, mes); rondas, por (mes, rondas) con
+    el número de negocios cerrados con esa cantidad de rondas.
+    """
+    df = pd.DataFrame(ofertas, columns=COLUMNAS["offers"])
+    df["mes"] = (
+        pd.to_datetime(df["created_at"], format="%Y-%m-%d %I:%M %p", errors="coerce")
+        .dt.strftime("%Y-%m")
+        .fillna("sin-fecha")
+    )
+    df["precio"] = pd.to_numeric(df["precio"], errors="coerce")
+    df["aceptada"] = df["status"].isin(["accepted", "closed"])
+
+    partes = []
+    for dimension in DIMENSIONES_ANALITICA + ("total",):
+        claves = ["mes"] if dimension == "total" else ["mes", dimension]
+        grupo = df.groupby(claves, dropna=False).agg(
+            precio_suma=("precio", "sum"),
+            precio_n=("precio", "count"),
+            precio_min=("precio", "min"),
+            precio_max=("precio", "max"),
+            ofertas=("id", "size"),
+            aceptadas=("aceptada", "sum"),
+        ).reset_index()
+        if dimension == "total":
+            grupo["valor"] = "Todas"
+        else:
+            grupo = grupo.rename(columns={dimension: "valor"})
+            # Sin valor (nulo o texto vacío) se agrupa como "—"
+            valor = grupo["valor"].astype(object)
+            grupo["valor"] = valor.where(valor.notna() & (valor.astype(str).str.strip() != ""), "—")
+        grupo["dimension"] = dimension
+        partes.append(grupo)
+    precios = pd.concat(partes, ignore_index=True)
+
+    h = pd.DataFrame(historial, columns=COLUMNAS["history"])
+    rondas_por_oferta = h[h["accion"].isin(ACCIONES_RONDA)].groupby("offer_id").size()
+    cerradas = df[df["aceptada"]]
+    rondas = (
+        pd.DataFrame({
+            "mes": cerradas["mes"],
+            "rondas": cerradas["id"].map(rondas_por_oferta).fillna(0).astype(int),
+        })
+        .groupby(["mes", "rondas"])
+        .size()
+        .reset_index(name="negociaciones")
+    )
+    return precios, rondas
+
+
+def combinar_parciales(parciales):
+    """Suma los parciales de varios grupos y calcula medias y tasas."""
+    if not parciales:
+        return pd.DataFrame(), pd.DataFrame()
+    precios = pd.concat([p for p, _ in parciales], ignore_index=True)
+    precios = precios.groupby(["dimension", "valor", "mes"]).agg(
+        precio_suma=("precio_suma", "sum"),
+        precio_n=("precio_n", "sum"),
+        precio_min=("precio_min", "min"),
+        precio_max=("precio_max", "max"),
+        ofertas=("ofertas", "sum"),
+        aceptadas=("aceptadas", "sum"),
+    ).reset_index()
+    precios["precio_medio"] = precios["precio_suma"] / precios["precio_n"].where(precios["precio_n"] > 0)
+    precios["tasa_aceptacion"] = precios["aceptadas"] / precios["ofertas"]
+    rondas = pd.concat([r for _, r in parciales], ignore_index=True)
+    rondas = rondas.groupby(["mes", "rondas"])["negociaciones"].sum().reset_index()
+    return precios, rondas
+
+
+class CacheAnalitica:
+    """Parciales por mes (y del archivo) compartidos por todas las sesiones."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meses = {}            # mes -> (versión, parciales)
+        self.archivo = (None, None)  # (firma_archivo, parciales)
+        self.combinado = {}        # incluir_archivo -> (firma, resultado)
+        self.recalculados = 0      # meses recalculados (para medir la caché)
+
+    def _parciales_archivo(self):
+        firma = firma_archivo()
+        if self.archivo[0] != firma:
+            ofertas = [o for o in ofertas_archivadas() if o.get("tipo") == "offer"]
+            historial = []
+            for mes, _ in firma:
+                for registros in historial_archivado(mes).values():
+                    historial.extend(registros)
+            self.archivo = (firma, agregados_parciales(ofertas, historial))
+        return firma, self.archivo[1]
+
+    def resultados(self, incluir_archivo=False):
+        """(precios, rondas) combinados; solo se recalculan los meses cambiados."""
+        datos = get_datos()
+        with self.lock:
+            with datos.lock:
+                versiones = {
+                    mes: (datos.generacion, datos.version_mes.get(mes, 0))
+                    for mes, ids in datos.negociaciones_por_mes.items() if ids
+                }
+                filas = {}
+                for mes, version in versiones.items():
+                    if self.meses.get(mes, (None,))[0] == version:
+                        continue
+                    ids = datos.negociaciones_por_mes[mes]
+                    filas[mes] = (
+                        [dict(datos.offers.get(i)) for i in ids if datos.offers.get(i)],
+                        [dict(h) for i in ids for h in datos.historial_por_oferta.get(i, [])],
+                    )
+            for mes, (ofertas, historial) in filas.items():
+                self.meses[mes] = (versiones[mes], agregados_parciales(ofertas, historial))
+                self.recalculados += 1
+            for mes in [m for m in self.meses if m not in versiones]:
+                del self.meses[mes]
+
+            firma = tuple(sorted(versiones.items()))
+            parciales = [p for _, p in self.meses.values()]
+            if incluir_archivo:
+                firma_arch, parcial_arch = self._parciales_archivo()
+                firma = (firma, firma_arch)
+                parciales.append(parcial_arch)
+            guardado = self.combinado.get(incluir_archivo)
+            if guardado is None or guardado[0] != firma:
+                guardado = (firma, combinar_parciales(parciales))
+                self.combinado[incluir_archivo] = guardado
+            return guardado[1]
+
+
+@st.cache_resource
+def get_cache_analitica():
+    return CacheAnalitica()
+
 
-    save_all()
+# ============================================================
+#  VISTAS
+# ============================================================
 
+def mostrar_historial(offer_id, titulo, etiqueta_descarga, nombre_archivo,
+                      sin_registros, key):
+    """Historial de una oferta, cargado solo cuando el usuario lo abre.
 
-def crear_contraoferta_comprador(oferta_original, comprador,
-                                 toneladas, recoleccion, canastillas,
-                                 precio, calibre, madurez, origen, notas):
+    A diferencia de un st.expander (cuyo contenido se ejecuta siempre),
+    el toggle evita buscar el historial y armar la tabla en cada rerun.
     """
-    Crea un registro de contraoferta del comprador.
-    No cierra la oferta original, solo añade una propuesta.
+    if not st.toggle(titulo, key=f"ver_{key}"):
+        return
+
+    registros = historial_de_oferta(offer_id)
+    if registros:
+        df = pd.DataFrame(registros)
+        st.dataframe(df, use_container_width=True)
+        # El CSV se arma una sola vez por versión del historial de la oferta
+        st.download_button(
+            etiqueta_descarga,
+            csv_historial_oferta(offer_id, len(registros)),
+            file_name=nombre_archivo,
+            mime="text/csv",
+            key=key,
+        )
+    else:
+        st.write(sin_registros)
+
+
+def mostrar_exportacion_total(user, role):
+    """Botón para descargar el historial de todas las negociaciones del usuario.
+
+    El archivo solo se genera cuando el usuario lo pide y queda cacheado
+    hasta que cambian las negociaciones del usuario.
     """
-    contra = {
-        "id": generar_id(),
-        "tipo": "counter",
-        "producer": oferta_original["producer"],
-        "buyer": comprador,
-        "parent_offer_id": oferta_original["id"],
-        "toneladas": toneladas,
-        "recoleccion": recoleccion,
-        "canastillas": canastillas,
-        "precio": precio,
+    version = version_negociaciones(user, role)
+    if st.session_state.get(f"exportar_{user}") != version:
+        if st.button("Preparar exportación de todas mis negociaciones", key=f"prep_exp_{user}"):
+            st.session_state[f"exportar_{user}"] = version
+            st.rerun()
+        return
 
-        # NUEVOS CAMPOS DE NEGOCIACIÓN
-        "calibre": calibre,
-        "madurez": madurez,
-        "origen": origen,
+    st.download_button(
+        "Descargar todas mis negociaciones (CSV)",
+        csv_exportacion_total(user, role, version),
+        file_name=f"negociaciones_{user}.csv",
+        mime="text/csv",
+        key=f"csv_total_{user}",
+    )
 
-        "notas": notas,
-        "status": "open",           # open, accepted, rejected, answered, deleted
-        "created_at": ahora(),
-        "updated_at": ahora(),
-    }
-    st.session_state.offers.append(contra)
 
-    # La oferta original sigue "open"
-    oferta_original["status"] = "open"
-    oferta_original["updated_at"] = ahora()
+def mostrar_archivadas(titulo, consultar, key):
+    """Tabla de ofertas archivadas; el archivo solo se lee al activar el toggle."""
+    if not st.toggle(titulo, key=key):
+        return
+    archivadas = consultar()
+    if not archivadas:
+        st.caption("No hay ofertas archivadas.")
+        return
+    st.dataframe(
+        tabla_por_columnas(archivadas, COLUMNAS_TABLA_OFERTAS),
+        hide_index=True,
+        use_container_width=True,
+    )
 
-    registrar_historial(
-        oferta_original["id"],
-        comprador,
-        "contraoferta_comprador",
-        f"El comprador {comprador} envió una contraoferta.",
+
+@medir_latencia("vista_mercado")
+@instrumentar("vista_mercado")
+def vista_mercado():
+    st.subheader("Mercado")
+    incluir = st.toggle("Incluir negociaciones archivadas", key="mercado_archivo")
+    precios, rondas = get_cache_analitica().resultados(incluir)
+    if precios.empty:
+        st.info("Aún no hay ofertas para analizar.")
+        return
+
+    total = precios[precios["dimension"] == "total"]
+    col_ofertas, col_tasa, col_rondas = st.columns(3)
+    col_ofertas.metric("Ofertas", int(total["ofertas"].sum()))
+    col_tasa.metric(
+        "Tasa de aceptación", f"{total['aceptadas'].sum() / total['ofertas'].sum():.0%}"
     )
-    enviar_notificacion(
-        oferta_original["producer"],
-        f"El comprador {comprador} hizo una contraoferta a tu oferta #{oferta_original['id']}.",
+    if not rondas.empty and rondas["negociaciones"].sum():
+        media = (rondas["rondas"] * rondas["negociaciones"]).sum() / rondas["negociaciones"].sum()
+        col_rondas.metric("Rondas de contraoferta por negocio cerrado", f"{media:.1f}")
+
+    dimension = st.selectbox(
+        "Agrupar precios por",
+        DIMENSIONES_ANALITICA,
+        format_func=lambda d: FILTROS_FACETAS[d],
+        key="mercado_dimension",
+    )
+    tabla = precios[precios["dimension"] == dimension]
+    st.line_chart(tabla.pivot_table(index="mes", columns="valor", values="precio_medio"))
+    st.dataframe(
+        tabla[[
+            "mes", "valor", "precio_medio", "precio_min", "precio_max",
+            "ofertas", "tasa_aceptacion",
+        ]].sort_values(["mes", "valor"], ascending=[False, True]),
+        hide_index=True,
+        use_container_width=True,
     )
 
-    # El comprador ya tomó una decisión sobre esta oferta → se oculta para él
-    marcar_oferta_procesada_por_comprador(comprador, oferta_original["id"])
+    if not rondas.empty:
+        st.caption("Negocios cerrados según el número de rondas de contraoferta")
+        st.bar_chart(rondas.groupby("rondas")["negociaciones"].sum())
 
-    save_all()
 
+def mostrar_latencias():
+    """Última duración medida de la app completa y de cada fragmento."""
+    latencias = st.session_state.get("latencias")
+    if not latencias:
+        return
+    with st.sidebar.expander("Latencia de la última ejecución"):
+        for seccion, ms in sorted(latencias.items()):
+            st.caption(f"{seccion}: {ms:.1f} ms")
 
-def contraoferta_vendedor_actualizar(oferta_original, contraoferta,
-                                     toneladas, recoleccion, canastillas,
-                                     precio, calibre, madurez, origen, notas):
-    """
-    El productor responde a la contraoferta del comprador.
-    En lugar de crear una oferta nueva, actualiza los datos de la oferta original
-    y marca la contraoferta como respondida.
-    """
-    # Actualizar la oferta original con los nuevos datos
-    oferta_original["toneladas"] = toneladas
-    oferta_original["recoleccion"] = recoleccion
-    oferta_original["canastillas"] = canastillas
-    oferta_original["precio"] = precio
 
-    # NUEVOS CAMPOS DE NEGOCIACIÓN (se actualizan también)
-    oferta_original["calibre"] = calibre
-    oferta_original["madurez"] = madurez
-    oferta_original["origen"] = origen
+def mostrar_cola_escritura():
+    """Profundidad de la cola y latencia de escritura (para ajustar los lotes)."""
+    if not ESCRITURA_DIFERIDA:
+        return
+    cola = get_cola_escritura()
+    m = cola.metricas
+    with st.sidebar.expander("Escritura diferida"):
+        st.caption(f"En cola: {cola.profundidad()} eventos")
+        st.caption(
+            f"Lotes escritos: {m['lotes']} "
+            f"({m['eventos']} eventos, {m['eventos_escritos']} tras fusionar)"
+        )
+        if m["lotes"]:
+            st.caption(
+                f"Escritura: última {m['ms_ultimo']:.1f} ms · "
+                f"media {m['ms_total'] / m['lotes']:.1f} ms · máx {m['ms_max']:.1f} ms"
+            )
+        if m["errores"]:
+            st.caption(f"Errores: {m['errores']} (último: {m['ultimo_error']})")
 
-    if notas is not None:
-        oferta_original["notas"] = notas
 
-    oferta_original["status"] = "open"
-    oferta_original["updated_at"] = ahora()
+def canales_sesion(user, role):
+    return (f"user:{user}", f"role:{role}")
 
-    # Marcar la contraoferta como respondida
-    contraoferta["status"] = "answered"
-    contraoferta["updated_at"] = ahora()
 
-    registrar_historial(
-        oferta_original["id"],
-        oferta_original["producer"],
-        "contraoferta_vendedor",
-        f"El productor envió una contraoferta al comprador {contraoferta['buyer']}.",
+def marcar_feed_al_dia():
+    """La página se está dibujando completa: ya ve todos los cambios hasta ahora."""
+    st.session_state["feed_secuencia"] = get_datos().cambios.secuencia
+    st.session_state["feed_pendientes"] = set()
+
+
+@st.fragment(run_every=FEED_CADA_SEGUNDOS or None)
+def vigilar_cambios(user, role):
+    """Consulta periódica del feed de cambios de la sesión.
+
+    Solo se vuelve a ejecutar este fragmento: dibuja el contador de
+    notificaciones sin leer y, si otras sesiones cambiaron ofertas que esta
+    sesión ve, ofrece actualizar la página. Los cambios de la propia sesión
+    se ignoran (sus fragmentos ya se actualizaron al hacerlos).
+    """
+    sincronizar_si_hace_falta()
+    datos = get_datos()
+    vista = st.session_state.get("feed_secuencia", 0)
+    if datos.cambios.secuencia != vista:
+        with datos.lock:
+            actual, cambios = datos.cambios.desde(
+                canales_sesion(user, role), vista, excluir_origen=sesion_actual()
+            )
+        st.session_state["feed_secuencia"] = actual
+        if cambios is None:
+            # Se descartaron cambios o se recargó todo: no se sabe cuáles
+            st.session_state["feed_pendientes"] = None
+        else:
+            nuevas = sum(1 for _, tipo, _, _ in cambios if tipo == "notificacion")
+            if nuevas:
+                st.toast(f"Tienes {nuevas} notificación(es) nueva(s).")
+            pendientes = st.session_state.get("feed_pendientes", set())
+            if pendientes is not None:
+                pendientes.update(i for _, tipo, i, _ in cambios if tipo == "oferta")
+                st.session_state["feed_pendientes"] = pendientes
+
+    # Contador de no leídas (con bisect sobre las bandejas: no recorre nada)
+    no_leidas = consulta_sesion(
+        ("no_leidas", user), lambda: contar_no_leidas(user, role)
+    )
+    col_notis, col_feed = st.columns(2)
+    col_notis.caption(
+        f"🔔 {no_leidas} notificación(es) sin leer" if no_leidas
+        else "🔔 Sin notificaciones nuevas"
     )
+    pendientes = st.session_state.get("feed_pendientes", set())
+    if pendientes is None or pendientes:
+        texto = (
+            "Hubo cambios en las ofertas" if pendientes is None
+            else f"{len(pendientes)} oferta(s) con cambios"
+        )
+        if col_feed.button(f"🔄 {texto} · Actualizar", key=f"feed_actualizar_{user}"):
+            st.rerun()
 
-    enviar_notificacion(
-        contraoferta["buyer"],
-        f"El productor {oferta_original['producer']} envió una contraoferta "
-        f"sobre la oferta #{oferta_original['id']}.",
+
+@medir_latencia("vista_inicio_comprador")
+@instrumentar("vista_inicio_comprador")
+def vista_inicio_comprador(user):
+    st.subheader("Ofertas disponibles")
+
+    filtros_inicio_comprador(user)
+    filtros, orden = filtros_feed(user)
+    # Al cambiar los filtros se vuelve a la primera página
+    clave_cursores = f"cursores_feed_{user}"
+    cursores = st.session_state.setdefault(clave_cursores, [])
+    if st.session_state.get(f"firma_feed_{user}") != (filtros, orden):
+        st.session_state[f"firma_feed_{user}"] = (filtros, orden)
+        cursores.clear()
+        olvidar_consultas("inicio_comprador")
+
+    ordenadas, claves = ofertas_disponibles_comprador(user, filtros, orden)
+
+    if not ordenadas:
+        if filtros:
+            st.info("Ninguna oferta coincide con los filtros.")
+        else:
+            st.info("No hay ofertas disponibles por ahora.")
+        return
+
+    if st.session_state.get("modo_compacto"):
+        tabla_ofertas_comprador(user)
+        return
+
+    # Paginación por cursor: solo la ventana visible crea widgets
+    pagina, cursor_siguiente = pagina_por_cursor(
+        ordenadas, claves, cursores[-1] if cursores else None, TAMANO_PAGINA_FEED
     )
+    if not pagina and cursores:
+        # La página actual quedó vacía (p. ej. se procesaron sus ofertas)
+        cursores.pop()
+        st.rerun()
 
-    # Permitir que el comprador vuelva a ver la oferta actualizada en su Inicio
-    limpiar_accion_comprador(contraoferta["buyer"], oferta_original["id"])
+    st.caption(
+        f"Mostrando {len(pagina)} de {len(ordenadas)} ofertas · página {len(cursores) + 1}"
+    )
 
-    save_all()
+    acciones_en_lote(
+        pagina, user, f"lote_feed_{user}",
+        lambda o: f"#{o['id']} · {o.get('producer')} · ${o.get('precio')}",
+        [("Me interesa", marcar_interes_lote), ("Rechazar", rechazar_ofertas_lote)],
+    )
 
+    for o in pagina:
+        tarjeta_oferta_comprador(o, user)
 
-# ============================================================
-#  LOGIN
-# ============================================================
+    col_ant, col_sig = st.columns(2)
+    if cursores and col_ant.button("← Más recientes", key=f"feed_prev_{user}"):
+        cursores.pop()
+        st.rerun()
+    if cursor_siguiente is not None and col_sig.button(
+        "Más antiguas →", key=f"feed_next_{user}"
+    ):
+        cursores.append(cursor_siguiente)
+        st.rerun()
 
-def login_box():
-    st.title("Aguacate Trade")
-    st.subheader("Iniciar sesión")
 
-    with st.form("login_form"):
-        usuario = st.text_input("Usuario")
-        password = st.text_input("Contraseña", type="password")
-        enviar = st.form_submit_button("Entrar")
+# Filtros del Inicio del comprador: campo -> etiqueta
+FILTROS_FACETAS = {
+    "calibre": "Calibre",
+    "madurez": "Grado de madurez",
+    "origen": "Origen",
+    "producer": "Productor",
+}
+FILTROS_RANGOS = {
+    "precio": "Precio",
+    "toneladas": "Toneladas",
+}
 
-    if enviar:
-        datos = st.session_state.users.get(usuario)
-        if datos and datos["password"] == password:
-            st.session_state.user = usuario
-            st.session_state.role = datos["role"]
-            st.rerun()
-        else:
-            st.error("Credenciales inválidas")
 
+def filtros_feed(user):
+    """(filtros, orden) elegidos en los widgets de filtros_inicio_comprador.
 
-# ============================================================
-#  VISTAS
-# ============================================================
+    Los filtros son una tupla ordenada (se usa como clave de caché) con solo
+    los campos que tienen algún valor.
+    """
+    estado = st.session_state
+    filtros = []
+    for campo in FILTROS_FACETAS:
+        valores = estado.get(f"filtro_{campo}_{user}")
+        if valores:
+            filtros.append((campo, tuple(sorted(valores))))
+    for campo in FILTROS_RANGOS:
+        minimo = estado.get(f"filtro_{campo}_min_{user}")
+        maximo = estado.get(f"filtro_{campo}_max_{user}")
+        if minimo is not None or maximo is not None:
+            filtros.append((campo, (minimo, maximo)))
+    return tuple(filtros), estado.get(f"orden_feed_{user}", "recientes")
+
+
+def filtros_inicio_comprador(user):
+    """Widgets de filtros y orden; las opciones salen de los índices de facetas."""
+    datos = get_datos()
+    with st.expander("Filtros y orden"):
+        columnas = st.columns(len(FILTROS_FACETAS))
+        for col, (campo, etiqueta) in zip(columnas, FILTROS_FACETAS.items()):
+            key = f"filtro_{campo}_{user}"
+            with datos.lock:
+                valores = datos.offers.valores_faceta(campo)
+            # Lo ya elegido sigue como opción aunque ya no queden ofertas con
+            # ese valor. Las opciones no llevan conteos: si cambiaran con cada
+            # oferta nueva, Streamlit reiniciaría la selección.
+            opciones = sorted(
+                {v for v in valores if v is not None} | set(st.session_state.get(key, [])),
+                key=str,
+            )
+            col.multiselect(etiqueta, opciones, key=key)
+
+        columnas = st.columns(len(FILTROS_RANGOS) * 2)
+        extremos = []
+        for i, (campo, etiqueta) in enumerate(FILTROS_RANGOS.items()):
+            columnas[2 * i].number_input(
+                f"{etiqueta} mínimo", min_value=0.0, value=None,
+                key=f"filtro_{campo}_min_{user}",
+            )
+            columnas[2 * i + 1].number_input(
+                f"{etiqueta} máximo", min_value=0.0, value=None,
+                key=f"filtro_{campo}_max_{user}",
+            )
+            with datos.lock:
+                minimo, maximo = datos.offers.extremos_rango(campo)
+            if minimo is not None:
+                extremos.append(f"{etiqueta}: {minimo:g} – {maximo:g}")
+        if extremos:
+            st.caption("Disponibles · " + " · ".join(extremos))
+
+        st.selectbox(
+            "Ordenar por",
+            list(ORDENES_FEED),
+            format_func=lambda orden: ORDENES_FEED[orden][0],
+            key=f"orden_feed_{user}",
+        )
+
+
+def acciones_en_lote(registros, user, key, etiqueta, acciones):
+    """Selector de varios registros y botones que los procesan de una vez.
+
+    `acciones` es una lista de (texto del botón, función *_lote). Se guarda
+    una sola vez y se vuelve a ejecutar la página una sola vez por lote.
+    """
+    aviso = st.session_state.pop(f"{key}_aviso", None)
+    if aviso:
+        st.success(aviso)
+
+    with st.expander("Acciones en lote"):
+        por_id = {r["id"]: r for r in registros}
+        elegidos = st.multiselect(
+            "Selecciona varias",
+            list(por_id),
+            format_func=lambda i: etiqueta(por_id[i]),
+            key=f"{key}_sel",
+        )
+        columnas = st.columns(len(acciones))
+        for col, (texto, accion) in zip(columnas, acciones):
+            if col.button(f"{texto} ({len(elegidos)})", key=f"{key}_{accion.__name__}",
+                          disabled=not elegidos):
+                seleccion = [por_id[i] for i in elegidos if i in por_id]
+                aplicadas = accion(seleccion, user)
+                st.session_state[f"{key}_aviso"] = (
+                    f"{texto}: {aplicadas} de {len(seleccion)} aplicadas."
+                )
+                del st.session_state[f"{key}_sel"]
+                st.rerun()
 
-def vista_inicio_comprador(user):
-    st.subheader("Ofertas disponibles")
 
-    # Ocultar ofertas cerradas/aceptadas o ya procesadas por este comprador
-    ofertas_disponibles = []
-    for o in st.session_state.offers:
-        if (
-            o.get("tipo") == "offer"
-            and o.get("status") not in ["closed", "accepted"]
-            and not comprador_ya_proceso_oferta(user, o.get("id"))
-        ):
-            ofertas_disponibles.append(o)
+@st.fragment
+@medir_latencia("tarjeta_oferta_comprador")
+def tarjeta_oferta_comprador(o, user):
+    """Tarjeta de una oferta en el Inicio del comprador.
 
-    if not ofertas_disponibles:
-        st.info("No hay ofertas disponibles por ahora.")
+    Es un fragmento: sus botones solo vuelven a ejecutar esta tarjeta.
+    """
+    if comprador_ya_proceso_oferta(user, o["id"]) or o.get("status") in ["closed", "accepted"]:
+        # La acción ya se aplicó; la tarjeta desaparece en el próximo rerun completo
+        st.success(f"Oferta #{o['id']} procesada.")
         return
 
-    for o in ofertas_disponibles:
-        with st.container(border=True):
-            st.markdown(f"**Oferta #{o['id']} — {o.get('status','open')}**")
-            st.write(f"Productor: **{o.get('producer','—')}**")
-            st.write(f"Toneladas: {o.get('toneladas','—')}")
-            st.write(f"Días de recolección: {o.get('recoleccion','—')}")
-            st.write(f"Canastillas: {o.get('canastillas','—')}")
-            st.write(f"Precio: {o.get('precio','—')}")
-            st.write(f"Calibre: {o.get('calibre','—')}")
-            st.write(f"Grado de madurez: {o.get('madurez','—')}")
-            st.write(f"Origen: {o.get('origen','—')}")
-            if o.get("notas"):
-                st.write(f"Notas: {o['notas']}")
-
-            c1, c2, c3, c4 = st.columns(4)
-
-            # Me interesa (YA NO OCULTA LA OFERTA)
-            if c1.button("Me interesa", key=f"int_{o['id']}_{user}"):
-                registrar_historial(
-                    o["id"],
-                    user,
-                    "interes",
-                    f"El comprador {user} marcó interés en la oferta.",
-                )
-                enviar_notificacion(
-                    o["producer"],
-                    f"El comprador {user} marcó interés en tu oferta #{o['id']}.",
-                )
-                save_all()
+    with st.container(border=True):
+        st.markdown(f"**Oferta #{o['id']} — {o.get('status','open')}**")
+        st.write(f"Productor: **{o.get('producer','—')}**")
+        st.write(f"Toneladas: {o.get('toneladas','—')}")
+        st.write(f"Días de recolección: {o.get('recoleccion','—')}")
+        st.write(f"Canastillas: {o.get('canastillas','—')}")
+        st.write(f"Precio: {o.get('precio','—')}")
+        st.write(f"Calibre: {o.get('calibre','—')}")
+        st.write(f"Grado de madurez: {o.get('madurez','—')}")
+        st.write(f"Origen: {o.get('origen','—')}")
+        if o.get("notas"):
+            st.write(f"Notas: {o['notas']}")
+
+        c1, c2, c3, c4 = st.columns(4)
+
+        # Me interesa (YA NO OCULTA LA OFERTA)
+        if c1.button("Me interesa", key=f"int_{o['id']}_{user}"):
+            if marcar_interes(o, user):
                 st.success("Interés registrado. (La oferta sigue visible en Inicio).")
-                st.rerun()
+                st.rerun(scope="fragment")
+            else:
+                st.error("Esta oferta ya no está disponible: otro comprador la aceptó o se cerró.")
 
-            # Aceptar oferta directa
-            if c2.button("Aceptar", key=f"acc_{o['id']}_{user}"):
-                o["status"] = "accepted"
-                o["buyer"] = user
-                o["updated_at"] = ahora()
-                registrar_historial(
-                    o["id"],
-                    user,
-                    "aceptar_oferta",
-                    f"El comprador {user} aceptó la oferta.",
-                )
-                enviar_notificacion(
-                    o["producer"],
-                    f"El comprador {user} aceptó tu oferta #{o['id']}.",
-                )
-                marcar_oferta_procesada_por_comprador(user, o["id"])
-                save_all()
+        # Aceptar oferta directa
+        if c2.button("Aceptar", key=f"acc_{o['id']}_{user}"):
+            if aceptar_oferta(o, user):
                 st.success("Oferta aceptada. Negocio cerrado.")
-                st.rerun()
+                st.rerun(scope="fragment")
+            else:
+                st.error("Esta oferta ya no está disponible: otro comprador la aceptó o se cerró.")
 
-            # Rechazar oferta
-            if c3.button("Rechazar", key=f"rej_offer_{o['id']}_{user}"):
-                registrar_historial(
-                    o["id"],
-                    user,
-                    "rechazar_oferta",
-                    f"El comprador {user} rechazó la oferta.",
-                )
-                enviar_notificacion(
-                    o["producer"],
-                    f"El comprador {user} rechazó tu oferta #{o['id']}.",
-                )
-                marcar_oferta_procesada_por_comprador(user, o["id"])
-                save_all()
+        # Rechazar oferta
+        if c3.button("Rechazar", key=f"rej_offer_{o['id']}_{user}"):
+            if rechazar_oferta(o, user):
                 st.warning(
                     "Has rechazado esta oferta. (Sigue disponible para otros compradores)."
                 )
-                st.rerun()
-
-            # Contraoferta del comprador
-            with c4.expander("Contraoferta", expanded=False):
-                with st.form(f"form_counter_{o['id']}_{user}"):
-                    toneladas = st.number_input(
-                        "Toneladas",
-                        min_value=0.0,
-                        value=float(o.get("toneladas", 0.0)),
-                        step=1.0,
-                        key=f"ton_c_{o['id']}_{user}",
-                    )
-                    reco = st.text_input(
-                        "Días de recolección",
-                        value=o.get("recoleccion", ""),
-                        key=f"reco_c_{o['id']}_{user}",
-                    )
-                    can = st.text_input(
-                        "Canastillas",
-                        value=o.get("canastillas", ""),
-                        key=f"can_c_{o['id']}_{user}",
-                    )
-                    precio = st.number_input(
-                        "Precio",
-                        min_value=0.0,
-                        value=float(o.get("precio", 0.0)),
-                        step=1.0,
-                        key=f"pre_c_{o['id']}_{user}",
-                    )
-
-                    # NUEVOS CAMPOS
-                    calibre = st.text_input(
-                        "Calibre",
-                        value=o.get("calibre", "") or "",
-                        key=f"cal_c_{o['id']}_{user}",
-                    )
-                    madurez = st.text_input(
-                        "Grado de madurez",
-                        value=o.get("madurez", "") or "",
-                        key=f"mad_c_{o['id']}_{user}",
-                    )
-                    origen = st.text_input(
-                        "Origen",
-                        value=o.get("origen", "") or "",
-                        key=f"ori_c_{o['id']}_{user}",
-                    )
-
-                    notas = st.text_area(
-                        "Notas para el productor",
-                        value=f"Contraoferta del comprador {user}",
-                        key=f"not_c_{o['id']}_{user}",
-                    )
-                    enviar = st.form_submit_button("Enviar contraoferta")
-
-                    if enviar:
-                        crear_contraoferta_comprador(
-                            o, user, toneladas, reco, can, precio,
-                            calibre, madurez, origen, notas
-                        )
-                        st.success("Contraoferta enviada al productor.")
-                        st.rerun()
+                st.rerun(scope="fragment")
+            else:
+                st.error("Esta oferta ya no está disponible: otro comprador la aceptó o se cerró.")
+
+        # Contraoferta del comprador
+        with c4.expander("Contraoferta", expanded=False):
+            formulario_contraoferta_comprador(o, user)
+
+
+def formulario_contraoferta_comprador(o, user):
+    with st.form(f"form_counter_{o['id']}_{user}"):
+        toneladas = st.number_input(
+            "Toneladas",
+            min_value=0.0,
+            value=float(o.get("toneladas", 0.0)),
+            step=1.0,
+            key=f"ton_c_{o['id']}_{user}",
+        )
+        reco = st.text_input(
+            "Días de recolección",
+            value=o.get("recoleccion", ""),
+            key=f"reco_c_{o['id']}_{user}",
+        )
+        can = st.text_input(
+            "Canastillas",
+            value=o.get("canastillas", ""),
+            key=f"can_c_{o['id']}_{user}",
+        )
+        precio = st.number_input(
+            "Precio",
+            min_value=0.0,
+            value=float(o.get("precio", 0.0)),
+            step=1.0,
+            key=f"pre_c_{o['id']}_{user}",
+        )
 
+        # NUEVOS CAMPOS
+        calibre = st.text_input(
+            "Calibre",
+            value=o.get("calibre", "") or "",
+            key=f"cal_c_{o['id']}_{user}",
+        )
+        madurez = st.text_input(
+            "Grado de madurez",
+            value=o.get("madurez", "") or "",
+            key=f"mad_c_{o['id']}_{user}",
+        )
+        origen = st.text_input(
+            "Origen",
+            value=o.get("origen", "") or "",
+            key=f"ori_c_{o['id']}_{user}",
+        )
+
+        notas = st.text_area(
+            "Notas para el productor",
+            value=f"Contraoferta del comprador {user}",
+            key=f"not_c_{o['id']}_{user}",
+        )
+        enviar = st.form_submit_button("Enviar contraoferta")
 
+        if enviar:
+            if crear_contraoferta_comprador(
+                o, user, toneladas, reco, can, precio,
+                calibre, madurez, origen, notas
+            ):
+                st.success("Contraoferta enviada al productor.")
+                st.rerun(scope="fragment")
+            else:
+                st.error("Esta oferta ya no está disponible: otro comprador la aceptó o se cerró.")
+
+
+@medir_latencia("vista_inicio_productor")
+@instrumentar("vista_inicio_productor")
 def vista_inicio_productor(user):
     st.subheader("Contraofertas recibidas")
 
     # Solo contraofertas abiertas del productor
-    contraofertas = []
-    for c in st.session_state.offers:
-        if c.get("tipo") == "counter" and c.get("producer") == user and c.get("status") == "open":
-            contraofertas.append(c)
+    contraofertas = contraofertas_abiertas_productor(user)
 
     if not contraofertas:
         st.info("No tienes contraofertas por ahora.")
         return
 
+    if st.session_state.get("modo_compacto"):
+        tabla_contraofertas_productor(user)
+        return
+
+    acciones_en_lote(
+        contraofertas, user, f"lote_contras_{user}",
+        lambda c: f"#{c['id']} · {c.get('buyer')} · ${c.get('precio')} (oferta #{c['parent_offer_id']})",
+        [("Aceptar", aceptar_contraofertas_lote), ("Rechazar", rechazar_contraofertas_lote)],
+    )
+
     for c in contraofertas:
-        oferta_original = get_oferta_por_id(c["parent_offer_id"])
+        tarjeta_contraoferta_productor(c, user)
 
-        with st.container(border=True):
-            st.markdown(f"**Contraoferta #{c['id']}** sobre oferta #{c['parent_offer_id']}")
-            st.write(f"Comprador: **{c.get('buyer','—')}**")
-            st.write(f"Toneladas: {c.get('toneladas','—')}")
-            st.write(f"Días de recolección: {c.get('recoleccion','—')}")
-            st.write(f"Canastillas: {c.get('canastillas','—')}")
-            st.write(f"Precio: {c.get('precio','—')}")
-            st.write(f"Calibre: {c.get('calibre','—')}")
-            st.write(f"Grado de madurez: {c.get('madurez','—')}")
-            st.write(f"Origen: {c.get('origen','—')}")
-            if c.get("notas"):
-                st.write(f"Notas: {c['notas']}")
-
-            col1, col2, col3 = st.columns(3)
-
-            # ACEPTAR
-            if col1.button("Aceptar", key=f"acc_c_{c['id']}"):
-                c["status"] = "accepted"
-                c["updated_at"] = ahora()
-
-                if oferta_original:
-                    oferta_original["status"] = "closed"
-                    oferta_original["buyer"] = c["buyer"]
-                    oferta_original["updated_at"] = ahora()
-
-                registrar_historial(
-                    c["id"],
-                    user,
-                    "aceptar_contraoferta",
-                    f"El productor aceptó la contraoferta de {c['buyer']}.",
-                )
-                enviar_notificacion(
-                    c["buyer"],
-                    f"El productor aceptó tu contraoferta #{c['id']}.",
-                )
-                save_all()
+
+@st.fragment
+@medir_latencia("tarjeta_contraoferta_productor")
+def tarjeta_contraoferta_productor(c, user):
+    """Tarjeta de una contraoferta recibida en el Inicio del productor.
+
+    Es un fragmento: sus botones solo vuelven a ejecutar esta tarjeta.
+    """
+    if c.get("status") != "open":
+        st.success(f"Contraoferta #{c['id']}: {c.get('status')}.")
+        return
+
+    oferta_original = get_oferta_por_id(c["parent_offer_id"])
+
+    with st.container(border=True):
+        st.markdown(f"**Contraoferta #{c['id']}** sobre oferta #{c['parent_offer_id']}")
+        st.write(f"Comprador: **{c.get('buyer','—')}**")
+        st.write(f"Toneladas: {c.get('toneladas','—')}")
+        st.write(f"Días de recolección: {c.get('recoleccion','—')}")
+        st.write(f"Canastillas: {c.get('canastillas','—')}")
+        st.write(f"Precio: {c.get('precio','—')}")
+        st.write(f"Calibre: {c.get('calibre','—')}")
+        st.write(f"Grado de madurez: {c.get('madurez','—')}")
+        st.write(f"Origen: {c.get('origen','—')}")
+        if c.get("notas"):
+            st.write(f"Notas: {c['notas']}")
+
+        col1, col2, col3 = st.columns(3)
+
+        # ACEPTAR
+        if col1.button("Aceptar", key=f"acc_c_{c['id']}"):
+            if aceptar_contraoferta(c, oferta_original, user):
                 st.success("Contraoferta aceptada. Negocio cerrado.")
-                st.rerun()
+                st.rerun(scope="fragment")
+            else:
+                st.error("No se pudo aceptar: la contraoferta ya no está abierta o la oferta ya se vendió.")
 
-            # RECHAZAR
-            if col2.button("Rechazar", key=f"rej_c_{c['id']}"):
-                c["status"] = "rejected"
-                c["updated_at"] = ahora()
-                registrar_historial(
-                    c["id"],
-                    user,
-                    "rechazar_contraoferta",
-                    f"El productor rechazó la contraoferta de {c['buyer']}.",
-                )
-                enviar_notificacion(
-                    c["buyer"],
-                    f"El productor rechazó tu contraoferta #{c['id']}.",
-                )
-                save_all()
+        # RECHAZAR
+        if col2.button("Rechazar", key=f"rej_c_{c['id']}"):
+            if rechazar_contraoferta(c, user):
                 st.warning("Contraoferta rechazada.")
-                st.rerun()
-
-            # CONTRAOFERTAR (PRODUCTOR) – actualiza la oferta original
-            with col3.expander("Contraofertar", expanded=False):
-                st.caption(
-                    "Enviar nueva propuesta al comprador (se actualiza la oferta original)."
-                )
-                if oferta_original is None:
-                    st.error("No se encontró la oferta original.")
-                else:
-                    with st.form(f"form_contra_prod_{c['id']}"):
-                        toneladas = st.number_input(
-                            "Toneladas",
-                            min_value=0.0,
-                            value=float(oferta_original.get("toneladas", 0.0)),
-                            step=1.0,
-                            key=f"ton_p_{c['id']}",
-                        )
-                        reco = st.text_input(
-                            "Días de recolección",
-                            value=oferta_original.get("recoleccion", ""),
-                            key=f"reco_p_{c['id']}",
-                        )
-                        can = st.text_input(
-                            "Canastillas",
-                            value=oferta_original.get("canastillas", ""),
-                            key=f"can_p_{c['id']}",
-                        )
-                        precio = st.number_input(
-                            "Precio",
-                            min_value=0.0,
-                            value=float(oferta_original.get("precio", 0.0)),
-                            step=1.0,
-                            key=f"pre_p_{c['id']}",
-                        )
-
-                        # NUEVOS CAMPOS
-                        calibre = st.text_input(
-                            "Calibre",
-                            value=oferta_original.get("calibre", "") or "",
-                            key=f"cal_p_{c['id']}",
-                        )
-                        madurez = st.text_input(
-                            "Grado de madurez",
-                            value=oferta_original.get("madurez", "") or "",
-                            key=f"mad_p_{c['id']}",
-                        )
-                        origen = st.text_input(
-                            "Origen",
-                            value=oferta_original.get("origen", "") or "",
-                            key=f"ori_p_{c['id']}",
-                        )
-
-                        notas = st.text_area(
-                            "Notas (opcional)",
-                            value=oferta_original.get("notas", ""),
-                            key=f"not_p_{c['id']}",
-                        )
-                        enviar = st.form_submit_button("Enviar contraoferta")
-
-                        if enviar:
-                            contraoferta_vendedor_actualizar(
-                                oferta_original,
-                                c,
-                                toneladas,
-                                reco,
-                                can,
-                                precio,
-                                calibre,
-                                madurez,
-                                origen,
-                                notas,
-                            )
-                            st.success("Se envió una nueva propuesta al comprador.")
-                            st.rerun()
+                st.rerun(scope="fragment")
+            else:
+                st.error("Esta contraoferta ya no está abierta.")
+
+        # CONTRAOFERTAR (PRODUCTOR) – actualiza la oferta original
+        with col3.expander("Contraofertar", expanded=False):
+            st.caption(
+                "Enviar nueva propuesta al comprador (se actualiza la oferta original)."
+            )
+            if oferta_original is None:
+                st.error("No se encontró la oferta original.")
+            else:
+                formulario_contraoferta_productor(c, oferta_original)
+
+
+def formulario_contraoferta_productor(c, oferta_original):
+    with st.form(f"form_contra_prod_{c['id']}"):
+        toneladas = st.number_input(
+            "Toneladas",
+            min_value=0.0,
+            value=float(oferta_original.get("toneladas", 0.0)),
+            step=1.0,
+            key=f"ton_p_{c['id']}",
+        )
+        reco = st.text_input(
+            "Días de recolección",
+            value=oferta_original.get("recoleccion", ""),
+            key=f"reco_p_{c['id']}",
+        )
+        can = st.text_input(
+            "Canastillas",
+            value=oferta_original.get("canastillas", ""),
+            key=f"can_p_{c['id']}",
+        )
+        precio = st.number_input(
+            "Precio",
+            min_value=0.0,
+            value=float(oferta_original.get("precio", 0.0)),
+            step=1.0,
+            key=f"pre_p_{c['id']}",
+        )
 
+        # NUEVOS CAMPOS
+        calibre = st.text_input(
+            "Calibre",
+            value=oferta_original.get("calibre", "") or "",
+            key=f"cal_p_{c['id']}",
+        )
+        madurez = st.text_input(
+            "Grado de madurez",
+            value=oferta_original.get("madurez", "") or "",
+            key=f"mad_p_{c['id']}",
+        )
+        origen = st.text_input(
+            "Origen",
+            value=oferta_original.get("origen", "") or "",
+            key=f"ori_p_{c['id']}",
+        )
+
+        notas = st.text_area(
+            "Notas (opcional)",
+            value=oferta_original.get("notas", ""),
+            key=f"not_p_{c['id']}",
+        )
+        enviar = st.form_submit_button("Enviar contraoferta")
 
+        if enviar:
+            if contraoferta_vendedor_actualizar(
+                oferta_original,
+                c,
+                toneladas,
+                reco,
+                can,
+                precio,
+                calibre,
+                madurez,
+                origen,
+                notas,
+            ):
+                st.success("Se envió una nueva propuesta al comprador.")
+                st.rerun(scope="fragment")
+            else:
+                st.error("No se pudo enviar: la oferta ya se vendió o la contraoferta ya no está abierta.")
+
+
+@medir_latencia("vista_mis_ofertas_productor")
+@instrumentar("vista_mis_ofertas_productor")
 def vista_mis_ofertas_productor(user):
     st.subheader("Mis ofertas (productor)")
+    mostrar_exportacion_total(user, "producer")
 
-    mis_ofertas = []
-    for o in st.session_state.offers:
-        if o.get("producer") == user and o.get("tipo") == "offer" and not o.get("producer_hidden", False):
-            mis_ofertas.append(o)
+    mis_ofertas = mis_ofertas_productor(user)
 
     if not mis_ofertas:
         st.info("Aún no has creado ofertas (o las ocultaste).")
+    elif st.session_state.get("modo_compacto"):
+        tabla_mis_ofertas_productor(user)
     else:
         for o in mis_ofertas:
-            with st.container(border=True):
-                st.markdown(f"**Oferta #{o['id']} — {o.get('status','open')}**")
-                st.write(f"Comprador final: {o['buyer'] if o.get('buyer') else '—'}")
-                st.write(f"Toneladas: {o.get('toneladas','—')}")
-                st.write(f"Días de recolección: {o.get('recoleccion','—')}")
-                st.write(f"Canastillas: {o.get('canastillas','—')}")
-                st.write(f"Precio: {o.get('precio','—')}")
-                st.write(f"Calibre: {o.get('calibre','—')}")
-                st.write(f"Grado de madurez: {o.get('madurez','—')}")
-                st.write(f"Origen: {o.get('origen','—')}")
-                st.write(f"Creada: {o.get('created_at','—')} · Actualizada: {o.get('updated_at','—')}")
-
-                # OCULTAR (en vez de eliminar definitivamente)
-                if o.get("status") not in ["closed", "accepted"]:
-                    if st.button("Eliminar oferta", key=f"del_{o['id']}"):
-                        o["producer_hidden"] = True
-                        o["updated_at"] = ahora()
-                        registrar_historial(
-                            o["id"],
-                            user,
-                            "ocultar_oferta",
-                            "El productor ocultó la oferta (sigue visible en Inicio para compradores).",
-                        )
-                        save_all()
-                        st.warning("Oferta ocultada (sigue disponible en Inicio para compradores).")
-                        st.rerun()
-
-                # Historial + CSV
-                with st.expander("Ver historial / Descargar CSV"):
-                    registros = [
-                        h for h in st.session_state.history if h["offer_id"] == o["id"]
-                    ]
-                    if registros:
-                        df = pd.DataFrame(registros)
-                        st.dataframe(df, use_container_width=True)
-                        csv = df.to_csv(index=False).encode("utf-8")
-                        st.download_button(
-                            "Descargar historial en CSV",
-                            csv,
-                            file_name=f"historial_oferta_{o['id']}.csv",
-                            mime="text/csv",
-                            key=f"csv_{o['id']}",
-                        )
-                    else:
-                        st.write("Sin registros aún para esta oferta.")
+            tarjeta_mi_oferta_productor(o, user)
+
+    mostrar_archivadas(
+        "Ver ofertas archivadas",
+        lambda: ofertas_archivadas_productor(user),
+        key=f"archivo_productor_{user}",
+    )
 
     st.markdown("---")
     st.subheader("Crear nueva oferta")
@@ -728,90 +4309,120 @@ def vista_mis_ofertas_productor(user):
             st.success("Oferta creada correctamente.")
             st.rerun()
 
+    importacion_masiva(user)
+
+
+def importacion_masiva(user):
+    """Carga de muchas ofertas desde un CSV o Excel."""
+    aviso = st.session_state.pop(f"importacion_{user}", None)
+    if aviso:
+        st.success(aviso)
+
+    with st.expander("Importar ofertas desde CSV o Excel"):
+        st.download_button(
+            "Descargar plantilla CSV",
+            ",".join(CAMPOS_IMPORTACION) + "\n",
+            file_name="plantilla_ofertas.csv",
+            mime="text/csv",
+            key=f"plantilla_{user}",
+        )
+        archivo = st.file_uploader(
+            "Archivo con una oferta por fila (toneladas y precio son obligatorios)",
+            type=["csv", "xlsx"],
+            key=f"archivo_importacion_{user}",
+        )
+        if archivo is None:
+            return
+        try:
+            filas, errores = validar_importacion(
+                leer_archivo_importacion(archivo.name, archivo.getvalue())
+            )
+        except (ValueError, pd.errors.ParserError) as e:
+            st.error(f"No se pudo leer el archivo: {e}")
+            return
+
+        st.caption(f"{len(filas)} fila(s) válida(s), {len(errores)} con errores.")
+        if len(errores):
+            st.dataframe(errores, hide_index=True, use_container_width=True)
+        if filas and st.button(f"Importar {len(filas)} ofertas", key=f"importar_{user}"):
+            ids = importar_ofertas(user, filas)
+            st.session_state[f"importacion_{user}"] = f"Se importaron {len(ids)} ofertas."
+            st.rerun()
+
 
+@st.fragment
+def tarjeta_mi_oferta_productor(o, user):
+    """Tarjeta de "Mis ofertas" del productor (fragmento)."""
+    if o.get("producer_hidden"):
+        st.warning(f"Oferta #{o['id']} ocultada.")
+        return
+
+    with st.container(border=True):
+        st.markdown(f"**Oferta #{o['id']} — {o.get('status','open')}**")
+        st.write(f"Comprador final: {o['buyer'] if o.get('buyer') else '—'}")
+        st.write(f"Toneladas: {o.get('toneladas','—')}")
+        st.write(f"Días de recolección: {o.get('recoleccion','—')}")
+        st.write(f"Canastillas: {o.get('canastillas','—')}")
+        st.write(f"Precio: {o.get('precio','—')}")
+        st.write(f"Calibre: {o.get('calibre','—')}")
+        st.write(f"Grado de madurez: {o.get('madurez','—')}")
+        st.write(f"Origen: {o.get('origen','—')}")
+        st.write(f"Creada: {o.get('created_at','—')} · Actualizada: {o.get('updated_at','—')}")
+
+        # OCULTAR (en vez de eliminar definitivamente)
+        if o.get("status") not in ["closed", "accepted"]:
+            if st.button("Eliminar oferta", key=f"del_{o['id']}"):
+                if ocultar_oferta(o, user):
+                    st.warning("Oferta ocultada (sigue disponible en Inicio para compradores).")
+                    st.rerun(scope="fragment")
+                else:
+                    st.error("Esta oferta ya se vendió; no se puede ocultar.")
+
+        # Historial + CSV
+        mostrar_historial(
+            o["id"],
+            "Ver historial / Descargar CSV",
+            "Descargar historial en CSV",
+            f"historial_oferta_{o['id']}.csv",
+            "Sin registros aún para esta oferta.",
+            key=f"csv_{o['id']}",
+        )
+
+
+@medir_latencia("vista_mis_ofertas_comprador")
+@instrumentar("vista_mis_ofertas_comprador")
 def vista_mis_ofertas_comprador(user):
     st.subheader("Mis contraofertas enviadas")
+    mostrar_exportacion_total(user, "buyer")
 
-    mis_contras = []
-    for c in st.session_state.offers:
-        if c.get("tipo") == "counter" and c.get("buyer") == user:
-            mis_contras.append(c)
+    mis_contras = mis_contraofertas_comprador(user)
 
     if not mis_contras:
         st.info("No has enviado contraofertas.")
+    elif st.session_state.get("modo_compacto"):
+        tabla_mis_contraofertas_comprador(user)
     else:
         for c in mis_contras:
-            with st.container(border=True):
-                st.markdown(f"**Contraoferta #{c['id']} — {c.get('status','—')}**")
-                st.write(f"Oferta original: #{c.get('parent_offer_id','—')}")
-                st.write(f"Productor: {c.get('producer','—')}")
-                st.write(f"Toneladas: {c.get('toneladas','—')}")
-                st.write(f"Días de recolección: {c.get('recoleccion','—')}")
-                st.write(f"Canastillas: {c.get('canastillas','—')}")
-                st.write(f"Precio: {c.get('precio','—')}")
-                st.write(f"Calibre: {c.get('calibre','—')}")
-                st.write(f"Grado de madurez: {c.get('madurez','—')}")
-                st.write(f"Origen: {c.get('origen','—')}")
-                st.write(f"Creada: {c.get('created_at','—')}")
-
-                # Eliminar contraoferta (solo si está abierta) -> la oferta vuelve a aparecer en Inicio
-                if c.get("status") == "open":
-                    if st.button("Eliminar contraoferta", key=f"del_c_{c['id']}"):
-                        c["status"] = "deleted"
-                        c["updated_at"] = ahora()
-                        registrar_historial(
-                            c["parent_offer_id"],
-                            user,
-                            "eliminar_contraoferta",
-                            f"El comprador {user} eliminó su contraoferta.",
-                        )
-                        enviar_notificacion(
-                            c["producer"],
-                            f"El comprador {user} eliminó su contraoferta #{c['id']}.",
-                        )
-
-                        # CLAVE: permitir que vuelva a aparecer en Inicio
-                        limpiar_accion_comprador(user, c["parent_offer_id"])
-
-                        save_all()
-                        st.warning("Contraoferta eliminada. La oferta volvió a tu Inicio.")
-                        st.rerun()
-
-                # Historial
-                with st.expander("Historial / Descargar CSV"):
-                    registros = [
-                        h
-                        for h in st.session_state.history
-                        if h["offer_id"] == c["parent_offer_id"]
-                    ]
-                    if registros:
-                        df = pd.DataFrame(registros)
-                        st.dataframe(df, use_container_width=True)
-                        csv = df.to_csv(index=False).encode("utf-8")
-                        st.download_button(
-                            "Descargar historial (oferta + contraofertas)",
-                            csv,
-                            file_name=f"historial_negocio_{c['parent_offer_id']}.csv",
-                            mime="text/csv",
-                            key=f"csv_buyer_{c['id']}",
-                        )
-                    else:
-                        st.write("Sin registros aún para este negocio.")
+            tarjeta_mi_contraoferta_comprador(c, user)
 
     st.markdown("---")
     st.subheader("Mis ofertas aceptadas (del vendedor)")
 
-    aceptadas = []
-    for o in st.session_state.offers:
-        if (
-            o.get("tipo") == "offer"
-            and o.get("buyer") == user
-            and o.get("status") in ["closed", "accepted"]
-        ):
-            aceptadas.append(o)
+    aceptadas = aceptadas_comprador(user)
+    mostrar_archivadas(
+        "Ver negocios archivados",
+        lambda: aceptadas_archivadas_comprador(user),
+        key=f"archivo_aceptadas_{user}",
+    )
 
     if not aceptadas:
         st.info("Todavía no tienes negocios cerrados.")
+    elif st.session_state.get("modo_compacto"):
+        st.dataframe(
+            tabla_por_columnas(aceptadas, COLUMNAS_TABLA_OFERTAS),
+            hide_index=True,
+            use_container_width=True,
+        )
     else:
         for o in aceptadas:
             with st.container(border=True):
@@ -828,27 +4439,181 @@ def vista_mis_ofertas_comprador(user):
                     f"Creada: {o.get('created_at','—')} · Actualizada: {o.get('updated_at','—')}"
                 )
 
+    st.markdown("---")
+    vista_posturas_comprador(user)
+
+
+def vista_posturas_comprador(user):
+    st.subheader("Mis posturas de compra")
+    st.caption(
+        "Te avisamos cuando se publique o actualice una oferta que cumpla tus condiciones."
+    )
+
+    with st.expander("Nueva postura"):
+        with st.form(f"form_postura_{user}"):
+            precio_max = st.number_input("Precio máximo", min_value=0.0, step=100.0)
+            col1, col2 = st.columns(2)
+            toneladas_min = col1.number_input("Toneladas mínimas", min_value=0.0, value=None)
+            toneladas_max = col2.number_input("Toneladas máximas", min_value=0.0, value=None)
+            calibres = st.text_input("Calibres (separados por coma; vacío = cualquiera)")
+            madurez = st.text_input("Grados de madurez (separados por coma; vacío = cualquiera)")
+            origenes = st.text_input("Orígenes (separados por coma; vacío = cualquiera)")
+            if st.form_submit_button("Registrar postura"):
+                if precio_max <= 0:
+                    st.error("Indica el precio máximo que estás dispuesto a pagar.")
+                else:
+                    registrar_postura(
+                        user, precio_max, toneladas_min, toneladas_max,
+                        calibres.strip(), madurez.strip(), origenes.strip(),
+                    )
+                    st.success("Postura registrada.")
+                    st.rerun()
+
+    posturas = posturas_comprador(user)
+    if not posturas:
+        st.info("No tienes posturas activas.")
+        return
+    for p in posturas:
+        with st.container(border=True):
+            minimo, maximo = p.get("toneladas_min"), p.get("toneladas_max")
+            st.markdown(f"**Postura #{p['id']}** · hasta ${p.get('precio_max')}")
+            st.write(
+                f"Toneladas: {minimo if minimo is not None else '—'} a "
+                f"{maximo if maximo is not None else '—'} · "
+                f"Calibres: {p.get('calibres') or 'cualquiera'} · "
+                f"Madurez: {p.get('madurez') or 'cualquiera'} · "
+                f"Origen: {p.get('origenes') or 'cualquiera'}"
+            )
+            with get_datos().lock:
+                cumplen = len(ofertas_para_postura(p))
+            st.caption(f"{cumplen} oferta(s) disponible(s) la cumplen ahora.")
+            if st.button("Cancelar postura", key=f"cancelar_postura_{p['id']}"):
+                cancelar_postura(p)
+                st.rerun()
+
 
+@st.fragment
+def tarjeta_mi_contraoferta_comprador(c, user):
+    """Tarjeta de "Mis contraofertas enviadas" del comprador (fragmento)."""
+    with st.container(border=True):
+        st.markdown(f"**Contraoferta #{c['id']} — {c.get('status','—')}**")
+        st.write(f"Oferta original: #{c.get('parent_offer_id','—')}")
+        st.write(f"Productor: {c.get('producer','—')}")
+        st.write(f"Toneladas: {c.get('toneladas','—')}")
+        st.write(f"Días de recolección: {c.get('recoleccion','—')}")
+        st.write(f"Canastillas: {c.get('canastillas','—')}")
+        st.write(f"Precio: {c.get('precio','—')}")
+        st.write(f"Calibre: {c.get('calibre','—')}")
+        st.write(f"Grado de madurez: {c.get('madurez','—')}")
+        st.write(f"Origen: {c.get('origen','—')}")
+        st.write(f"Creada: {c.get('created_at','—')}")
+
+        # Eliminar contraoferta (solo si está abierta) -> la oferta vuelve a aparecer en Inicio
+        if c.get("status") == "open":
+            if st.button("Eliminar contraoferta", key=f"del_c_{c['id']}"):
+                if eliminar_contraoferta(c, user):
+                    st.warning("Contraoferta eliminada. La oferta volvió a tu Inicio.")
+                    st.rerun(scope="fragment")
+                else:
+                    st.error("Esta contraoferta ya no está abierta.")
+
+        # Historial
+        mostrar_historial(
+            c["parent_offer_id"],
+            "Historial / Descargar CSV",
+            "Descargar historial (oferta + contraofertas)",
+            f"historial_negocio_{c['parent_offer_id']}.csv",
+            "Sin registros aún para este negocio.",
+            key=f"csv_buyer_{c['id']}",
+        )
+
+
+@st.fragment
+@medir_latencia("vista_notificaciones")
+@instrumentar("vista_notificaciones")
 def vista_notificaciones(user):
     st.subheader("Notificaciones")
 
-    notis = [n for n in st.session_state.notifications if n["usuario_destino"] == user]
-    if not notis:
+    rol = st.session_state.role
+    # Cursores (claves de clave_bandeja) de las páginas más antiguas abiertas
+    cursores = st.session_state.setdefault(f"cursores_notis_{user}", [])
+    antes_de = cursores[-1] if cursores else None
+    notis = consulta_sesion(
+        ("notificaciones", user, antes_de),
+        lambda: pagina_bandeja(user, rol, antes_de=antes_de),
+    )
+    if not notis and not cursores:
         st.info("No tienes notificaciones por ahora.")
         return
 
-    # Ordenar de más reciente a más antigua
-    notis = sorted(notis, key=lambda x: x["fecha"], reverse=True)
-
-    for n in notis:
+    # Ya vienen de la más reciente a la más antigua
+    for n, es_nueva, _ in notis:
         with st.container(border=True):
-            st.write(f"**{n['fecha']}** — {n['mensaje']}")
+            marca = "🆕 " if es_nueva else ""
+            st.write(f"{marca}**{texto_ts(ts_notificacion(n))}** — {n['mensaje']}")
+
+    col_nuevas, col_antiguas = st.columns(2)
+    if cursores and col_nuevas.button("← Más recientes", key=f"notis_prev_{user}"):
+        cursores.pop()
+        st.rerun(scope="fragment")
+    if len(notis) == TAMANO_PAGINA_NOTIFICACIONES and col_antiguas.button(
+        "Más antiguas →", key=f"notis_next_{user}"
+    ):
+        cursores.append(notis[-1][2])
+        st.rerun(scope="fragment")
+
+    # st.tabs ejecuta esta vista en cada carga aunque la pestaña no esté
+    # abierta: los marcadores solo avanzan cuando el usuario lo pide
+    if any(es_nueva for _, es_nueva, _ in notis) and st.button(
+        "Marcar como leídas", key=f"notis_leidas_{user}"
+    ):
+        marcar_notificaciones_leidas(user, rol)
+        # Rerun completo: el contador de no leídas está en vigilar_cambios
+        st.rerun()
 
 
 # ============================================================
 #  APLICACIÓN PRINCIPAL
 # ============================================================
 
+def vista_rendimiento():
+    """Panel del administrador: percentiles por sección y exportación."""
+    st.subheader("Rendimiento por sección")
+    if not INSTRUMENTACION:
+        st.info(
+            "La instrumentación está desactivada. "
+            "Inicia la app con AGUACATE_INSTRUMENTACION=1 para medir."
+        )
+        return
+
+    metricas = get_metricas()
+    resumen = metricas.resumen()
+    if not resumen:
+        st.info("Aún no hay mediciones.")
+        return
+
+    st.caption(f"Percentiles sobre las últimas {metricas.ventana} llamadas de cada sección.")
+    st.dataframe(pd.DataFrame(resumen), hide_index=True, use_container_width=True)
+
+    col_prom, col_csv, col_reset = st.columns(3)
+    col_prom.download_button(
+        "Exportar (Prometheus)",
+        metricas.prometheus(),
+        file_name="aguacate_metricas.prom",
+        mime="text/plain",
+    )
+    col_csv.download_button(
+        "Exportar muestras (CSV)",
+        metricas.csv(),
+        file_name="aguacate_metricas.csv",
+        mime="text/csv",
+    )
+    if col_reset.button("Reiniciar métricas"):
+        metricas.reiniciar()
+        st.rerun()
+
+
+@medir_latencia("app")
 def main():
     init_state()
 
@@ -864,9 +4629,27 @@ def main():
         st.session_state.user = None
         st.session_state.role = None
         st.rerun()
+    st.toggle("Vista compacta (tabla)", key="modo_compacto")
+    mostrar_latencias()
+    mostrar_cola_escritura()
+
+    if st.session_state.role == "admin":
+        pestaña_rendimiento, pestaña_mercado = st.tabs(["Rendimiento", "Mercado"])
+        with pestaña_rendimiento:
+            vista_rendimiento()
+        with pestaña_mercado:
+            vista_mercado()
+        return
 
-    # Navegación principal
-    pestaña = st.tabs(["Inicio", "Mis ofertas", "Notificaciones"])
+    # La página se dibuja con los datos actuales; después el fragmento
+    # vigilar_cambios mantiene al día el contador de no leídas y avisa de
+    # los cambios de otras sesiones sin volver a ejecutar la página
+    marcar_feed_al_dia()
+    vigilar_cambios(st.session_state.user, st.session_state.role)
+
+    # Navegación principal. El contador de no leídas está en vigilar_cambios:
+    # el título de una pestaña solo cambia con un rerun completo
+    pestaña = st.tabs(["Inicio", "Mis ofertas", "Notificaciones", "Mercado"])
 
     # INICIO
     with pestaña[0]:
@@ -886,6 +4669,10 @@ def main():
     with pestaña[2]:
         vista_notificaciones(st.session_state.user)
 
+    # MERCADO
+    with pestaña[3]:
+        vista_mercado()
+
 
 if __name__ == "__main__":
     main()
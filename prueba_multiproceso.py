@@ -0,0 +1,257 @@
+"""Prueba de estrés: varios procesos servidor escribiendo los mismos datos.
+
+Uso:
+    python prueba_multiproceso.py                          # journal y sqlite, 4 procesos
+    python prueba_multiproceso.py --backends csv journal sqlite --procesos 8 --acciones 40
+
+Para cada backend, en un directorio temporal y con AGUACATE_MULTIPROCESO=1:
+
+1. se publican --disputadas ofertas iniciales;
+2. arranca un proceso observador que carga los datos y espera;
+3. --procesos trabajadores ejecutan a la vez --acciones rondas cada uno:
+   crear una oferta, marcar interés en una oferta al azar e intentar aceptar
+   una de las ofertas disputadas (todos compiten por las mismas), una vez
+   con aceptar_oferta y la siguiente con aceptar_ofertas_lote;
+4. el observador se pone al día (recarga incremental, o completa si hizo
+   falta) y compara su memoria con una carga nueva desde disco;
+5. una carga nueva comprueba que no se perdió nada: todas las ofertas y
+   marcas de interés están, y cada oferta disputada se aceptó una sola vez,
+   por el trabajador que recibió la confirmación.
+
+Imprime el resultado en JSON y termina con código 1 si algo falla.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+RUTA = os.path.abspath(__file__)
+DIRECTORIO = os.path.dirname(RUTA)
+
+
+def importar_main(directorio):
+    os.chdir(directorio)
+    sys.path.insert(0, DIRECTORIO)
+    import main
+    return main
+
+
+def resumen_tablas(datos):
+    """Contenido comparable de los datos en memoria de un proceso."""
+    return {
+        "offers": sorted(
+            (o["id"], o.get("status"), o.get("buyer")) for o in datos.offers
+        ),
+        "history": sorted(
+            (h["offer_id"], h["actor"], h["accion"]) for h in datos.history
+        ),
+        "notifications": len(datos.notifications),
+        "buyer_actions": sorted(
+            (b, o) for b, ids in datos.buyer_actions.items() for o in ids
+        ),
+    }
+
+
+def sembrar(args):
+    main = importar_main(args.dir)
+    for _ in range(args.disputadas):
+        main.crear_oferta("vendedor0", 10.0, "5", "100", 30000.0, "18",
+                          "Verde", "Michoacán", None)
+    print(json.dumps([o["id"] for o in main.get_datos().offers]))
+
+
+def trabajador(args):
+    main = importar_main(args.dir)
+    n = args.trabajador
+    rnd = random.Random(n)
+    productor, comprador = f"vendedor{n}", f"comprador{n}"
+    disputadas = json.loads(args.disputadas_ids)
+    # Todos arrancan a la vez para que las escrituras se crucen
+    time.sleep(max(0.0, args.inicio - time.time()))
+
+    interes, aceptadas = 0, []
+    for ronda in range(args.acciones):
+        main.crear_oferta(productor, float(rnd.randint(1, 40)), "5", "100",
+                          float(rnd.randint(20, 60) * 1000), "18", "Verde",
+                          "Jalisco", None)
+        with main.acceso_exclusivo():
+            oferta = rnd.choice(list(main.get_datos().offers))
+            # Solo cuenta si la oferta seguía disponible
+            if main.marcar_interes(oferta, comprador):
+                interes += 1
+        objetivo = rnd.choice(disputadas)
+        # Se alternan la acción individual (botón de la tarjeta) y la de lote
+        if ronda % 2:
+            aplicada = main.aceptar_ofertas_lote([{"id": objetivo}], comprador)
+        else:
+            aplicada = main.aceptar_oferta({"id": objetivo}, comprador)
+        if aplicada:
+            aceptadas.append(objetivo)
+    print(json.dumps({"trabajador": n, "interes": interes, "aceptadas": aceptadas}))
+
+
+def observar(args):
+    main = importar_main(args.dir)
+    datos = main.get_datos()
+    version_inicial = datos.version_almacen
+    open(os.path.join(args.dir, "listo"), "w").close()
+    while not os.path.exists(os.path.join(args.dir, "fin")):
+        time.sleep(0.05)
+    main.sincronizar_si_hace_falta()
+    nuevo = main.DatosCompartidos(main.get_almacen())
+    print(json.dumps({
+        "version_inicial": version_inicial,
+        "version_final": datos.version_almacen,
+        "recarga": "completa" if datos.cambios.recarga else "incremental",
+        "coincide_con_disco": resumen_tablas(datos) == resumen_tablas(nuevo),
+    }))
+
+
+def verificar(args):
+    main = importar_main(args.dir)
+    datos = main.get_datos()
+    trabajadores = json.loads(args.resultados)
+    disputadas = set(json.loads(args.disputadas_ids))
+
+    errores = []
+    for t in trabajadores:
+        n = t["trabajador"]
+        creadas = len(datos.offers.buscar("producer", f"vendedor{n}", "offer"))
+        if creadas != args.acciones:
+            errores.append(f"vendedor{n}: {creadas} ofertas de {args.acciones}")
+        marcas = sum(
+            1 for h in datos.history
+            if h["actor"] == f"comprador{n}" and h["accion"] == "interes"
+        )
+        if marcas != t["interes"]:
+            errores.append(f"comprador{n}: {marcas} marcas de interés de {t['interes']}")
+
+    ganadores = {o: f"comprador{t['trabajador']}" for t in trabajadores for o in t["aceptadas"]}
+    confirmadas = sum(len(t["aceptadas"]) for t in trabajadores)
+    if confirmadas != len(ganadores):
+        errores.append(f"{confirmadas} aceptaciones confirmadas para {len(ganadores)} ofertas")
+    for offer_id in disputadas:
+        aceptaciones = [
+            h for h in datos.historial_por_oferta.get(offer_id, [])
+            if h["accion"] == "aceptar_oferta"
+        ]
+        oferta = datos.offers.get(offer_id)
+        esperado = ganadores.get(offer_id)
+        if len(aceptaciones) != (1 if esperado else 0):
+            errores.append(f"oferta {offer_id}: aceptada {len(aceptaciones)} veces")
+        elif esperado and (oferta.get("buyer") != esperado or oferta.get("status") != "accepted"):
+            errores.append(f"oferta {offer_id}: comprador {oferta.get('buyer')}, esperado {esperado}")
+
+    print(json.dumps({
+        "ofertas": sum(1 for o in datos.offers if o.get("tipo") == "offer"),
+        "historial": len(datos.history),
+        "aceptadas": len(ganadores),
+        "errores": errores,
+    }))
+
+
+def lanzar(modo, directorio, entorno, *extra):
+    return subprocess.Popen(
+        [sys.executable, RUTA, modo, "--dir", directorio, *extra],
+        env=entorno, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+
+
+def salida_json(proceso):
+    stdout, stderr = proceso.communicate()
+    if proceso.returncode != 0:
+        raise RuntimeError(stderr.strip().splitlines()[-1] if stderr.strip() else "sin salida")
+    # La última línea es el JSON (Streamlit puede escribir avisos antes)
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def ejecutar(backend, args):
+    directorio = tempfile.mkdtemp(prefix=f"aguacate_multi_{backend}_")
+    entorno = {**os.environ, "AGUACATE_MULTIPROCESO": "1",
+               "AGUACATE_PERSISTENCIA": backend}
+    comunes = ["--acciones", str(args.acciones)]
+    try:
+        ids = salida_json(lanzar("sembrar", directorio, entorno,
+                                 "--disputadas", str(args.disputadas)))
+        ids_json = json.dumps(ids)
+        observador = lanzar("observar", directorio, entorno)
+        while not os.path.exists(os.path.join(directorio, "listo")):
+            if observador.poll() is not None:
+                salida_json(observador)
+                raise RuntimeError("el observador terminó antes de tiempo")
+            time.sleep(0.05)
+
+        inicio = time.time() + 2  # margen para que todos importen main
+        trabajadores = [
+            lanzar("trabajador", directorio, entorno, "--trabajador", str(n),
+                   "--inicio", str(inicio), "--disputadas-ids", ids_json, *comunes)
+            for n in range(1, args.procesos + 1)
+        ]
+        resultados = [salida_json(p) for p in trabajadores]
+        duracion = time.time() - inicio
+        open(os.path.join(directorio, "fin"), "w").close()
+
+        observado = salida_json(observador)
+        verificado = salida_json(lanzar(
+            "verificar", directorio, entorno, "--resultados", json.dumps(resultados),
+            "--disputadas-ids", ids_json, *comunes,
+        ))
+        if not observado["coincide_con_disco"]:
+            verificado["errores"].append("la memoria del observador no coincide con el disco")
+        return {
+            "backend": backend,
+            "procesos": args.procesos,
+            "acciones_por_proceso": args.acciones,
+            "segundos": round(duracion, 2),
+            "observador": observado,
+            **verificado,
+            "ok": not verificado["errores"],
+        }
+    except RuntimeError as e:
+        return {"backend": backend, "ok": False, "errores": [str(e)]}
+    finally:
+        if args.conservar:
+            print(f"Datos de {backend} en {directorio}", file=sys.stderr)
+        else:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modo", nargs="?", default="prueba",
+                        choices=["prueba", "sembrar", "trabajador", "observar", "verificar"],
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--backends", nargs="+", default=["journal", "sqlite"],
+                        choices=["csv", "journal", "sqlite"])
+    parser.add_argument("--procesos", type=int, default=4)
+    parser.add_argument("--acciones", type=int, default=25,
+                        help="Rondas de cada proceso (crear, interés, aceptar)")
+    parser.add_argument("--disputadas", type=int, default=10,
+                        help="Ofertas que todos los procesos intentan aceptar")
+    parser.add_argument("--conservar", action="store_true",
+                        help="No borrar los directorios de datos")
+    # Parámetros internos de los subprocesos
+    for interno in ("--dir", "--disputadas-ids", "--resultados"):
+        parser.add_argument(interno, help=argparse.SUPPRESS)
+    parser.add_argument("--trabajador", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inicio", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.modo != "prueba":
+        {"sembrar": sembrar, "trabajador": trabajador,
+         "observar": observar, "verificar": verificar}[args.modo](args)
+        return
+
+    resultados = [ejecutar(backend, args) for backend in args.backends]
+    print(json.dumps(resultados, indent=2, ensure_ascii=False))
+    sys.exit(0 if all(r["ok"] for r in resultados) else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,112 @@
+"""Herramientas para los snapshots de datos de la app.
+
+Uso:
+    python snapshot.py convertir [--origen csv] [--destino parquet]
+    python snapshot.py benchmark [--repeticiones 5]
+
+`convertir` reescribe todas las tablas (offers, history, ...) en el otro
+formato usando el esquema tipado de main.py. `benchmark` mide el tiempo de
+carga en el arranque con cada formato disponible e imprime el resultado en
+JSON; termina con código 1 si a un formato le faltan archivos (por ejemplo,
+Parquet antes de `convertir`).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import main
+
+
+def tablas_faltantes(formato):
+    """Tablas con snapshot CSV (el formato de origen) sin archivo en `formato`."""
+    existentes = [
+        nombre for nombre in main.TABLAS
+        if os.path.exists(main.archivo_tabla(nombre, "csv"))
+    ]
+    if not existentes:
+        return sorted(main.TABLAS)
+    return sorted(
+        nombre for nombre in existentes
+        if not os.path.exists(main.archivo_tabla(nombre, formato))
+    )
+
+
+def medir_carga(formato, repeticiones):
+    """Tiempos (ms) de cargar todas las tablas con un formato.
+
+    Se pasa el archivo explícito a cargar_tabla para leerlo siempre de
+    disco: sin archivo, con AGUACATE_MULTIPROCESO=1 pasaría por el lector
+    incremental cacheado y se mediría un acierto de caché.
+    """
+    faltantes = tablas_faltantes(formato)
+    if faltantes:
+        raise RuntimeError(
+            f"Faltan archivos {formato} de: {', '.join(faltantes)}"
+            + (" (ejecuta primero: python snapshot.py convertir)" if formato == "parquet" else "")
+        )
+    tiempos = []
+    filas = 0
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        tablas = {
+            nombre: main.cargar_tabla(
+                nombre, formato, archivo=main.archivo_tabla(nombre, formato)
+            )
+            for nombre in main.TABLAS
+            if os.path.exists(main.archivo_tabla(nombre, formato))
+        }
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+        filas = sum(len(registros) for registros in tablas.values())
+    return {
+        "formato": formato,
+        "filas": filas,
+        "bytes": sum(
+            os.path.getsize(main.archivo_tabla(nombre, formato))
+            for nombre in main.TABLAS
+            if os.path.exists(main.archivo_tabla(nombre, formato))
+        ),
+        "ms_mediana": round(statistics.median(tiempos), 3),
+        "ms_min": round(min(tiempos), 3),
+    }
+
+
+def cmd_convertir(args):
+    main.convertir_snapshot(args.origen, args.destino)
+    print(f"Snapshots convertidos de {args.origen} a {args.destino}")
+
+
+def cmd_benchmark(args):
+    resultados = []
+    for formato in ("csv", "parquet"):
+        try:
+            resultados.append(medir_carga(formato, args.repeticiones))
+        except RuntimeError as e:
+            resultados.append({"formato": formato, "error": str(e)})
+    print(json.dumps(resultados, indent=2, ensure_ascii=False))
+    if any("error" in r for r in resultados):
+        sys.exit(1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("convertir", help="Convierte los snapshots entre formatos")
+    p.add_argument("--origen", choices=["csv", "parquet"], default="csv")
+    p.add_argument("--destino", choices=["csv", "parquet"], default="parquet")
+    p.set_defaults(func=cmd_convertir)
+
+    p = sub.add_parser("benchmark", help="Mide la carga inicial con cada formato")
+    p.add_argument("--repeticiones", type=int, default=5)
+    p.set_defaults(func=cmd_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()